@@ -4,33 +4,71 @@
 # https://github.com/gtluu/flex_maldi_dda_automation
 
 
-import os
-from contextlib import redirect_stdout
-from io import StringIO
-import atexit
-import shutil
-import webview
-import numpy.core.multiarray
-from TSFImagingDataViewer import VERSION
-from TSFImagingDataViewer.dashboard import app, FILE_SYSTEM_BACKEND
+import time
+STARTUP_TIME = time.perf_counter()
+# The imports below are timed as part of startup, so they follow STARTUP_TIME.
+import os  # noqa: E402
+import sys  # noqa: E402
+from contextlib import redirect_stdout  # noqa: E402
+from io import StringIO  # noqa: E402
+import atexit  # noqa: E402
+import shutil  # noqa: E402
+import threading  # noqa: E402
+import multiprocessing  # noqa: E402
+import webview  # noqa: E402
+import numpy.core.multiarray  # noqa: E402
+from TSFImagingDataViewer import VERSION  # noqa: E402
+from TSFImagingDataViewer.metrics import METRICS  # noqa: E402
+
+LOADING_HTML = ('<html><body style="font-family: sans-serif; display: flex; align-items: center; '
+                'justify-content: center; height: 100vh; margin: 0;">Loading TSFImagingDataViewer...</body></html>')
+
+
+def record_startup_time(stage):
+    """
+    Record the time elapsed since this script started in the 'startup_seconds' histogram.
+
+    :param stage: Startup stage that was reached (i.e. 'window' or 'dashboard').
+    :type stage: str
+    """
+    METRICS.observe('startup_seconds', time.perf_counter() - STARTUP_TIME, stage=stage)
+
+
+def start_dashboard(window):
+    """
+    Import the dashboard, serve it on a local port, and load it in the window. Runs on a background thread once the
+    loading window is visible so that the window does not wait for Dash, plotly, and pyTDFSDK to be imported.
+
+    :param window: Window showing the loading page.
+    :type window: webview.Window
+    """
+    record_startup_time('window')
+    from werkzeug.serving import make_server
+    from TSFImagingDataViewer.dashboard import get_app
+    server = make_server('127.0.0.1', 0, get_app().server, threaded=False)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    window.load_url(f'http://127.0.0.1:{server.server_port}/')
+    record_startup_time('dashboard')
 
 
 def main():
     stream = StringIO()
     with redirect_stdout(stream):
         webview.settings['ALLOW_DOWNLOADS'] = True
-        app.server.config['THREADED'] = False
-        window = webview.create_window(f'TSFImagingDataViewer {VERSION}', app.server)
-        webview.start()
+        window = webview.create_window(f'TSFImagingDataViewer {VERSION}', html=LOADING_HTML)
+        webview.start(start_dashboard, window)
 
 
 def delete_file_system_backend():
-    if os.path.exists(FILE_SYSTEM_BACKEND):
-        shutil.rmtree(FILE_SYSTEM_BACKEND)
+    # The dashboard may not have been imported if the window was closed while loading.
+    dashboard = sys.modules.get('TSFImagingDataViewer.dashboard')
+    if dashboard is not None and os.path.exists(dashboard.FILE_SYSTEM_BACKEND):
+        shutil.rmtree(dashboard.FILE_SYSTEM_BACKEND)
 
 
 atexit.register(delete_file_system_backend)
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     main()
@@ -16,7 +16,18 @@ a = Analysis(
 		('third-party-licenses.txt', '.'),
 		('C:\\Users\\bass\\.conda\\envs\\tsfviewer\\Lib\\site-packages\\TDF-SDK', 'TDF-SDK')
 	],
-    hiddenimports=[],
+    hiddenimports=[
+		'TSFImagingDataViewer.cache',
+		'TSFImagingDataViewer.centroid_index',
+		'TSFImagingDataViewer.dashboard',
+		'TSFImagingDataViewer.datacube',
+		'TSFImagingDataViewer.jobs',
+		'TSFImagingDataViewer.layout',
+		'TSFImagingDataViewer.metrics',
+		'TSFImagingDataViewer.parallel',
+		'TSFImagingDataViewer.sessions',
+		'TSFImagingDataViewer.util'
+	],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
@@ -1,27 +1,26 @@
-import os
-import copy
-from contextlib import redirect_stdout
-from io import StringIO
-import atexit
-import shutil
-import numpy as np
-import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
-from plotly_resampler import FigureResampler
-from dash import State, callback_context, no_update, dcc, html
-import dash_bootstrap_components as dbc
-from dash_extensions.enrich import (Input, Output, DashProxy, MultiplexerTransform, Serverside,
-                                    ServersideOutputTransform, FileSystemBackend)
-import tempfile
-import tkinter
-from tkinter.filedialog import askdirectory
-import webview
-from pyTDFSDK.classes import TsfData, TsfSpectrum
-from pyTDFSDK.init_tdf_sdk import init_tdf_sdk_api
-
-from TSFImagingDataViewer.dashboard import *
-from TSFImagingDataViewer.layout import *
-from TSFImagingDataViewer.util import *
+import importlib
 
 VERSION = '1.0.0'
+
+# Submodules are imported on first attribute access so that importing the package (i.e. to read VERSION) does not
+# import Dash, plotly, pandas, or pyTDFSDK. Names that used to be star-imported from the submodules are looked up in
+# reverse import order so that the same module wins when several of them define a name.
+SUBMODULES = ['util', 'sessions', 'parallel', 'metrics', 'layout', 'jobs', 'datacube', 'dashboard', 'centroid_index',
+              'cache']
+
+
+def __getattr__(name):
+    if name in SUBMODULES or name in ('batch', 'export'):
+        return importlib.import_module(f'{__name__}.{name}')
+    if not name.startswith('_'):
+        for submodule in SUBMODULES:
+            module = importlib.import_module(f'{__name__}.{submodule}')
+            if hasattr(module, name):
+                value = getattr(module, name)
+                globals()[name] = value
+                return value
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | set(SUBMODULES) | {'batch', 'export'})
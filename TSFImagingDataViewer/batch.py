@@ -0,0 +1,485 @@
+import os
+import sys
+import json
+import zlib
+import struct
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from plotly.colors import sequential, hex_to_rgb
+from pyTDFSDK.classes import TsfData
+from pyTDFSDK.init_tdf_sdk import init_tdf_sdk_api
+from TSFImagingDataViewer.util import (schema_detection, get_dataset_fingerprint, parse_mz_targets,
+                                       resume_average_spectrum, get_ion_images_array, get_tic_image_array,
+                                       get_mz_bins)
+from TSFImagingDataViewer.parallel import DEFAULT_CHUNK_SIZE
+from TSFImagingDataViewer.export import EXPORT_FORMATS, EXPORT_CHUNK_SIZE, export_spectra
+
+BATCH_MANIFEST_FILENAME = 'manifest.json'
+BATCH_MANIFEST_VERSION = 2
+BATCH_FORMATS = ['npy', 'png', 'csv']
+BATCH_SPECTRUM_FORMATS = ['npy', 'csv']
+
+
+def get_args(args=None):
+    """
+    Parse command line parameters for batch export.
+
+    :param args: List of command line arguments. Defaults to sys.argv.
+    :type args: list[str] | None
+    :return: Arguments with default values if not specified by the user.
+    :rtype: dict
+    """
+    parser = argparse.ArgumentParser(description='Export average spectra, TIC images, ion images, and spectra from '
+                                                 'Bruker *.d TSF datasets without the viewer.')
+    parser.add_argument('input', nargs='+', help='Path(s) to Bruker *.d directories containing TSF data.')
+    parser.add_argument('--outdir', required=True, help='Directory in which the results of each dataset are saved.')
+    parser.add_argument('--mz', nargs='*', type=float, default=[], help='Target m/z values for ion images.')
+    parser.add_argument('--targets', default='',
+                        help='Text file with one ion image target per line as "m/z", "m/z, tolerance", or '
+                             '"m/z, tolerance, Da/ppm".')
+    parser.add_argument('--mz_tolerance', type=float, default=0.05, help='Default m/z tolerance (+/-).')
+    parser.add_argument('--mz_tolerance_unit', default='Da', choices=['Da', 'ppm'],
+                        help='Default m/z tolerance unit.')
+    parser.add_argument('--average_sampling_fraction', type=float, default=1.0,
+                        help='Fraction of frames used for the average spectrum. Use 0 to skip the average spectrum.')
+    parser.add_argument('--mz_bin_width', type=float, default=0,
+                        help='Width of the m/z bins used to bin spectra for the average spectrum and spectra '
+                             'exports. Use 0 to use profile spectra.')
+    parser.add_argument('--mz_bin_unit', default='Da', choices=['Da', 'ppm'], help='m/z bin width unit.')
+    parser.add_argument('--no_tic', action='store_true', help='Do not export the TIC image.')
+    parser.add_argument('--formats', nargs='+', default=BATCH_FORMATS, choices=BATCH_FORMATS,
+                        help='Output formats.')
+    parser.add_argument('--export', nargs='+', default=[], choices=EXPORT_FORMATS,
+                        help='Also export the spectrum of every frame to chunked HDF5 (.h5), Zarr (.zarr), and/or '
+                             'continuous mode imzML (.imzML/.ibd). HDF5 and Zarr require h5py and zarr.')
+    parser.add_argument('--export_chunk_size', type=int, default=EXPORT_CHUNK_SIZE,
+                        help='Number of frames read and written per chunk when exporting spectra.')
+    parser.add_argument('--png_scale', type=int, default=1,
+                        help='Integer factor used to upscale ion images in PNG files.')
+    parser.add_argument('--processes', type=int, default=1, help='Number of datasets processed in parallel.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes used to read the frames of each dataset.')
+    parser.add_argument('--chunk_size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='Number of frames processed per chunk.')
+    parser.add_argument('--overwrite', action='store_true', help='Recompute results that have already been exported.')
+    return vars(parser.parse_args(args))
+
+
+def get_viridis_lut():
+    """
+    Get a 256 entry viridis lookup table interpolated from the plotly viridis color scale.
+
+    :return: uint8 numpy array with shape (256, 3).
+    :rtype: numpy.array
+    """
+    colors = np.array([hex_to_rgb(color) for color in sequential.Viridis], dtype=np.float64)
+    positions = np.linspace(0, 255, len(colors))
+    lut = np.stack([np.interp(np.arange(256), positions, colors[:, channel]) for channel in range(3)], axis=1)
+    return np.round(lut).astype(np.uint8)
+
+
+def get_png_bytes(rgb_image):
+    """
+    Encode an RGB image as a PNG file.
+
+    :param rgb_image: uint8 numpy array with shape (number of rows, number of columns, 3).
+    :type rgb_image: numpy.array
+    :return: PNG file contents.
+    :rtype: bytes
+    """
+    def get_chunk(chunk_type, chunk_data):
+        return (struct.pack('>I', len(chunk_data)) + chunk_type + chunk_data +
+                struct.pack('>I', zlib.crc32(chunk_type + chunk_data) & 0xFFFFFFFF))
+
+    height, width = rgb_image.shape[:2]
+    # Each row is prefixed with filter type 0 (none).
+    scanlines = np.concatenate([np.zeros((height, 1), dtype=np.uint8),
+                                np.ascontiguousarray(rgb_image, dtype=np.uint8).reshape(height, width * 3)],
+                               axis=1)
+    return (b'\x89PNG\r\n\x1a\n' +
+            get_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            get_chunk(b'IDAT', zlib.compress(scanlines.tobytes(), 6)) +
+            get_chunk(b'IEND', b''))
+
+
+def get_image_png_bytes(image, scale=1):
+    """
+    Map a 2D image to the viridis color scale, scaled from 0 to its maximum, and encode it as a PNG file.
+
+    :param image: 2D numpy array.
+    :type image: numpy.array
+    :param scale: Integer factor used to upscale the image.
+    :type scale: int
+    :return: PNG file contents.
+    :rtype: bytes
+    """
+    max_intensity = np.max(image, initial=0)
+    if max_intensity > 0:
+        indices = np.round(np.clip(image / max_intensity, 0, 1) * 255).astype(np.uint8)
+    else:
+        indices = np.zeros(image.shape, dtype=np.uint8)
+    if scale > 1:
+        indices = np.repeat(np.repeat(indices, scale, axis=0), scale, axis=1)
+    return get_png_bytes(get_viridis_lut()[indices])
+
+
+def write_atomic(path, write_func, mode='wb'):
+    """
+    Write a file by writing to a temporary file first and renaming it, so that interrupted exports never leave a
+    partially written output behind.
+
+    :param path: Path to the output file.
+    :type path: str
+    :param write_func: Function called with the open temporary file.
+    :type write_func: function
+    :param mode: Mode used to open the temporary file.
+    :type mode: str
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, mode) as tmp_file:
+        write_func(tmp_file)
+    os.replace(tmp_path, path)
+
+
+def write_image(path, image, formats, png_scale=1):
+    """
+    Write a 2D image to each of the requested formats.
+
+    :param path: Path to the output file without extension.
+    :type path: str
+    :param image: 2D numpy array.
+    :type image: numpy.array
+    :param formats: List of output formats ('npy', 'png', and/or 'csv').
+    :type formats: list[str]
+    :param png_scale: Integer factor used to upscale the image in PNG files.
+    :type png_scale: int
+    :return: List of paths written.
+    :rtype: list[str]
+    """
+    paths = []
+    if 'npy' in formats:
+        write_atomic(path + '.npy', lambda image_file: np.save(image_file, image))
+        paths.append(path + '.npy')
+    if 'png' in formats:
+        png_bytes = get_image_png_bytes(image, png_scale)
+        write_atomic(path + '.png', lambda image_file: image_file.write(png_bytes))
+        paths.append(path + '.png')
+    if 'csv' in formats:
+        write_atomic(path + '.csv', lambda image_file: np.savetxt(image_file, image, delimiter=','))
+        paths.append(path + '.csv')
+    return paths
+
+
+def write_spectrum(path, mz_array, intensity_array, formats):
+    """
+    Write a spectrum to each of the requested formats. PNG is not supported for spectra and is ignored.
+
+    :param path: Path to the output file without extension.
+    :type path: str
+    :param mz_array: Array containing m/z values.
+    :type mz_array: numpy.array
+    :param intensity_array: Array containing intensity values.
+    :type intensity_array: numpy.array
+    :param formats: List of output formats ('npy' and/or 'csv').
+    :type formats: list[str]
+    :return: List of paths written.
+    :rtype: list[str]
+    """
+    paths = []
+    spectrum = np.stack([mz_array, intensity_array], axis=1)
+    if 'npy' in formats:
+        write_atomic(path + '.npy', lambda spectrum_file: np.save(spectrum_file, spectrum))
+        paths.append(path + '.npy')
+    if 'csv' in formats:
+        write_atomic(path + '.csv',
+                     lambda spectrum_file: np.savetxt(spectrum_file, spectrum, delimiter=',', header='m/z,Intensity',
+                                                      comments=''))
+        paths.append(path + '.csv')
+    return paths
+
+
+def get_ion_image_name(mz, mz_tolerance, mz_tolerance_unit):
+    """
+    Get the output file name of an ion image without extension.
+
+    :param mz: m/z value.
+    :type mz: float
+    :param mz_tolerance: m/z tolerance (+/-).
+    :type mz_tolerance: float
+    :param mz_tolerance_unit: m/z tolerance unit.
+    :type mz_tolerance_unit: str
+    :return: File name.
+    :rtype: str
+    """
+    return f'ion_image_mz{mz}_{mz_tolerance}{mz_tolerance_unit}'
+
+
+def load_manifest(outdir, fingerprint):
+    """
+    Load the manifest of a previous export of a dataset. Manifests of a different version or of a dataset whose raw
+    data has changed are ignored.
+
+    :param outdir: Output directory of the dataset.
+    :type outdir: str
+    :param fingerprint: Current fingerprint of the dataset.
+    :type fingerprint: dict
+    :return: Dictionary mapping completed items to the formats and paths written for them.
+    :rtype: dict
+    """
+    manifest_path = os.path.join(outdir, BATCH_MANIFEST_FILENAME)
+    if not os.path.isfile(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get('version') != BATCH_MANIFEST_VERSION or manifest.get('fingerprint') != fingerprint:
+        return {}
+    return manifest.get('outputs', {})
+
+
+def save_manifest(outdir, dataset, fingerprint, outputs):
+    """
+    Save the manifest of a dataset listing every completed item and its output paths.
+
+    :param outdir: Output directory of the dataset.
+    :type outdir: str
+    :param dataset: Path to the .d directory.
+    :type dataset: str
+    :param fingerprint: Fingerprint of the dataset.
+    :type fingerprint: dict
+    :param outputs: Dictionary mapping completed items to the formats and paths written for them.
+    :type outputs: dict
+    """
+    manifest = {'version': BATCH_MANIFEST_VERSION,
+                'dataset': os.path.abspath(dataset),
+                'fingerprint': fingerprint,
+                'outputs': outputs}
+    write_atomic(os.path.join(outdir, BATCH_MANIFEST_FILENAME),
+                 lambda manifest_file: json.dump(manifest, manifest_file, indent=4),
+                 mode='w')
+
+
+def is_item_valid(outputs, item):
+    """
+    Check whether an item has been exported and all of its output files still exist.
+
+    :param outputs: Dictionary mapping completed items to the formats and paths written for them.
+    :type outputs: dict
+    :param item: Name of the item.
+    :type item: str
+    :return: True if the item has been exported.
+    :rtype: bool
+    """
+    # Zarr stores are directories.
+    return item in outputs and all(os.path.exists(path) for path in outputs[item]['paths'])
+
+
+def get_missing_formats(outputs, item, formats):
+    """
+    Get the requested formats of an item that have not been exported yet. Every format is missing if any output file
+    of the item has been removed.
+
+    :param outputs: Dictionary mapping completed items to the formats and paths written for them.
+    :type outputs: dict
+    :param item: Name of the item.
+    :type item: str
+    :param formats: Requested output formats.
+    :type formats: list[str]
+    :return: List of formats that need to be exported.
+    :rtype: list[str]
+    """
+    if not is_item_valid(outputs, item):
+        return list(formats)
+    return [output_format for output_format in formats if output_format not in outputs[item]['formats']]
+
+
+def add_outputs(outputs, item, formats, paths):
+    """
+    Record the formats and paths written for an item, keeping the formats previously written for it.
+
+    :param outputs: Dictionary mapping completed items to the formats and paths written for them.
+    :type outputs: dict
+    :param item: Name of the item.
+    :type item: str
+    :param formats: Formats written.
+    :type formats: list[str]
+    :param paths: Paths written.
+    :type paths: list[str]
+    """
+    if is_item_valid(outputs, item):
+        formats = sorted(set(outputs[item]['formats']) | set(formats))
+        paths = sorted(set(outputs[item]['paths']) | set(paths))
+    outputs[item] = {'formats': sorted(formats), 'paths': sorted(paths)}
+
+
+def get_output_dir(dataset, outdir):
+    """
+    Get the directory in which the results of a dataset are saved, named after the .d directory.
+
+    :param dataset: Path to the .d directory.
+    :type dataset: str
+    :param outdir: Directory in which the results of each dataset are saved.
+    :type outdir: str
+    :return: Path to the output directory of the dataset.
+    :rtype: str
+    """
+    return os.path.join(outdir, os.path.splitext(os.path.basename(dataset.rstrip('/\\')))[0])
+
+
+def get_duplicate_datasets(datasets, outdir):
+    """
+    Find datasets that would be saved to the same output directory because their .d directories have the same name.
+
+    :param datasets: List of paths to .d directories.
+    :type datasets: list[str]
+    :param outdir: Directory in which the results of each dataset are saved.
+    :type outdir: str
+    :return: List of lists of datasets sharing an output directory.
+    :rtype: list[list[str]]
+    """
+    output_dirs = {}
+    for dataset in datasets:
+        output_dir = os.path.normcase(os.path.abspath(get_output_dir(dataset, outdir)))
+        output_dirs.setdefault(output_dir, []).append(dataset)
+    return [paths for paths in output_dirs.values() if len(paths) > 1]
+
+
+def export_dataset(dataset, args, targets):
+    """
+    Export the average spectrum, TIC image, ion images, and spectra of a dataset. Formats of each item recorded in the
+    manifest of a previous export are skipped unless overwrite is set, so only newly requested formats are written.
+
+    :param dataset: Path to the .d directory.
+    :type dataset: str
+    :param args: Arguments from get_args().
+    :type args: dict
+    :param targets: List of (m/z, m/z tolerance, m/z tolerance unit) tuples.
+    :type targets: list[tuple]
+    :return: Tuple of the dataset path and a summary message.
+    :rtype: tuple[str]
+    """
+    dataset = dataset.rstrip('/\\')
+    if not dataset.endswith('.d') or schema_detection(dataset) != 'TSF':
+        raise ValueError(f'{dataset} is not a Bruker *.d directory containing TSF data.')
+    outdir = get_output_dir(dataset, args['outdir'])
+    os.makedirs(outdir, exist_ok=True)
+    fingerprint = get_dataset_fingerprint(dataset)
+    outputs = {} if args['overwrite'] else load_manifest(outdir, fingerprint)
+    data = TsfData(dataset, init_tdf_sdk_api())
+    n_exported = 0
+
+    mz_bins = get_mz_bins(data, args['mz_bin_width'], args['mz_bin_unit'])
+    # Sampled and binned averages are exported separately so that they do not replace the full profile average.
+    average_name = 'average_spectrum'
+    if args['average_sampling_fraction'] < 1:
+        average_name += f'_sampled{args["average_sampling_fraction"]:g}'
+    if mz_bins is not None:
+        average_name += mz_bins.get_suffix()
+    spectrum_formats = get_missing_formats(outputs, average_name,
+                                           [output_format for output_format in args['formats']
+                                            if output_format in BATCH_SPECTRUM_FORMATS])
+    if args['average_sampling_fraction'] > 0 and spectrum_formats:
+        frame_ids = data.analysis['Frames']['Id'].values
+        if args['average_sampling_fraction'] < 1:
+            frame_ids = frame_ids[::int(frame_ids.size / (frame_ids.size * args['average_sampling_fraction']))]
+        mz_array, intensity_array = resume_average_spectrum(data, frame_ids, workers=args['workers'],
+                                                            chunk_size=args['chunk_size'], mz_bins=mz_bins)
+        add_outputs(outputs, average_name, spectrum_formats,
+                    write_spectrum(os.path.join(outdir, average_name), mz_array, intensity_array, spectrum_formats))
+        save_manifest(outdir, dataset, fingerprint, outputs)
+        n_exported += 1
+
+    tic_formats = get_missing_formats(outputs, 'tic_image', args['formats'])
+    if not args['no_tic'] and tic_formats:
+        tic_image = get_tic_image_array(data, workers=args['workers'], chunk_size=args['chunk_size'])
+        add_outputs(outputs, 'tic_image', tic_formats,
+                    write_image(os.path.join(outdir, 'tic_image'), tic_image, tic_formats, args['png_scale']))
+        save_manifest(outdir, dataset, fingerprint, outputs)
+        n_exported += 1
+
+    pending_targets = []
+    for target in targets:
+        target_formats = get_missing_formats(outputs, get_ion_image_name(*target), args['formats'])
+        if target_formats:
+            pending_targets.append((target, target_formats))
+    if pending_targets:
+        # Every pending ion image is calculated in a single pass over the frames.
+        ion_images = get_ion_images_array(data, [target for target, target_formats in pending_targets],
+                                          workers=args['workers'], chunk_size=args['chunk_size'])
+        for (target, target_formats), ion_image in zip(pending_targets, ion_images):
+            name = get_ion_image_name(*target)
+            add_outputs(outputs, name, target_formats,
+                        write_image(os.path.join(outdir, name), ion_image, target_formats, args['png_scale']))
+        save_manifest(outdir, dataset, fingerprint, outputs)
+        n_exported += len(pending_targets)
+
+    spectra_name = 'spectra' if mz_bins is None else f'spectra{mz_bins.get_suffix()}'
+    export_formats = get_missing_formats(outputs, spectra_name, args['export'])
+    if export_formats:
+        # Every pending format is written in a single pass over the frames. Interrupted exports are resumed.
+        paths = export_spectra(data, os.path.join(outdir, spectra_name), export_formats, mz_bins=mz_bins,
+                               workers=args['workers'], chunk_size=args['export_chunk_size'])
+        add_outputs(outputs, spectra_name, export_formats,
+                    [path for export_paths in paths.values() for path in export_paths])
+        save_manifest(outdir, dataset, fingerprint, outputs)
+        n_exported += 1
+
+    save_manifest(outdir, dataset, fingerprint, outputs)
+    return dataset, f'{n_exported} item(s) exported to {outdir}'
+
+
+def main(args=None):
+    """
+    Export results from every dataset passed on the command line.
+
+    :param args: List of command line arguments. Defaults to sys.argv.
+    :type args: list[str] | None
+    :return: Exit code. 1 if any dataset failed.
+    :rtype: int
+    """
+    args = get_args(args)
+    targets = [(mz, args['mz_tolerance'], args['mz_tolerance_unit']) for mz in args['mz']]
+    if args['targets']:
+        with open(args['targets'], 'r') as targets_file:
+            targets += parse_mz_targets(targets_file.read(), args['mz_tolerance'], args['mz_tolerance_unit'])
+    # A dataset passed more than once is only exported once.
+    datasets = {}
+    for dataset in args['input']:
+        datasets.setdefault(os.path.normcase(os.path.abspath(dataset.rstrip('/\\'))), dataset)
+    datasets = list(datasets.values())
+    duplicate_datasets = get_duplicate_datasets(datasets, args['outdir'])
+    if duplicate_datasets:
+        for duplicates in duplicate_datasets:
+            print(f'{", ".join(duplicates)}: failed: datasets with the same name would be saved to the same output '
+                  f'directory. Export them with separate --outdir directories.', file=sys.stderr)
+        return 1
+    os.makedirs(args['outdir'], exist_ok=True)
+
+    exit_code = 0
+    if args['processes'] <= 1:
+        results = []
+        for dataset in datasets:
+            try:
+                results.append(export_dataset(dataset, args, targets))
+            except Exception as error:
+                results.append((dataset, error))
+    else:
+        with ProcessPoolExecutor(max_workers=args['processes']) as executor:
+            futures = [executor.submit(export_dataset, dataset, args, targets) for dataset in datasets]
+            results = []
+            for dataset, future in zip(datasets, futures):
+                try:
+                    results.append(future.result())
+                except Exception as error:
+                    results.append((dataset, error))
+    for dataset, result in results:
+        if isinstance(result, Exception):
+            print(f'{dataset}: failed: {result}', file=sys.stderr)
+            exit_code = 1
+        else:
+            print(f'{dataset}: {result}')
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
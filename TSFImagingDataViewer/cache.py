@@ -0,0 +1,490 @@
+import os
+import uuid
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from TSFImagingDataViewer.metrics import METRICS
+from TSFImagingDataViewer.util import get_dataset_fingerprint, read_spectrum
+
+RESULT_CACHE_DIRNAME = 'TSFImagingDataViewer_cache'
+RESULT_CACHE_VERSION = 1
+RESULT_CACHE_MAX_BYTES = 2 * 1024 ** 3
+ENTRY_METADATA_FILENAME = 'entry.json'
+SPECTRUM_CACHE_MAX_BYTES = 512 * 1024 ** 2
+FIGURE_DATA_STORE_MAX_BYTES = 256 * 1024 ** 2
+FIGURE_DATA_STORE_SPILL_MAX_BYTES = 1024 ** 3
+IMAGE_PYRAMID_STORE_MAX_BYTES = 512 * 1024 ** 2
+
+
+class ResultCache(object):
+    """
+    On-disk cache for derived products of a dataset (average spectra, TIC images, ion images, etc.). Each entry is keyed
+    by the dataset fingerprint, the name of the result, and the parameters used to compute it. Arrays are stored as
+    individual .npy files that are memory-mapped on load. Least recently used entries are evicted once the total size
+    of the cache exceeds max_bytes.
+
+    :param bruker_dot_d_file: Path to the .d directory of interest.
+    :type bruker_dot_d_file: str
+    :param cache_dir: Directory used to store the cache. Defaults to a subdirectory within the .d directory.
+    :type cache_dir: str | None
+    :param max_bytes: Maximum total size of the cache in bytes.
+    :type max_bytes: int
+    """
+    def __init__(self, bruker_dot_d_file, cache_dir=None, max_bytes=RESULT_CACHE_MAX_BYTES):
+        self.bruker_dot_d_file = bruker_dot_d_file
+        if cache_dir is None:
+            cache_dir = os.path.join(bruker_dot_d_file, RESULT_CACHE_DIRNAME)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def get_key(self, name, params):
+        """
+        Get the key of an entry.
+
+        :param name: Name of the result (i.e. 'average_spectrum').
+        :type name: str
+        :param params: JSON serializable parameters used to compute the result.
+        :type params: dict
+        :return: Tuple of the hexadecimal key and the metadata describing the entry.
+        :rtype: tuple[str, dict]
+        """
+        metadata = {'version': RESULT_CACHE_VERSION,
+                    'fingerprint': get_dataset_fingerprint(self.bruker_dot_d_file),
+                    'name': name,
+                    'params': params}
+        key = hashlib.sha1(json.dumps(metadata, sort_keys=True).encode('utf-8')).hexdigest()
+        return key, metadata
+
+    def get(self, name, params):
+        """
+        Load a cached result.
+
+        :param name: Name of the result.
+        :type name: str
+        :param params: JSON serializable parameters used to compute the result.
+        :type params: dict
+        :return: Dictionary of memory-mapped arrays or None if the result is not cached.
+        :rtype: dict | None
+        """
+        key, metadata = self.get_key(name, params)
+        entry_dir = os.path.join(self.cache_dir, key)
+        metadata_path = os.path.join(entry_dir, ENTRY_METADATA_FILENAME)
+        if not os.path.isfile(metadata_path):
+            METRICS.inc('cache_misses_total', cache='result')
+            return None
+        METRICS.inc('cache_hits_total', cache='result')
+        with open(metadata_path, 'r') as metadata_file:
+            entry_metadata = json.load(metadata_file)
+        arrays = {}
+        for array_name in entry_metadata['arrays']:
+            arrays[array_name] = np.load(os.path.join(entry_dir, f'{array_name}.npy'), mmap_mode='r')
+        # Directory modification time is used to track when an entry was last used.
+        os.utime(entry_dir)
+        return arrays
+
+    def put(self, name, params, arrays, exact=('mz_array',)):
+        """
+        Store a result. Floating point arrays are stored as float32 unless their name is in exact. If the entry has
+        already been stored (i.e. by a concurrent call with the same key), the existing entry is kept.
+
+        :param name: Name of the result.
+        :type name: str
+        :param params: JSON serializable parameters used to compute the result.
+        :type params: dict
+        :param arrays: Dictionary of numpy arrays making up the result.
+        :type arrays: dict
+        :param exact: Names of floating point arrays that are stored with their original dtype.
+        :type exact: tuple[str]
+        """
+        key, metadata = self.get_key(name, params)
+        entry_dir = os.path.join(self.cache_dir, key)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Concurrent puts of the same entry each write to their own temporary directory.
+        tmp_entry_dir = tempfile.mkdtemp(prefix=key + '.', suffix='.tmp', dir=self.cache_dir)
+        try:
+            for array_name, array in arrays.items():
+                array = np.asarray(array)
+                if np.issubdtype(array.dtype, np.floating) and array_name not in exact:
+                    array = array.astype(np.float32)
+                np.save(os.path.join(tmp_entry_dir, f'{array_name}.npy'), array)
+            metadata['arrays'] = list(arrays.keys())
+            with open(os.path.join(tmp_entry_dir, ENTRY_METADATA_FILENAME), 'w') as metadata_file:
+                json.dump(metadata, metadata_file)
+            try:
+                os.replace(tmp_entry_dir, entry_dir)
+            except OSError:
+                # The same entry was stored by another caller, which may already have memory-mapped it.
+                if not os.path.isfile(os.path.join(entry_dir, ENTRY_METADATA_FILENAME)):
+                    raise
+        finally:
+            if os.path.isdir(tmp_entry_dir):
+                shutil.rmtree(tmp_entry_dir, ignore_errors=True)
+        self.evict()
+
+    def get_entries(self):
+        """
+        Get the size and last used time of every entry in the cache.
+
+        :return: List of tuples containing the entry directory, size in bytes, and last used time.
+        :rtype: list[tuple]
+        """
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_dir() and not entry.name.endswith('.tmp'):
+                size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+                entries.append((entry.path, size, entry.stat().st_mtime))
+        return entries
+
+    def evict(self):
+        """
+        Remove least recently used entries until the total size of the cache is at most max_bytes.
+        """
+        entries = sorted(self.get_entries(), key=lambda entry: entry[2])
+        total_bytes = sum(entry[1] for entry in entries)
+        for entry_dir, size, last_used in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_bytes -= size
+
+    def clear(self):
+        """
+        Remove every entry in the cache.
+        """
+        if os.path.isdir(self.cache_dir):
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+
+class SpectrumCache(object):
+    """
+    In-memory cache of profile spectra keyed by frame ID with a memory budget in bytes and least recently used
+    eviction. After each request, the next and previous frames and the 4-neighbours of the requested pixel can be
+    decoded ahead of time on a background thread.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param pixel_index: Pixel index of the dataset used to find neighbouring pixels.
+    :type pixel_index: TSFImagingDataViewer.util.PixelIndex
+    :param max_bytes: Maximum total size of the cached m/z and intensity arrays in bytes.
+    :type max_bytes: int
+    """
+    def __init__(self, data, pixel_index, max_bytes=SPECTRUM_CACHE_MAX_BYTES):
+        self.data = data
+        self.pixel_index = pixel_index
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+        self._spectra = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='spectrum_prefetch')
+        self._pending = {}
+
+    def _get_cached(self, frame, count_hit=False, count_miss=False):
+        with self._lock:
+            spectrum = self._spectra.get(frame)
+            # Counters are updated under the lock since the prefetch thread and server threads share the cache.
+            if spectrum is not None:
+                self._spectra.move_to_end(frame)
+                if count_hit:
+                    self.hits += 1
+            elif count_miss:
+                self.misses += 1
+            return spectrum
+
+    def _put(self, frame, spectrum):
+        n_bytes = spectrum.mz_array.nbytes + spectrum.intensity_array.nbytes
+        if n_bytes > self.max_bytes:
+            return
+        with self._lock:
+            if frame in self._spectra:
+                return
+            self._spectra[frame] = spectrum
+            self.n_bytes += n_bytes
+            while self.n_bytes > self.max_bytes:
+                evicted_frame, evicted_spectrum = self._spectra.popitem(last=False)
+                self.n_bytes -= evicted_spectrum.mz_array.nbytes + evicted_spectrum.intensity_array.nbytes
+
+    def get(self, frame):
+        """
+        Get the profile spectrum of a frame, decoding it if it is not cached.
+
+        :param frame: Frame ID.
+        :type frame: int
+        :return: Spectrum object.
+        :rtype: pyTDFSDK.classes.TsfSpectrum
+        """
+        frame = int(frame)
+        spectrum = self._get_cached(frame, count_hit=True, count_miss=True)
+        if spectrum is not None:
+            METRICS.inc('cache_hits_total', cache='spectrum')
+            return spectrum
+        METRICS.inc('cache_misses_total', cache='spectrum')
+        spectrum = read_spectrum(self.data, frame)
+        self._put(frame, spectrum)
+        return spectrum
+
+    def put(self, frame, spectrum):
+        """
+        Add a spectrum decoded elsewhere (i.e. in a worker process) to the cache.
+
+        :param frame: Frame ID.
+        :type frame: int
+        :param spectrum: Object with mz_array and intensity_array attributes.
+        :type spectrum: pyTDFSDK.classes.TsfSpectrum | TSFImagingDataViewer.util.DecodedSpectrum
+        """
+        self._put(int(frame), spectrum)
+
+    def get_cached(self, frame):
+        """
+        Get the profile spectrum of a frame only if it is already cached, without decoding it.
+
+        :param frame: Frame ID.
+        :type frame: int
+        :return: Spectrum object or None if the frame is not cached.
+        :rtype: pyTDFSDK.classes.TsfSpectrum | None
+        """
+        spectrum = self._get_cached(int(frame), count_hit=True)
+        if spectrum is not None:
+            METRICS.inc('cache_hits_total', cache='spectrum')
+        return spectrum
+
+    def _prefetch(self, frame):
+        if self._get_cached(frame) is None:
+            self._put(frame, read_spectrum(self.data, frame))
+            self.prefetched += 1
+
+    def get_neighbors(self, frame):
+        """
+        Get the frame IDs of the next and previous frames and of the 4-neighbours of the pixel of a frame.
+
+        :param frame: Frame ID.
+        :type frame: int
+        :return: List of neighbouring frame IDs.
+        :rtype: list[int]
+        """
+        neighbors = [i for i in [frame + 1, frame - 1] if self.pixel_index.get_coords(i) is not None]
+        coords = self.pixel_index.get_coords(frame)
+        if coords is not None:
+            x_coord, y_coord = coords
+            for dx, dy in [(1, 0), (-1, 0), (0, 1), (0, -1)]:
+                neighbor = self.pixel_index.get_frame(x_coord + dx, y_coord + dy)
+                if neighbor is not None and neighbor not in neighbors:
+                    neighbors.append(neighbor)
+        return neighbors
+
+    def prefetch_neighbors(self, frame):
+        """
+        Decode the neighbours of a frame on a background thread. Prefetches queued for previously requested frames
+        that have not started yet are cancelled.
+
+        :param frame: Frame ID.
+        :type frame: int
+        """
+        neighbors = self.get_neighbors(int(frame))
+        for pending_frame, future in list(self._pending.items()):
+            if pending_frame not in neighbors:
+                future.cancel()
+        self._pending = {pending_frame: future for pending_frame, future in self._pending.items()
+                         if not future.done()}
+        for neighbor in neighbors:
+            if neighbor not in self._pending and self._get_cached(neighbor) is None:
+                self._pending[neighbor] = self._executor.submit(self._prefetch, neighbor)
+
+    def get_stats(self):
+        """
+        Get the hit/miss counters and current size of the cache.
+
+        :return: Dictionary of cache statistics.
+        :rtype: dict
+        """
+        with self._lock:
+            n_spectra = len(self._spectra)
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'prefetched': self.prefetched,
+                'n_spectra': n_spectra,
+                'n_bytes': self.n_bytes,
+                'max_bytes': self.max_bytes}
+
+    def close(self):
+        """
+        Cancel pending prefetches and stop the background thread.
+        """
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            self._spectra.clear()
+            self.n_bytes = 0
+
+
+class FigureDataStore(object):
+    """
+    Serverside store of the m/z and intensity arrays behind displayed spectrum figures, used to resample a figure when
+    it is zoomed or panned. Entries are kept in memory up to max_bytes with least recently used eviction. If spill_dir
+    is provided, evicted entries are written to disk instead of being discarded, up to spill_max_bytes.
+
+    :param max_bytes: Maximum total size of the arrays kept in memory in bytes.
+    :type max_bytes: int
+    :param spill_dir: Optional directory used to spill entries evicted from memory.
+    :type spill_dir: str | None
+    :param spill_max_bytes: Maximum total size of the spilled entries in bytes.
+    :type spill_max_bytes: int
+    """
+    def __init__(self, max_bytes=FIGURE_DATA_STORE_MAX_BYTES, spill_dir=None,
+                 spill_max_bytes=FIGURE_DATA_STORE_SPILL_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        self.n_bytes = 0
+        self.n_spill_bytes = 0
+        self._entries = OrderedDict()
+        self._spilled = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_spill_path(self, key):
+        return os.path.join(self.spill_dir, f'{key}.npz')
+
+    def _spill(self, key, arrays):
+        if self.spill_dir is None:
+            return
+        os.makedirs(self.spill_dir, exist_ok=True)
+        spill_path = self._get_spill_path(key)
+        tmp_spill_path = spill_path + '.tmp'
+        with open(tmp_spill_path, 'wb') as spill_file:
+            np.savez(spill_file, mz_array=arrays[0], intensity_array=arrays[1])
+        os.replace(tmp_spill_path, spill_path)
+        self._spilled[key] = os.path.getsize(spill_path)
+        self.n_spill_bytes += self._spilled[key]
+        while self.n_spill_bytes > self.spill_max_bytes:
+            evicted_key, size = self._spilled.popitem(last=False)
+            self._remove_spilled(evicted_key, size)
+
+    def _remove_spilled(self, key, size):
+        self.n_spill_bytes -= size
+        spill_path = self._get_spill_path(key)
+        if os.path.isfile(spill_path):
+            os.remove(spill_path)
+
+    def _put(self, key, arrays):
+        self._entries[key] = arrays
+        self.n_bytes += arrays[0].nbytes + arrays[1].nbytes
+        while self.n_bytes > self.max_bytes and len(self._entries) > 1:
+            evicted_key, evicted_arrays = self._entries.popitem(last=False)
+            self.n_bytes -= evicted_arrays[0].nbytes + evicted_arrays[1].nbytes
+            self._spill(evicted_key, evicted_arrays)
+
+    def put(self, mz_array, intensity_array):
+        """
+        Store the arrays behind a spectrum figure. The arrays are stored by reference and must not be modified
+        afterwards.
+
+        :param mz_array: Array containing m/z values.
+        :type mz_array: numpy.array
+        :param intensity_array: Array containing intensity values.
+        :type intensity_array: numpy.array
+        :return: Key used to retrieve the arrays.
+        :rtype: str
+        """
+        key = uuid.uuid4().hex
+        with self._lock:
+            self._put(key, (np.asarray(mz_array), np.asarray(intensity_array)))
+        return key
+
+    def get(self, key):
+        """
+        Get the arrays stored under a key. Spilled entries are loaded back into memory.
+
+        :param key: Key returned by put().
+        :type key: str
+        :return: Tuple of the m/z and intensity arrays or None if the entry has been evicted.
+        :rtype: tuple[numpy.array] | None
+        """
+        with self._lock:
+            arrays = self._entries.get(key)
+            if arrays is not None:
+                self._entries.move_to_end(key)
+                METRICS.inc('cache_hits_total', cache='figure_data')
+                return arrays
+            size = self._spilled.pop(key, None)
+            if size is None:
+                METRICS.inc('cache_misses_total', cache='figure_data')
+                return None
+            METRICS.inc('cache_hits_total', cache='figure_data_spill')
+            with np.load(self._get_spill_path(key)) as spilled_arrays:
+                arrays = (spilled_arrays['mz_array'], spilled_arrays['intensity_array'])
+            self._remove_spilled(key, size)
+            self._put(key, arrays)
+            return arrays
+
+    def clear(self):
+        """
+        Remove every entry from memory and disk.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.n_bytes = 0
+            for key, size in list(self._spilled.items()):
+                self._remove_spilled(key, size)
+            self._spilled.clear()
+
+
+class ImagePyramidStore(object):
+    """
+    Serverside store of the image pyramids behind displayed ion images and the functions used to plot them, used to
+    send only the visible tiles when an ion image is zoomed or panned. Entries are kept in memory up to max_bytes with
+    least recently used eviction; evicted ion images can be reloaded from the result cache by recalculating them.
+
+    :param max_bytes: Maximum total size of the pyramids in bytes.
+    :type max_bytes: int
+    """
+    def __init__(self, max_bytes=IMAGE_PYRAMID_STORE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, pyramid, get_figure):
+        """
+        Store an image pyramid.
+
+        :param pyramid: Image pyramid.
+        :type pyramid: TSFImagingDataViewer.util.ImagePyramid
+        :param get_figure: Function called with the return values of pyramid.get_view() to plot a view.
+        :type get_figure: function
+        :return: Key used to retrieve the pyramid.
+        :rtype: str
+        """
+        key = uuid.uuid4().hex
+        with self._lock:
+            self._entries[key] = (pyramid, get_figure)
+            self.n_bytes += pyramid.nbytes
+            while self.n_bytes > self.max_bytes and len(self._entries) > 1:
+                evicted_key, (evicted_pyramid, evicted_get_figure) = self._entries.popitem(last=False)
+                self.n_bytes -= evicted_pyramid.nbytes
+        return key
+
+    def get(self, key):
+        """
+        Get the image pyramid stored under a key.
+
+        :param key: Key returned by put().
+        :type key: str
+        :return: Tuple of the image pyramid and the function used to plot it, or None if the entry has been evicted.
+        :rtype: tuple | None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                METRICS.inc('cache_misses_total', cache='image_pyramid')
+                return None
+            self._entries.move_to_end(key)
+            METRICS.inc('cache_hits_total', cache='image_pyramid')
+            return entry
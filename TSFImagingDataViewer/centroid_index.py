@@ -0,0 +1,325 @@
+import os
+import json
+import shutil
+import tempfile
+import threading
+import numpy as np
+from TSFImagingDataViewer.metrics import timed
+from TSFImagingDataViewer.parallel import iter_frame_chunks, DEFAULT_CHUNK_SIZE
+from TSFImagingDataViewer.util import (get_dataset_fingerprint, get_dataset_metadata, get_pixel_index, get_tmp_path,
+                                       read_spectrum)
+
+CENTROID_INDEX_DIRNAME = 'centroid_index'
+CENTROID_INDEX_METADATA_FILENAME = 'centroid_index.json'
+CENTROID_INDEX_ARRAYS = ['frame_ptr', 'mz_array', 'intensity_array', 'sorted_mz_array', 'sorted_intensity_array',
+                         'sorted_positions', 'bucket_ptr']
+CENTROID_INDEX_BUILD_PREFIX = 'build.'
+DEFAULT_BUCKET_WIDTH = 1.0
+CENTROID_INDEX_LOCKS = {}
+CENTROID_INDEX_LOCKS_LOCK = threading.Lock()
+
+
+class CentroidIndex(object):
+    """
+    Sparse peak list of every frame in a TSF dataset stored in CSR format (frame pointer, m/z, intensity) along with a
+    copy of every peak sorted by m/z and bucketed into fixed width m/z buckets so that the peaks within any m/z range
+    can be found without touching the rest of the data.
+
+    :param arrays: Dictionary of numpy arrays named in CENTROID_INDEX_ARRAYS.
+    :type arrays: dict
+    :param mz_min: Lower m/z of the first bucket.
+    :type mz_min: float
+    :param bucket_width: Width of each m/z bucket in Daltons.
+    :type bucket_width: float
+    """
+    def __init__(self, arrays, mz_min, bucket_width):
+        self.frame_ptr = arrays['frame_ptr']
+        self.mz_array = arrays['mz_array']
+        self.intensity_array = arrays['intensity_array']
+        self.sorted_mz_array = arrays['sorted_mz_array']
+        self.sorted_intensity_array = arrays['sorted_intensity_array']
+        self.sorted_positions = arrays['sorted_positions']
+        self.bucket_ptr = arrays['bucket_ptr']
+        self.mz_min = mz_min
+        self.bucket_width = bucket_width
+        self.n_frames = self.frame_ptr.size - 1
+
+    def get_peaks(self, position):
+        """
+        Get the peak list of a frame.
+
+        :param position: Position of the frame in the Frames table.
+        :type position: int
+        :return: Tuple of the m/z and intensity arrays of the peaks of the frame.
+        :rtype: tuple[numpy.array]
+        """
+        start = self.frame_ptr[position]
+        stop = self.frame_ptr[position + 1]
+        return self.mz_array[start:stop], self.intensity_array[start:stop]
+
+    def sum_mass_range(self, lower_mass_range, upper_mass_range):
+        """
+        Sum the intensities of the peaks of every frame between the lower and upper mass ranges (inclusive). Only the
+        buckets overlapping the mass range are searched.
+
+        :param lower_mass_range: Mass in Daltons to use for the lower mass range.
+        :type lower_mass_range: float
+        :param upper_mass_range: Mass in Daltons to use for the upper mass range.
+        :type upper_mass_range: float
+        :return: Numpy array containing the summed intensity of each frame in the order of the Frames table.
+        :rtype: numpy.array
+        """
+        n_buckets = self.bucket_ptr.size - 1
+        first_bucket = min(max(int((lower_mass_range - self.mz_min) // self.bucket_width), 0), n_buckets)
+        last_bucket = min(max(int((upper_mass_range - self.mz_min) // self.bucket_width), 0), n_buckets - 1)
+        bucket_start = int(self.bucket_ptr[first_bucket])
+        bucket_stop = int(self.bucket_ptr[last_bucket + 1])
+        bucket_mz_array = self.sorted_mz_array[bucket_start:bucket_stop]
+        start = bucket_start + int(np.searchsorted(bucket_mz_array, lower_mass_range, side='left'))
+        stop = bucket_start + int(np.searchsorted(bucket_mz_array, upper_mass_range, side='right'))
+        return np.bincount(self.sorted_positions[start:stop],
+                           weights=self.sorted_intensity_array[start:stop],
+                           minlength=self.n_frames)
+
+
+def pick_peaks(mz_array, intensity_array):
+    """
+    Pick peaks from a profile spectrum as the local maxima with non-zero intensity.
+
+    :param mz_array: Numpy array containing m/z values.
+    :type mz_array: numpy.array
+    :param intensity_array: Numpy array containing intensity values.
+    :type intensity_array: numpy.array
+    :return: Tuple of the m/z and intensity arrays of the peaks.
+    :rtype: tuple[numpy.array]
+    """
+    if intensity_array.size < 3:
+        indices = np.nonzero(intensity_array > 0)[0]
+    else:
+        indices = np.nonzero((intensity_array[1:-1] > intensity_array[:-2]) &
+                             (intensity_array[1:-1] >= intensity_array[2:]) &
+                             (intensity_array[1:-1] > 0))[0] + 1
+    return mz_array[indices], intensity_array[indices]
+
+
+def get_peak_lists(data, frame_ids, mode='centroid'):
+    """
+    Get the concatenated peak lists of a list of frames. Used as the per chunk reducer for build_centroid_index().
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param frame_ids: List of frame IDs.
+    :type frame_ids: list[int]
+    :param mode: 'centroid' to use the centroided spectra from the SDK or 'profile' to pick local maxima from the
+        profile spectra.
+    :type mode: str
+    :return: Tuple of the number of peaks of each frame and the concatenated m/z and intensity arrays.
+    :rtype: tuple[numpy.array]
+    """
+    n_peaks = np.zeros(len(frame_ids), dtype=np.int64)
+    mz_arrays = []
+    intensity_arrays = []
+    for row, i in enumerate(frame_ids):
+        if mode == 'profile':
+            spectrum = read_spectrum(data, i, mode='profile')
+            mz_array, intensity_array = pick_peaks(spectrum.mz_array, spectrum.intensity_array)
+        else:
+            spectrum = read_spectrum(data, i, mode='centroid')
+            mz_array = spectrum.mz_array
+            intensity_array = spectrum.intensity_array
+        n_peaks[row] = mz_array.size
+        mz_arrays.append(np.asarray(mz_array, dtype=np.float64))
+        intensity_arrays.append(np.asarray(intensity_array, dtype=np.float32))
+    return (n_peaks,
+            np.concatenate(mz_arrays) if mz_arrays else np.array([], dtype=np.float64),
+            np.concatenate(intensity_arrays) if intensity_arrays else np.array([], dtype=np.float32))
+
+
+def get_centroid_index_paths(bruker_dot_d_file):
+    """
+    Get the paths to the directory and metadata file used to store the centroid index within a Bruker .d directory.
+    Each build of the index is stored in its own subdirectory, and the metadata file names the current build.
+
+    :param bruker_dot_d_file: Path to the .d directory of interest.
+    :type bruker_dot_d_file: str
+    :return: Tuple of paths to the index directory and metadata file.
+    :rtype: tuple[str]
+    """
+    index_dir = os.path.join(bruker_dot_d_file, CENTROID_INDEX_DIRNAME)
+    return index_dir, os.path.join(index_dir, CENTROID_INDEX_METADATA_FILENAME)
+
+
+def get_centroid_index_lock(index_dir):
+    """
+    Get the lock used to serialize builds of a centroid index.
+
+    :param index_dir: Path to the centroid index directory.
+    :type index_dir: str
+    :return: Lock of the centroid index.
+    :rtype: threading.Lock
+    """
+    index_dir = os.path.normpath(os.path.abspath(index_dir))
+    with CENTROID_INDEX_LOCKS_LOCK:
+        lock = CENTROID_INDEX_LOCKS.get(index_dir)
+        if lock is None:
+            lock = CENTROID_INDEX_LOCKS[index_dir] = threading.Lock()
+        return lock
+
+
+def load_centroid_index(data, mode='centroid', bucket_width=DEFAULT_BUCKET_WIDTH):
+    """
+    Load a previously built centroid index for a TSF dataset if it exists, was built with the same parameters, and is
+    not stale.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param mode: Peak picking mode used to build the index.
+    :type mode: str
+    :param bucket_width: Width of each m/z bucket in Daltons.
+    :type bucket_width: float
+    :return: Memory-mapped centroid index or None if no valid index is found.
+    :rtype: TSFImagingDataViewer.centroid_index.CentroidIndex | None
+    """
+    index_dir, metadata_path = get_centroid_index_paths(data.source_file)
+    if not os.path.isfile(metadata_path):
+        return None
+    with open(metadata_path, 'r') as metadata_file:
+        metadata = json.load(metadata_file)
+    if metadata.get('fingerprint') != get_dataset_fingerprint(data.source_file) or \
+            metadata.get('mode') != mode or metadata.get('bucket_width') != bucket_width:
+        return None
+    # Indices written before builds were stored in subdirectories do not name a build and are rebuilt.
+    build_dir = os.path.join(index_dir, metadata.get('build', ''))
+    if 'build' not in metadata or not os.path.isdir(build_dir):
+        return None
+    arrays = {name: np.load(os.path.join(build_dir, f'{name}.npy'), mmap_mode='r') for name in CENTROID_INDEX_ARRAYS}
+    return CentroidIndex(arrays, metadata['mz_min'], metadata['bucket_width'])
+
+
+@timed()
+def build_centroid_index(data, mode='centroid', bucket_width=DEFAULT_BUCKET_WIDTH, workers=1,
+                         chunk_size=DEFAULT_CHUNK_SIZE, progress_callback=None):
+    """
+    Build the centroid index for a TSF dataset and store it within the .d directory. The arrays are written to a new,
+    uniquely named build directory and the metadata file is then replaced atomically to point to it, so an index that
+    is memory-mapped elsewhere is never modified or removed. Use get_centroid_index() to serialize concurrent builds
+    of the same index.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param mode: 'centroid' to use the centroided spectra from the SDK or 'profile' to pick local maxima from the
+        profile spectra.
+    :type mode: str
+    :param bucket_width: Width of each m/z bucket in Daltons.
+    :type bucket_width: float
+    :param workers: Number of worker processes used to read frames.
+    :type workers: int
+    :param chunk_size: Number of frames processed per chunk.
+    :type chunk_size: int
+    :param progress_callback: Optional function called with the number of frames processed so far and the total
+        number of frames after each chunk. May raise an exception to stop the build.
+    :type progress_callback: function | None
+    :return: Memory-mapped centroid index.
+    :rtype: TSFImagingDataViewer.centroid_index.CentroidIndex
+    """
+    index_dir, metadata_path = get_centroid_index_paths(data.source_file)
+    fingerprint = get_dataset_fingerprint(data.source_file)
+    frame_ids = get_pixel_index(data).frame_ids
+    peak_lists = []
+    n_processed = 0
+    for peak_list in iter_frame_chunks(data, frame_ids, get_peak_lists, (mode,), workers=workers,
+                                       chunk_size=chunk_size):
+        peak_lists.append(peak_list)
+        n_processed += peak_list[0].size
+        if progress_callback is not None:
+            progress_callback(n_processed, frame_ids.size)
+    n_peaks = np.concatenate([peak_list[0] for peak_list in peak_lists])
+    mz_array = np.concatenate([peak_list[1] for peak_list in peak_lists])
+    intensity_array = np.concatenate([peak_list[2] for peak_list in peak_lists])
+    del peak_lists
+    frame_ptr = np.zeros(n_peaks.size + 1, dtype=np.int64)
+    np.cumsum(n_peaks, out=frame_ptr[1:])
+
+    order = np.argsort(mz_array, kind='stable')
+    positions = np.repeat(np.arange(n_peaks.size, dtype=np.int32), n_peaks)
+    metadata = get_dataset_metadata(data)
+    mz_min = metadata.mz_acq_range_lower
+    mz_max = metadata.mz_acq_range_upper
+    if mz_array.size > 0:
+        mz_min = min(mz_min, float(mz_array[order[0]]))
+        mz_max = max(mz_max, float(mz_array[order[-1]]))
+    n_buckets = int((mz_max - mz_min) // bucket_width) + 1
+    sorted_mz_array = mz_array[order]
+    arrays = {'frame_ptr': frame_ptr,
+              'mz_array': mz_array,
+              'intensity_array': intensity_array,
+              'sorted_mz_array': sorted_mz_array,
+              'sorted_intensity_array': intensity_array[order],
+              'sorted_positions': positions[order],
+              'bucket_ptr': np.searchsorted(sorted_mz_array,
+                                            mz_min + np.arange(n_buckets + 1) * bucket_width,
+                                            side='left').astype(np.int64)}
+    # Peaks at the upper edge of the last bucket belong to the last bucket.
+    arrays['bucket_ptr'][-1] = sorted_mz_array.size
+
+    os.makedirs(index_dir, exist_ok=True)
+    build_dir = tempfile.mkdtemp(prefix=CENTROID_INDEX_BUILD_PREFIX, dir=index_dir)
+    tmp_metadata_path = None
+    try:
+        for name in CENTROID_INDEX_ARRAYS:
+            np.save(os.path.join(build_dir, f'{name}.npy'), arrays[name])
+        # Metadata is written last so that an interrupted build is never mistaken for a valid index. Previous builds
+        # are left in place since they may still be memory-mapped.
+        tmp_metadata_path = get_tmp_path(metadata_path)
+        with open(tmp_metadata_path, 'w') as metadata_file:
+            json.dump({'fingerprint': fingerprint,
+                       'mode': mode,
+                       'bucket_width': bucket_width,
+                       'mz_min': mz_min,
+                       'n_frames': int(n_peaks.size),
+                       'n_peaks': int(mz_array.size),
+                       'build': os.path.basename(build_dir)},
+                      metadata_file)
+        os.replace(tmp_metadata_path, metadata_path)
+    except BaseException:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        raise
+    finally:
+        if tmp_metadata_path is not None and os.path.isfile(tmp_metadata_path):
+            os.remove(tmp_metadata_path)
+    return load_centroid_index(data, mode=mode, bucket_width=bucket_width)
+
+
+def get_centroid_index(data, mode='centroid', bucket_width=DEFAULT_BUCKET_WIDTH, workers=1,
+                       chunk_size=DEFAULT_CHUNK_SIZE, progress_callback=None):
+    """
+    Get the centroid index for a TSF dataset, building it if it does not exist yet or if the raw data has changed.
+    Builds of the same index are serialized, so concurrent callers wait for a single build and then load its result.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param mode: 'centroid' to use the centroided spectra from the SDK or 'profile' to pick local maxima from the
+        profile spectra.
+    :type mode: str
+    :param bucket_width: Width of each m/z bucket in Daltons.
+    :type bucket_width: float
+    :param workers: Number of worker processes used to read frames.
+    :type workers: int
+    :param chunk_size: Number of frames processed per chunk.
+    :type chunk_size: int
+    :param progress_callback: Optional function called with the number of frames processed so far and the total
+        number of frames after each chunk. May raise an exception to stop the build.
+    :type progress_callback: function | None
+    :return: Memory-mapped centroid index.
+    :rtype: TSFImagingDataViewer.centroid_index.CentroidIndex
+    """
+    centroid_index = load_centroid_index(data, mode=mode, bucket_width=bucket_width)
+    if centroid_index is not None:
+        return centroid_index
+    with get_centroid_index_lock(get_centroid_index_paths(data.source_file)[0]):
+        # Another caller may have built the index while waiting for the lock.
+        centroid_index = load_centroid_index(data, mode=mode, bucket_width=bucket_width)
+        if centroid_index is None:
+            centroid_index = build_centroid_index(data, mode=mode, bucket_width=bucket_width, workers=workers,
+                                                  chunk_size=chunk_size, progress_callback=progress_callback)
+    return centroid_index
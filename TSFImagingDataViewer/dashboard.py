@@ -5,311 +5,1015 @@
 
 
 import os
-import copy
+import uuid
+import hashlib
 import numpy as np
 import pandas as pd
-from dash import State, callback_context, no_update
+from dash import State, Patch, callback_context, no_update
 import dash_bootstrap_components as dbc
-from dash_extensions.enrich import (Input, Output, DashProxy, MultiplexerTransform, Serverside,
-                                    ServersideOutputTransform, FileSystemBackend)
+from dash_extensions.enrich import Input, Output, DashProxy, DashBlueprint, MultiplexerTransform
 import plotly.express as px
-from plotly_resampler import FigureResampler
 import tempfile
+import threading
 import tkinter
 from tkinter.filedialog import askdirectory
-from pyTDFSDK.classes import TsfData, TsfSpectrum
-from pyTDFSDK.init_tdf_sdk import init_tdf_sdk_api
 from TSFImagingDataViewer.layout import get_dashboard_layout
-from TSFImagingDataViewer.util import (schema_detection, get_spectrum, get_spectrum_from_arrays, get_ion_image,
-                                       create_average_spectrum)
+from TSFImagingDataViewer.util import (schema_detection, list_datasets, resolve_dataset_path, get_spectrum_figure,
+                                       get_ion_image_figure, resume_average_spectrum, get_pixel_index,
+                                       blank_figure, parse_mz_targets, iter_ion_images_array,
+                                       get_multichannel_ion_image_figure, normalize_ion_images, get_relayout_ranges,
+                                       ImagePyramid, get_roi_frame_ids, create_roi_average_spectrum, get_mz_bins,
+                                       PROGRESSIVE_STRIDES, SPECTRUM_DOWNSAMPLERS, DEFAULT_SPECTRUM_DOWNSAMPLER,
+                                       DEFAULT_SPECTRUM_N_SHOWN_SAMPLES)
+from TSFImagingDataViewer.cache import FigureDataStore, ImagePyramidStore
+from TSFImagingDataViewer.centroid_index import get_centroid_index
+from TSFImagingDataViewer.datacube import get_datacube
+from TSFImagingDataViewer.jobs import JobRunner, JobCancelledError
+from TSFImagingDataViewer.metrics import timed, enable_metrics_log, register_metrics_routes
+from TSFImagingDataViewer.parallel import DEFAULT_WORKERS
+from TSFImagingDataViewer.sessions import DatasetPool, SessionRegistry, DatasetPoolFullError
 
 FILE_SYSTEM_BACKEND = tempfile.TemporaryDirectory().name
-DATA = None
-
-app = DashProxy(prevent_initial_callbacks=True,
-                transforms=[MultiplexerTransform(),
-                            ServersideOutputTransform(backends=[FileSystemBackend(cache_dir=FILE_SYSTEM_BACKEND)])],
-                external_stylesheets=[dbc.themes.SPACELAB])
-app.layout = get_dashboard_layout()
-
-
-@app.callback([Output('spectrum', 'figure'),
-               Output('store_plot', 'data'),
-               Output('ion_image', 'figure'),
-               Output('mz', 'value'),
-               Output('mz', 'min'),
-               Output('mz', 'max'),
-               Output('x_coord', 'value'),
-               Output('x_coord', 'min'),
-               Output('x_coord', 'max'),
-               Output('y_coord', 'value'),
-               Output('y_coord', 'min'),
-               Output('y_coord', 'max'),
-               Output('frame', 'value'),
-               Output('frame', 'min'),
-               Output('frame', 'max'),
-               Output('average_estimate', 'disabled'),
-               Output('average_full', 'disabled'),
-               Output('per_frame', 'disabled'),
-               Output('mz', 'disabled'),
-               Output('mz_tolerance', 'disabled'),
-               Output('mz_tolerance_unit', 'disabled'),
-               Output('update_ion_image', 'disabled'),
-               Output('x_coord', 'disabled'),
-               Output('y_coord', 'disabled'),
-               Output('frame', 'disabled'),
-               Output('dot_d_directory', 'data'),
-               Output('load_tsf_error_modal', 'is_open')],
-              Input('load_tsf', 'n_clicks'))
-def upload_data(n_clicks):
+# Each browser session loads its own dataset; sessions viewing the same dataset share its handle and caches.
+DATASET_POOL = DatasetPool()
+SESSIONS = SessionRegistry(DATASET_POOL)
+# Jobs of different sessions can run at the same time, each using DEFAULT_WORKERS processes to read frames.
+JOB_RUNNER = JobRunner(max_workers=2)
+# Tk is not thread-safe, so only one directory dialog is shown at a time when the server is threaded.
+DIALOG_LOCK = threading.Lock()
+# Directory containing the datasets that can be loaded in server mode. If None, the desktop directory dialog is used.
+DATA_DIR = None
+# Evicted spectra are spilled to disk and the directory is removed on exit.
+FIGURE_DATA_STORE = FigureDataStore(spill_dir=FILE_SYSTEM_BACKEND)
+IMAGE_PYRAMID_STORE = ImagePyramidStore()
+# plotly-resampler downsampler (a name in SPECTRUM_DOWNSAMPLERS) and maximum number of data points sent to the browser
+# for each view of a spectrum.
+SPECTRUM_DOWNSAMPLER = os.environ.get('TSFIMAGINGDATAVIEWER_SPECTRUM_DOWNSAMPLER', DEFAULT_SPECTRUM_DOWNSAMPLER)
+SPECTRUM_N_SHOWN_SAMPLES = int(os.environ.get('TSFIMAGINGDATAVIEWER_SPECTRUM_N_SHOWN_SAMPLES',
+                                              DEFAULT_SPECTRUM_N_SHOWN_SAMPLES))
+if SPECTRUM_DOWNSAMPLER not in SPECTRUM_DOWNSAMPLERS:
+    raise ValueError(f'Invalid spectrum downsampler {SPECTRUM_DOWNSAMPLER}. Choose from '
+                     f'{", ".join(SPECTRUM_DOWNSAMPLERS)}.')
+
+# Callbacks are collected on a blueprint when this module is imported; the Dash app and its Flask server are only
+# created by get_app() so that importing the dashboard does not pay for building them.
+BLUEPRINT = DashBlueprint(transforms=[MultiplexerTransform()])
+APP = None
+
+
+def serve_layout():
+    """
+    Get the dashboard layout on every page load. In server mode, the datasets in the data directory are listed.
+
+    :return: Dash dashboard layout
+    :rtype: html.Div
+    """
+    global DATA_DIR
+    return get_dashboard_layout(None if DATA_DIR is None else list_datasets(DATA_DIR))
+
+
+def get_app(data_dir=None):
+    """
+    Get the Dash app of the dashboard, creating it and registering its callbacks on first use.
+
+    :param data_dir: Directory containing the datasets that can be loaded. If set, the app runs in server mode and
+        datasets are chosen from this directory instead of a directory dialog. Only used when the app is created.
+    :type data_dir: str | None
+    :return: Dash app.
+    :rtype: dash_extensions.enrich.DashProxy
+    """
+    global APP
+    global DATA_DIR
+    if APP is None:
+        DATA_DIR = data_dir
+        app = DashProxy(prevent_initial_callbacks=True,
+                        blueprint=BLUEPRINT,
+                        external_stylesheets=[dbc.themes.SPACELAB])
+        app.layout = serve_layout
+        register_metrics_routes(app.server)
+        if os.environ.get('TSFIMAGINGDATAVIEWER_METRICS_LOG'):
+            enable_metrics_log(os.environ['TSFIMAGINGDATAVIEWER_METRICS_LOG'])
+        APP = app
+    return APP
+
+
+def __getattr__(name):
+    # Keep 'from TSFImagingDataViewer.dashboard import app' working.
+    if name == 'app':
+        return get_app()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+@timed()
+def get_average_spectrum_df(handle, sampling_fraction, mz_bin_width=0, mz_bin_unit='Da', progress_callback=None):
+    """
+    Get the average spectrum of a dataset from its result cache, calculating it if it has not been cached.
+
+    :param handle: Handle of the dataset.
+    :type handle: TSFImagingDataViewer.sessions.DatasetHandle
+    :param sampling_fraction: Fraction of frames evenly sampled across the dataset to average. Use 1.0 to average every
+        frame.
+    :type sampling_fraction: float
+    :param mz_bin_width: Width of the m/z bins used to bin each spectrum. Use 0 to average profile spectra.
+    :type mz_bin_width: float
+    :param mz_bin_unit: m/z bin width unit. Either 'Da' or 'ppm'.
+    :type mz_bin_unit: str
+    :param progress_callback: Optional function called with the number of frames processed so far and the total
+        number of frames.
+    :type progress_callback: function | None
+    :return: Spectrum dataframe containing columns 'm/z' and 'Intensity'.
+    :rtype: pandas.DataFrame
+    """
+    data = handle.data
+    result_cache = handle.result_cache
+    mz_bins = get_mz_bins(data, mz_bin_width, mz_bin_unit)
+    params = {'sampling_fraction': sampling_fraction}
+    if mz_bins is not None:
+        params['mz_bins'] = mz_bins.get_params()
+    average_spectrum = result_cache.get('average_spectrum', params)
+    if average_spectrum is None:
+        frame_ids = handle.metadata.frame_ids
+        if sampling_fraction < 1:
+            frame_ids = frame_ids[::int(frame_ids.size / (frame_ids.size * sampling_fraction))]
+        mz_array, intensity_array = resume_average_spectrum(data, frame_ids, workers=DEFAULT_WORKERS,
+                                                            progress_callback=progress_callback, mz_bins=mz_bins)
+        average_spectrum = {'mz_array': mz_array, 'intensity_array': intensity_array}
+        result_cache.put('average_spectrum', params, average_spectrum)
+    return pd.DataFrame({'m/z': np.array(average_spectrum['mz_array']),
+                         'Intensity': np.array(average_spectrum['intensity_array'])})
+
+
+@timed()
+def get_roi_average_spectrum_df(handle, frame_ids, ion_image_options, mz_bin_width=0, mz_bin_unit='Da',
+                                progress_callback=None):
+    """
+    Get the average spectrum of the frames within a region of interest from the result cache of a dataset, calculating
+    it if it has not been cached. If the datacube switch is enabled, the spectra are averaged from the datacube.
+
+    :param handle: Handle of the dataset.
+    :type handle: TSFImagingDataViewer.sessions.DatasetHandle
+    :param frame_ids: Sorted numpy array of the frame IDs within the region of interest.
+    :type frame_ids: numpy.array
+    :param ion_image_options: Values selected in the ion image options checklist.
+    :type ion_image_options: list[str]
+    :param mz_bin_width: Width of the m/z bins used to bin each spectrum. Use 0 to average profile spectra.
+    :type mz_bin_width: float
+    :param mz_bin_unit: m/z bin width unit. Either 'Da' or 'ppm'.
+    :type mz_bin_unit: str
+    :param progress_callback: Optional function called with the number of frames processed so far and the total
+        number of frames.
+    :type progress_callback: function | None
+    :return: Spectrum dataframe containing columns 'm/z' and 'Intensity'.
+    :rtype: pandas.DataFrame
+    """
+    data = handle.data
+    result_cache = handle.result_cache
+    mz_bins = get_mz_bins(data, mz_bin_width, mz_bin_unit)
+    # The centroid index only contains peak lists, so profile spectra are averaged unless the datacube is enabled.
+    source = 'datacube' if 'datacube' in ion_image_options else 'profile'
+    params = {'frame_ids': hashlib.sha1(np.ascontiguousarray(frame_ids, dtype=np.int64).tobytes()).hexdigest(),
+              'n_frames': int(frame_ids.size),
+              'source': source}
+    if mz_bins is not None:
+        params['mz_bins'] = mz_bins.get_params()
+    average_spectrum = result_cache.get('roi_average_spectrum', params)
+    if average_spectrum is None:
+        if source == 'datacube':
+            source_kwargs = {'datacube': get_datacube(data, progress_callback=progress_callback, mz_bins=mz_bins)}
+        else:
+            source_kwargs = {'spectrum_cache': handle.spectrum_cache}
+        mz_array, intensity_array = create_roi_average_spectrum(data, frame_ids, workers=DEFAULT_WORKERS,
+                                                                progress_callback=progress_callback, mz_bins=mz_bins,
+                                                                **source_kwargs)
+        average_spectrum = {'mz_array': mz_array, 'intensity_array': intensity_array}
+        result_cache.put('roi_average_spectrum', params, average_spectrum)
+    return pd.DataFrame({'m/z': np.array(average_spectrum['mz_array']),
+                         'Intensity': np.array(average_spectrum['intensity_array'])})
+
+
+@timed()
+def plot_spectrum(mz_array, intensity_array):
+    """
+    Plot a spectrum and keep its arrays in the figure data store so that the figure can be resampled later.
+
+    :param mz_array: Array containing m/z values.
+    :type mz_array: numpy.array
+    :param intensity_array: Array containing intensity values.
+    :type intensity_array: numpy.array
+    :return: Tuple of the plotly figure and the figure data store key to save in store_plot.
+    :rtype: tuple
+    """
+    global FIGURE_DATA_STORE
+    global SPECTRUM_DOWNSAMPLER
+    global SPECTRUM_N_SHOWN_SAMPLES
+    figure = get_spectrum_figure(mz_array,
+                                 intensity_array,
+                                 downsampler=SPECTRUM_DOWNSAMPLER,
+                                 n_shown_samples=SPECTRUM_N_SHOWN_SAMPLES)
+    return figure, FIGURE_DATA_STORE.put(mz_array, intensity_array)
+
+
+@timed()
+def plot_ion_images(ion_images_array, get_figure):
+    """
+    Build the image pyramid of ion images, keep it in the image pyramid store so that the figure can be updated with
+    the visible tiles when it is zoomed, and plot the whole image at the resolution that fits in the graph.
+
+    :param ion_images_array: 3D numpy array with shape (number of channels, number of rows, number of columns).
+    :type ion_images_array: numpy.array
+    :param get_figure: Function called with the return values of ImagePyramid.get_view() to plot a view.
+    :type get_figure: function
+    :return: Tuple of the plotly figure and the image pyramid store key to save in store_ion_image.
+    :rtype: tuple
+    """
+    global IMAGE_PYRAMID_STORE
+    pyramid = ImagePyramid(ion_images_array)
+    pyramid_key = IMAGE_PYRAMID_STORE.put(pyramid, get_figure)
+    fig = get_figure(*pyramid.get_view())
+    # Keeps the zoom level when the figure is updated with the visible tiles.
+    fig.update_layout(uirevision=pyramid_key)
+    return fig, pyramid_key
+
+
+def get_ion_image_source(ion_image_options):
+    """
+    Get the name of the data source used to calculate ion images based on the selected ion image options. The centroid
+    index takes precedence over the datacube.
+
+    :param ion_image_options: Values selected in the ion image options checklist.
+    :type ion_image_options: list[str]
+    :return: 'centroid_index', 'datacube', or 'profile'.
+    :rtype: str
+    """
+    if 'centroid_index' in ion_image_options:
+        return 'centroid_index'
+    elif 'datacube' in ion_image_options:
+        return 'datacube'
+    else:
+        return 'profile'
+
+
+def get_ion_image_source_kwargs(data, ion_image_options, progress_callback=None, mz_bins=None):
+    """
+    Get the datacube or centroid index of a dataset to pass to the ion image functions, building it if needed.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param ion_image_options: Values selected in the ion image options checklist.
+    :type ion_image_options: list[str]
+    :param progress_callback: Optional function called with the number of frames processed so far and the total
+        number of frames while building the datacube or centroid index.
+    :type progress_callback: function | None
+    :param mz_bins: Optional m/z bins of the datacube.
+    :type mz_bins: TSFImagingDataViewer.util.MzBins | None
+    :return: Dictionary of keyword arguments.
+    :rtype: dict
+    """
+    source = get_ion_image_source(ion_image_options)
+    if source == 'centroid_index':
+        return {'centroid_index': get_centroid_index(data, workers=DEFAULT_WORKERS,
+                                                     progress_callback=progress_callback)}
+    elif source == 'datacube':
+        return {'datacube': get_datacube(data, progress_callback=progress_callback, mz_bins=mz_bins)}
+    else:
+        return {}
+
+
+def get_ion_image_mz_bins(data, source, mz_bin_width, mz_bin_unit):
+    """
+    Get the m/z bins used to calculate ion images. Only the datacube is binned; profile spectra and the centroid index
+    are read at full resolution either way, so binning them would not make ion images faster.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param source: Ion image data source from get_ion_image_source().
+    :type source: str
+    :param mz_bin_width: Width of the m/z bins. Use 0 to disable binning.
+    :type mz_bin_width: float
+    :param mz_bin_unit: m/z bin width unit. Either 'Da' or 'ppm'.
+    :type mz_bin_unit: str
+    :return: m/z bins or None if ion images are not calculated from binned spectra.
+    :rtype: TSFImagingDataViewer.util.MzBins | None
+    """
+    if source != 'datacube':
+        return None
+    return get_mz_bins(data, mz_bin_width, mz_bin_unit)
+
+
+def get_progressive_ion_images_array(data, targets, ion_image_options, get_figure, progress_callback=None,
+                                     mz_bins=None):
+    """
+    Calculate the ion images of several m/z targets. If progressive ion images are enabled, low resolution previews
+    are passed to progress_callback as partial results before the full resolution images are done.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param targets: List of (m/z, m/z tolerance, m/z tolerance unit) tuples.
+    :type targets: list[tuple]
+    :param ion_image_options: Values selected in the ion image options checklist.
+    :type ion_image_options: list[str]
+    :param get_figure: Function used to create the preview result from the 3D ion images array.
+    :type get_figure: function
+    :param progress_callback: Optional function called with the number of frames processed so far, the total number
+        of frames, and optionally a preview result.
+    :type progress_callback: function | None
+    :param mz_bins: Optional m/z bins of the datacube.
+    :type mz_bins: TSFImagingDataViewer.util.MzBins | None
+    :return: 3D numpy array with shape (number of targets, number of rows, number of columns) containing ion images.
+    :rtype: numpy.array
+    """
+    if 'progressive' in ion_image_options:
+        strides = PROGRESSIVE_STRIDES
+    else:
+        strides = (1,)
+    n_frames = get_pixel_index(data).frame_ids.size
+    for n_processed, stride, ion_images_array in iter_ion_images_array(data,
+                                                                       targets,
+                                                                       strides=strides,
+                                                                       workers=DEFAULT_WORKERS,
+                                                                       progress_callback=progress_callback,
+                                                                       **get_ion_image_source_kwargs(
+                                                                           data,
+                                                                           ion_image_options,
+                                                                           progress_callback,
+                                                                           mz_bins)):
+        if stride > 1 and progress_callback is not None:
+            progress_callback(n_processed, n_frames, get_figure(ion_images_array))
+    return ion_images_array
+
+
+@timed()
+def get_ion_image_job_result(handle, mz, mz_tolerance, mz_tolerance_unit, ion_image_options, mz_bin_width=0,
+                             mz_bin_unit='Da', progress_callback=None):
+    """
+    Get the ion image figure of a dataset from its result cache, calculating it if it has not been cached.
+
+    :param handle: Handle of the dataset.
+    :type handle: TSFImagingDataViewer.sessions.DatasetHandle
+    :param mz: Target m/z value.
+    :type mz: float
+    :param mz_tolerance: m/z tolerance.
+    :type mz_tolerance: float
+    :param mz_tolerance_unit: m/z tolerance unit. Either 'Da' or 'ppm'.
+    :type mz_tolerance_unit: str
+    :param ion_image_options: Values selected in the ion image options checklist.
+    :type ion_image_options: list[str]
+    :param mz_bin_width: Width of the m/z bins of the datacube. Use 0 for a profile datacube.
+    :type mz_bin_width: float
+    :param mz_bin_unit: m/z bin width unit. Either 'Da' or 'ppm'.
+    :type mz_bin_unit: str
+    :param progress_callback: Optional function called with the number of frames processed so far and the total
+        number of frames.
+    :type progress_callback: function | None
+    :return: Tuple of the plotly figure containing the ion image and its image pyramid store key.
+    :rtype: tuple
+    """
+    data = handle.data
+    result_cache = handle.result_cache
+    source = get_ion_image_source(ion_image_options)
+    params = {'mz': mz, 'mz_tolerance': mz_tolerance, 'mz_tolerance_unit': mz_tolerance_unit,
+              'source': source}
+    mz_bins = get_ion_image_mz_bins(data, source, mz_bin_width, mz_bin_unit)
+    if mz_bins is not None:
+        params['mz_bins'] = mz_bins.get_params()
+
+    def plot(ion_images_array):
+        # The color scale of zoomed views spans the intensity range of the whole image.
+        range_max = float(np.max(ion_images_array, initial=0))
+        return plot_ion_images(ion_images_array,
+                               lambda view, x0, y0, scale: get_ion_image_figure(view[0], x0, y0, scale, range_max))
+
+    cached_ion_image = result_cache.get('ion_image', params)
+    if cached_ion_image is None:
+        ion_image_array = get_progressive_ion_images_array(data,
+                                                           [(mz, mz_tolerance, mz_tolerance_unit)],
+                                                           ion_image_options,
+                                                           plot,
+                                                           progress_callback,
+                                                           mz_bins)[0]
+        result_cache.put('ion_image', params, {'ion_image': ion_image_array})
+    else:
+        ion_image_array = np.array(cached_ion_image['ion_image'])
+    return plot(ion_image_array[np.newaxis])
+
+
+@timed()
+def get_multichannel_ion_image_job_result(handle, targets, ion_image_mode, ion_image_options, mz_bin_width=0,
+                                          mz_bin_unit='Da', progress_callback=None):
+    """
+    Get the multi-channel ion image figure of a dataset from its result cache, calculating it if it has not been
+    cached.
+
+    :param handle: Handle of the dataset.
+    :type handle: TSFImagingDataViewer.sessions.DatasetHandle
+    :param targets: List of (m/z, m/z tolerance, m/z tolerance unit) tuples.
+    :type targets: list[tuple]
+    :param ion_image_mode: Either 'panels' or 'rgb'.
+    :type ion_image_mode: str
+    :param ion_image_options: Values selected in the ion image options checklist.
+    :type ion_image_options: list[str]
+    :param mz_bin_width: Width of the m/z bins of the datacube. Use 0 for a profile datacube.
+    :type mz_bin_width: float
+    :param mz_bin_unit: m/z bin width unit. Either 'Da' or 'ppm'.
+    :type mz_bin_unit: str
+    :param progress_callback: Optional function called with the number of frames processed so far and the total
+        number of frames.
+    :type progress_callback: function | None
+    :return: Tuple of the plotly figure containing the multi-channel ion image and its image pyramid store key.
+    :rtype: tuple
+    """
+    data = handle.data
+    result_cache = handle.result_cache
+    source = get_ion_image_source(ion_image_options)
+    params = {'targets': [list(target) for target in targets],
+              'source': source}
+    mz_bins = get_ion_image_mz_bins(data, source, mz_bin_width, mz_bin_unit)
+    if mz_bins is not None:
+        params['mz_bins'] = mz_bins.get_params()
+    labels = [f'm/z {mz} \u00B1 {mz_tolerance} {mz_tolerance_unit}'
+              for mz, mz_tolerance, mz_tolerance_unit in targets]
+    # RGB overlays are limited to 3 channels, so fall back to panels for more targets.
+    if ion_image_mode == 'rgb' and len(targets) > 3:
+        ion_image_mode = 'panels'
+
+    def plot(ion_images_array):
+        # Channels are normalized before building the pyramid so that zoomed views keep the same normalization.
+        return plot_ion_images(normalize_ion_images(ion_images_array),
+                               lambda view, x0, y0, scale: get_multichannel_ion_image_figure(
+                                   view, labels, mode=ion_image_mode, x0=x0, y0=y0, scale=scale, normalize=False))
+
+    cached_ion_images = result_cache.get('ion_images', params)
+    if cached_ion_images is None:
+        ion_images_array = get_progressive_ion_images_array(data,
+                                                            targets,
+                                                            ion_image_options,
+                                                            plot,
+                                                            progress_callback,
+                                                            mz_bins)
+        result_cache.put('ion_images', params, {'ion_images': ion_images_array})
+    else:
+        ion_images_array = np.array(cached_ion_images['ion_images'])
+    return plot(ion_images_array)
+
+
+def run_dataset_job(func, handle, *args, progress_callback=None):
+    """
+    Run a job function on a dataset, keeping the dataset handle open until the job is done.
+
+    :param func: Job function called with the handle, args, and progress_callback.
+    :type func: function
+    :param handle: Handle of the dataset.
+    :type handle: TSFImagingDataViewer.sessions.DatasetHandle
+    :param progress_callback: Progress callback of the job.
+    :type progress_callback: function | None
+    :return: Result of func.
+    """
+    global DATASET_POOL
+    if not DATASET_POOL.retain(handle):
+        raise JobCancelledError(f'{handle.path} was closed before the job started.')
+    try:
+        return func(handle, *args, progress_callback=progress_callback)
+    finally:
+        DATASET_POOL.release(handle)
+
+
+def submit_job(name, func, session_id, args, description, previous_job_id):
+    """
+    Submit a background job on the dataset loaded by a session, cancelling the job that is currently displayed in the
+    session's progress bar.
+
+    :param name: Name of the job.
+    :type name: str
+    :param func: Function to run in the background. Called with the dataset handle followed by args.
+    :type func: function
+    :param session_id: Session ID.
+    :type session_id: str
+    :param args: Positional arguments passed to func after the dataset handle.
+    :type args: tuple
+    :param description: Human readable description shown next to the progress bar.
+    :type description: str
+    :param previous_job_id: ID of the job currently displayed in the progress bar.
+    :type previous_job_id: str | None
+    :return: Tuple of the new job ID and False to enable progress polling.
+    :rtype: tuple
+    """
+    global SESSIONS
+    global JOB_RUNNER
+    handle = SESSIONS.get_handle(session_id)
+    if handle is None:
+        return no_update
+    if previous_job_id:
+        JOB_RUNNER.cancel(previous_job_id)
+    job = JOB_RUNNER.submit(name, run_dataset_job, func, handle, *args, description=description)
+    return job.id, False
+
+
+@BLUEPRINT.callback(Output('session_id', 'data'),
+                     Input('session_id', 'modified_timestamp'),
+                     State('session_id', 'data'),
+                     prevent_initial_call=False)
+@timed()
+def register_session(modified_timestamp, session_id):
+    global SESSIONS
+    # A session ID is only created if the browser tab does not have one yet. Setting it triggers this callback again,
+    # which registers the new ID.
+    if session_id is None:
+        return uuid.uuid4().hex
+    SESSIONS.register(session_id)
+    return no_update
+
+
+@BLUEPRINT.callback([Output('spectrum', 'figure'),
+                      Output('store_plot', 'data'),
+                      Output('ion_image', 'figure'),
+                      Output('mz', 'value'),
+                      Output('mz', 'min'),
+                      Output('mz', 'max'),
+                      Output('x_coord', 'value'),
+                      Output('x_coord', 'min'),
+                      Output('x_coord', 'max'),
+                      Output('y_coord', 'value'),
+                      Output('y_coord', 'min'),
+                      Output('y_coord', 'max'),
+                      Output('frame', 'value'),
+                      Output('frame', 'min'),
+                      Output('frame', 'max'),
+                      Output('average_estimate', 'disabled'),
+                      Output('average_full', 'disabled'),
+                      Output('per_frame', 'disabled'),
+                      Output('mz', 'disabled'),
+                      Output('mz_tolerance', 'disabled'),
+                      Output('mz_tolerance_unit', 'disabled'),
+                      Output('update_ion_image', 'disabled'),
+                      Output('ion_image_targets', 'disabled'),
+                      Output('ion_image_mode', 'disabled'),
+                      Output('update_multichannel_ion_image', 'disabled'),
+                      Output('x_coord', 'disabled'),
+                      Output('y_coord', 'disabled'),
+                      Output('frame', 'disabled'),
+                      Output('dot_d_directory', 'data'),
+                      Output('load_tsf_error_modal', 'is_open'),
+                      Output('load_tsf_error_message', 'children'),
+                      Output('store_ion_image', 'data')],
+                     Input('load_tsf', 'n_clicks'),
+                     [State('dot_d_path', 'value'),
+                      State('session_id', 'data'),
+                      State('job_id', 'data')])
+@timed()
+def upload_data(n_clicks, dot_d_path, session_id, job_id):
     changed_id = [i['prop_id'] for i in callback_context.triggered][0]
     if changed_id == 'load_tsf.n_clicks':
-        global DATA
-        main_tk_window = tkinter.Tk()
-        main_tk_window.attributes('-topmost', True, '-alpha', 0)
-        dot_d_directory = askdirectory(mustexist=True)
-        main_tk_window.destroy()
-        if dot_d_directory.endswith('.d') and schema_detection(dot_d_directory) == 'TSF':
-            DATA = TsfData(dot_d_directory, init_tdf_sdk_api())
-            spectrum = TsfSpectrum(DATA, frame=1, mode='profile')
-            fig = get_spectrum(spectrum)
+        global SESSIONS
+        global JOB_RUNNER
+        global DIALOG_LOCK
+        global DATA_DIR
+        if DATA_DIR is not None:
+            dot_d_directory = resolve_dataset_path(DATA_DIR, dot_d_path) or ''
+        else:
+            with DIALOG_LOCK:
+                main_tk_window = tkinter.Tk()
+                main_tk_window.attributes('-topmost', True, '-alpha', 0)
+                dot_d_directory = askdirectory(mustexist=True)
+                main_tk_window.destroy()
+        if (dot_d_directory.endswith('.d') and os.path.isdir(dot_d_directory) and
+                schema_detection(dot_d_directory) == 'TSF'):
+            if job_id:
+                JOB_RUNNER.cancel(job_id)
+            try:
+                # Parsed metadata is loaded from the result cache if the dataset has been opened before.
+                handle = SESSIONS.open_dataset(session_id, dot_d_directory)
+            except DatasetPoolFullError:
+                return ((no_update,) * 29 +
+                        (True, 'Too many datasets are open on this server. Please try again later.', no_update))
+            metadata = handle.metadata
+            spectrum = handle.spectrum_cache.get(1)
+            fig, figure_key = plot_spectrum(spectrum.mz_array, spectrum.intensity_array)
+            # Neighbouring spectra are only decoded once the first spectrum has been plotted.
+            handle.spectrum_cache.prefetch_neighbors(1)
             ion_image = px.imshow(np.zeros((2, 2)), color_continuous_scale='viridis', range_color=[0, 1])
-            maldiframeinfo_dict = DATA.analysis['MaldiFrameInfo'][DATA.analysis['MaldiFrameInfo']['Frame'] ==
-                                                                  1].to_dict(orient='records')[0]
-            mz_value = float(DATA.analysis['GlobalMetadata']['MzAcqRangeLower'])
-            mz_min = float(DATA.analysis['GlobalMetadata']['MzAcqRangeLower'])
-            mz_max = float(DATA.analysis['GlobalMetadata']['MzAcqRangeUpper'])
-            x_value = int(maldiframeinfo_dict['XIndexPos'])
-            x_min = int(DATA.analysis['GlobalMetadata']['ImagingAreaMinXIndexPos'])
-            x_max = int(DATA.analysis['GlobalMetadata']['ImagingAreaMaxXIndexPos'])
-            y_value = int(maldiframeinfo_dict['YIndexPos'])
-            y_min = int(DATA.analysis['GlobalMetadata']['ImagingAreaMinYIndexPos'])
-            y_max = int(DATA.analysis['GlobalMetadata']['ImagingAreaMaxYIndexPos'])
+            x_value, y_value = handle.pixel_index.get_coords(1)
+            mz_value = metadata.mz_acq_range_lower
+            mz_min = metadata.mz_acq_range_lower
+            mz_max = metadata.mz_acq_range_upper
+            x_min = metadata.min_x
+            x_max = metadata.max_x
+            y_min = metadata.min_y
+            y_max = metadata.max_y
             frame_value = 1
-            frame_min = int(np.min(DATA.analysis['Frames']['Id'].values))
-            frame_max = int(np.max(DATA.analysis['Frames']['Id'].values))
-            return (fig, Serverside(fig), ion_image,
+            frame_min = int(np.min(metadata.frame_ids))
+            frame_max = int(np.max(metadata.frame_ids))
+            return (fig, figure_key, ion_image,
                     mz_value, mz_min, mz_max,
                     x_value, x_min, x_max, y_value, y_min, y_max,
                     frame_value, frame_min, frame_max,
-                    False, False, False, False, False, False, False, False, False, False,
-                    dot_d_directory, False)
+                    False, False, False, False, False, False, False, False, False, False, False, False, False,
+                    dot_d_directory, False, no_update, None)
         else:
             return no_update
     else:
         return no_update
 
 
-@app.callback([Output('spectrum', 'figure'),
-               Output('store_plot', 'data'),
-               Output('x_coord_group', 'style'),
-               Output('y_coord_group', 'style'),
-               Output('frame_group', 'style')],
-              Input('average_estimate', 'n_clicks'),
-              [State('x_coord_group', 'style'),
-               State('y_coord_group', 'style'),
-               State('frame_group', 'style')])
-def show_average_estimate(n_clicks, x_coord_group_style, y_coord_group_style, frame_group_style):
+@BLUEPRINT.callback([Output('job_id', 'data'),
+                      Output('job_interval', 'disabled')],
+                     Input('average_estimate', 'n_clicks'),
+                     [State('mz_bin_width', 'value'),
+                      State('mz_bin_unit', 'value'),
+                      State('session_id', 'data'),
+                      State('job_id', 'data')])
+@timed()
+def show_average_estimate(n_clicks, mz_bin_width, mz_bin_unit, session_id, job_id):
     changed_id = [i['prop_id'] for i in callback_context.triggered][0]
     if changed_id == 'average_estimate.n_clicks':
-        global DATA
-        if os.path.isfile(os.path.join(DATA.source_file, 'average_estimate.pickle')):
-            spectrum_df = pd.read_pickle(os.path.join(DATA.source_file, 'average_estimate.pickle'))
-        else:
-            frame_ids = DATA.analysis['Frames']['Id'].values
-            frame_ids = frame_ids[::int(frame_ids.size / (frame_ids.size * 0.2))]
-            mz_array, intensity_array = create_average_spectrum(DATA, frame_ids)
-            spectrum_df = pd.DataFrame({'m/z': copy.deepcopy(mz_array),
-                                        'Intensity': copy.deepcopy(intensity_array)})
-            spectrum_df.to_pickle(os.path.join(DATA.source_file, 'average_estimate.pickle'))
-        fig = get_spectrum_from_arrays(spectrum_df)
-        x_coord_group_style['display'] = 'none'
-        y_coord_group_style['display'] = 'none'
-        frame_group_style['display'] = 'none'
-        return fig, Serverside(fig), x_coord_group_style, y_coord_group_style, frame_group_style
+        return submit_job('average_spectrum', get_average_spectrum_df, session_id, (0.2, mz_bin_width, mz_bin_unit),
+                          'Calculating average estimate spectrum', job_id)
     else:
         return no_update
 
 
-@app.callback([Output('spectrum', 'figure'),
-               Output('store_plot', 'data'),
-               Output('x_coord_group', 'style'),
-               Output('y_coord_group', 'style'),
-               Output('frame_group', 'style')],
-              Input('average_full', 'n_clicks'),
-              [State('x_coord_group', 'style'),
-               State('y_coord_group', 'style'),
-               State('frame_group', 'style')])
-def show_average_full(n_clicks, x_coord_group_style, y_coord_group_style, frame_group_style):
+@BLUEPRINT.callback([Output('job_id', 'data'),
+                      Output('job_interval', 'disabled')],
+                     Input('average_full', 'n_clicks'),
+                     [State('mz_bin_width', 'value'),
+                      State('mz_bin_unit', 'value'),
+                      State('session_id', 'data'),
+                      State('job_id', 'data')])
+@timed()
+def show_average_full(n_clicks, mz_bin_width, mz_bin_unit, session_id, job_id):
     changed_id = [i['prop_id'] for i in callback_context.triggered][0]
     if changed_id == 'average_full.n_clicks':
-        global DATA
-        if os.path.isfile(os.path.join(DATA.source_file, 'average_full.pickle')):
-            spectrum_df = pd.read_pickle(os.path.join(DATA.source_file, 'average_full.pickle'))
-        else:
-            frame_ids = DATA.analysis['Frames']['Id'].values
-
-            mz_array, intensity_array = create_average_spectrum(DATA, frame_ids)
-            spectrum_df = pd.DataFrame({'m/z': copy.deepcopy(mz_array),
-                                        'Intensity': copy.deepcopy(intensity_array)})
-            spectrum_df.to_pickle(os.path.join(DATA.source_file, 'average_full.pickle'))
-        fig = get_spectrum_from_arrays(spectrum_df)
-        x_coord_group_style['display'] = 'none'
-        y_coord_group_style['display'] = 'none'
-        frame_group_style['display'] = 'none'
-        return fig, Serverside(fig), x_coord_group_style, y_coord_group_style, frame_group_style
+        return submit_job('average_spectrum', get_average_spectrum_df, session_id, (1.0, mz_bin_width, mz_bin_unit),
+                          'Calculating full average spectrum', job_id)
     else:
         return no_update
 
 
-@app.callback([Output('spectrum', 'figure'),
-               Output('store_plot', 'data'),
-               Output('x_coord_group', 'style'),
-               Output('y_coord_group', 'style'),
-               Output('frame_group', 'style')],
-              Input('per_frame', 'n_clicks'),
-              [State('frame', 'value'),
-               State('x_coord_group', 'style'),
-               State('y_coord_group', 'style'),
-               State('frame_group', 'style')])
+@BLUEPRINT.callback([Output('spectrum', 'figure'),
+                      Output('store_plot', 'data'),
+                      Output('x_coord_group', 'style'),
+                      Output('y_coord_group', 'style'),
+                      Output('frame_group', 'style')],
+                     Input('per_frame', 'n_clicks'),
+                     [State('frame', 'value'),
+                      State('x_coord_group', 'style'),
+                      State('y_coord_group', 'style'),
+                      State('frame_group', 'style'),
+                      State('session_id', 'data')])
+@timed()
 def view_per_frame_spectra(n_clicks, frame,
-                           x_coord_group_style, y_coord_group_style, frame_group_style):
+                           x_coord_group_style, y_coord_group_style, frame_group_style, session_id):
     changed_id = [i['prop_id'] for i in callback_context.triggered][0]
     if changed_id == 'per_frame.n_clicks':
         if frame == 0:
             frame = 1
-        global DATA
-        spectrum = TsfSpectrum(DATA, frame=frame, mode='profile')
-        fig = get_spectrum(spectrum)
+        global SESSIONS
+        handle = SESSIONS.get_handle(session_id)
+        if handle is None:
+            return no_update
+        if handle.pixel_index.get_coords(frame) is None:
+            return no_update
+        spectrum = handle.spectrum_cache.get(frame)
+        handle.spectrum_cache.prefetch_neighbors(frame)
+        fig, figure_key = plot_spectrum(spectrum.mz_array, spectrum.intensity_array)
         x_coord_group_style['display'] = 'flex'
         y_coord_group_style['display'] = 'flex'
         frame_group_style['display'] = 'flex'
-        return fig, Serverside(fig), x_coord_group_style, y_coord_group_style, frame_group_style
+        return fig, figure_key, x_coord_group_style, y_coord_group_style, frame_group_style
     else:
         return no_update
 
 
-@app.callback([Output('spectrum', 'figure'),
-               Output('store_plot', 'data'),
-               Output('x_coord', 'value'),
-               Output('y_coord', 'value')],
-              Input('frame', 'value'))
-def update_spectrum_from_frame(frame):
+@BLUEPRINT.callback([Output('spectrum', 'figure'),
+                      Output('store_plot', 'data'),
+                      Output('x_coord', 'value'),
+                      Output('y_coord', 'value')],
+                     Input('frame', 'value'),
+                     State('session_id', 'data'))
+@timed()
+def update_spectrum_from_frame(frame, session_id):
     changed_id = callback_context
     if changed_id.triggered[0]['prop_id'].split('.')[0] == 'frame':
-        global DATA
-        spectrum = TsfSpectrum(DATA, frame=frame, mode='profile')
-        fig = get_spectrum(spectrum)
-        maldiframeinfo_dict = DATA.analysis['MaldiFrameInfo'][DATA.analysis['MaldiFrameInfo']['Frame'] ==
-                                                              frame].to_dict(orient='records')[0]
-        return fig, Serverside(fig), int(maldiframeinfo_dict['XIndexPos']), int(maldiframeinfo_dict['YIndexPos'])
+        global SESSIONS
+        handle = SESSIONS.get_handle(session_id)
+        if handle is None:
+            return no_update
+        coords = handle.pixel_index.get_coords(frame)
+        if coords is None:
+            return no_update
+        spectrum = handle.spectrum_cache.get(frame)
+        handle.spectrum_cache.prefetch_neighbors(frame)
+        fig, figure_key = plot_spectrum(spectrum.mz_array, spectrum.intensity_array)
+        return fig, figure_key, coords[0], coords[1]
     else:
         return no_update
 
 
-@app.callback([Output('spectrum', 'figure'),
-               Output('store_plot', 'data'),
-               Output('frame', 'value')],
-              Input('x_coord', 'value'),
-              State('y_coord', 'value'))
-def update_spectrum_from_x_coord(x_coord, y_coord):
+@BLUEPRINT.callback([Output('spectrum', 'figure'),
+                      Output('store_plot', 'data'),
+                      Output('frame', 'value')],
+                     Input('x_coord', 'value'),
+                     [State('y_coord', 'value'),
+                      State('session_id', 'data')])
+@timed()
+def update_spectrum_from_x_coord(x_coord, y_coord, session_id):
     changed_id = callback_context
     if changed_id.triggered[0]['prop_id'].split('.')[0] == 'x_coord':
-        global DATA
-        maldiframeinfo_dict = \
-            DATA.analysis['MaldiFrameInfo'][(DATA.analysis['MaldiFrameInfo']['XIndexPos'] == x_coord) &
-                                            (DATA.analysis['MaldiFrameInfo']['YIndexPos'] == y_coord)].to_dict(
-                orient='records')[0]
-        spectrum = TsfSpectrum(DATA, frame=maldiframeinfo_dict['Frame'], mode='profile')
-        fig = get_spectrum(spectrum)
-        return fig, Serverside(fig), maldiframeinfo_dict['Frame']
+        global SESSIONS
+        handle = SESSIONS.get_handle(session_id)
+        if handle is None:
+            return no_update
+        frame = handle.pixel_index.get_frame(x_coord, y_coord)
+        if frame is None:
+            return blank_figure(), None, no_update
+        spectrum = handle.spectrum_cache.get(frame)
+        handle.spectrum_cache.prefetch_neighbors(frame)
+        fig, figure_key = plot_spectrum(spectrum.mz_array, spectrum.intensity_array)
+        return fig, figure_key, frame
     else:
         return no_update
 
 
-@app.callback([Output('spectrum', 'figure'),
-               Output('store_plot', 'data'),
-               Output('frame', 'value')],
-              Input('y_coord', 'value'),
-              State('x_coord', 'value'))
-def update_spectrum_from_y_coord(y_coord, x_coord):
+@BLUEPRINT.callback([Output('spectrum', 'figure'),
+                      Output('store_plot', 'data'),
+                      Output('frame', 'value')],
+                     Input('y_coord', 'value'),
+                     [State('x_coord', 'value'),
+                      State('session_id', 'data')])
+@timed()
+def update_spectrum_from_y_coord(y_coord, x_coord, session_id):
     changed_id = callback_context
     if changed_id.triggered[0]['prop_id'].split('.')[0] == 'y_coord':
-        global DATA
-        maldiframeinfo_dict = \
-            DATA.analysis['MaldiFrameInfo'][(DATA.analysis['MaldiFrameInfo']['XIndexPos'] == x_coord) &
-                                            (DATA.analysis['MaldiFrameInfo']['YIndexPos'] == y_coord)].to_dict(
-                orient='records')[0]
-        spectrum = TsfSpectrum(DATA, frame=maldiframeinfo_dict['Frame'], mode='profile')
-        fig = get_spectrum(spectrum)
-        return fig, Serverside(fig), maldiframeinfo_dict['Frame']
+        global SESSIONS
+        handle = SESSIONS.get_handle(session_id)
+        if handle is None:
+            return no_update
+        frame = handle.pixel_index.get_frame(x_coord, y_coord)
+        if frame is None:
+            return blank_figure(), None, no_update
+        spectrum = handle.spectrum_cache.get(frame)
+        handle.spectrum_cache.prefetch_neighbors(frame)
+        fig, figure_key = plot_spectrum(spectrum.mz_array, spectrum.intensity_array)
+        return fig, figure_key, frame
     else:
         return no_update
 
 
-@app.callback(Output('ion_image', 'figure'),
-              Input('update_ion_image', 'n_clicks'),
-              [State('mz', 'value'),
-               State('mz_tolerance', 'value'),
-               State('mz_tolerance_unit', 'value')])
-def update_ion_image(n_clicks, mz, mz_tolerance, mz_tolerance_unit):
+@BLUEPRINT.callback([Output('job_id', 'data'),
+                      Output('job_interval', 'disabled')],
+                     Input('update_ion_image', 'n_clicks'),
+                     [State('mz', 'value'),
+                      State('mz_tolerance', 'value'),
+                      State('mz_tolerance_unit', 'value'),
+                      State('ion_image_options', 'value'),
+                      State('mz_bin_width', 'value'),
+                      State('mz_bin_unit', 'value'),
+                      State('session_id', 'data'),
+                      State('job_id', 'data')])
+@timed()
+def update_ion_image(n_clicks, mz, mz_tolerance, mz_tolerance_unit, ion_image_options, mz_bin_width, mz_bin_unit,
+                     session_id, job_id):
     changed_id = [i['prop_id'] for i in callback_context.triggered][0]
     if changed_id == 'update_ion_image.n_clicks':
-        global DATA
-        ion_image = get_ion_image(DATA, mz, mz_tolerance, mz_tolerance_unit)
-        return ion_image
+        return submit_job('ion_image',
+                          get_ion_image_job_result,
+                          session_id,
+                          (mz, mz_tolerance, mz_tolerance_unit, ion_image_options, mz_bin_width, mz_bin_unit),
+                          f'Calculating ion image for m/z {mz} \u00B1 {mz_tolerance} {mz_tolerance_unit}',
+                          job_id)
+    else:
+        return no_update
+
+
+@BLUEPRINT.callback([Output('job_id', 'data'),
+                      Output('job_interval', 'disabled')],
+                     Input('update_multichannel_ion_image', 'n_clicks'),
+                     [State('ion_image_targets', 'value'),
+                      State('ion_image_mode', 'value'),
+                      State('mz_tolerance', 'value'),
+                      State('mz_tolerance_unit', 'value'),
+                      State('ion_image_options', 'value'),
+                      State('mz_bin_width', 'value'),
+                      State('mz_bin_unit', 'value'),
+                      State('session_id', 'data'),
+                      State('job_id', 'data')])
+@timed()
+def update_multichannel_ion_image(n_clicks, ion_image_targets, ion_image_mode, mz_tolerance, mz_tolerance_unit,
+                                  ion_image_options, mz_bin_width, mz_bin_unit, session_id, job_id):
+    changed_id = [i['prop_id'] for i in callback_context.triggered][0]
+    if changed_id == 'update_multichannel_ion_image.n_clicks':
+        try:
+            targets = parse_mz_targets(ion_image_targets, mz_tolerance, mz_tolerance_unit)
+        except ValueError:
+            return no_update
+        if not targets:
+            return no_update
+        return submit_job('ion_image',
+                          get_multichannel_ion_image_job_result,
+                          session_id,
+                          (targets, ion_image_mode, ion_image_options, mz_bin_width, mz_bin_unit),
+                          f'Calculating {len(targets)} ion images',
+                          job_id)
     else:
         return no_update
 
 
-@app.callback(Output('mz', 'value'),
-              Input('spectrum', 'clickData'))
+@BLUEPRINT.callback([Output('job_progress', 'value'),
+                      Output('job_progress', 'label'),
+                      Output('job_status', 'children'),
+                      Output('job_interval', 'disabled'),
+                      Output('cancel_job', 'disabled'),
+                      Output('job_result', 'data')],
+                     Input('job_interval', 'n_intervals'),
+                     [State('job_id', 'data'),
+                      State('job_result', 'data')])
+@timed()
+def update_job_progress(n_intervals, job_id, job_result):
+    global JOB_RUNNER
+    job = JOB_RUNNER.get(job_id)
+    if job is None:
+        return 0, '', '', True, True, no_update
+    progress = job.get_progress()
+    label = f'{progress:.0f}%' if progress > 0 else ''
+    # Partial results such as low resolution ion image previews are shown as soon as they are available.
+    if job.result_version > 0 and job_result != {'job_id': job.id, 'version': job.result_version}:
+        job_result = {'job_id': job.id, 'version': job.result_version}
+    else:
+        job_result = no_update
+    if job.status == 'done':
+        return progress, label, f'{job.description}: done', True, True, job_result
+    elif job.status == 'failed':
+        return progress, label, f'{job.description}: failed ({job.error})', True, True, job_result
+    elif job.status == 'cancelled':
+        return progress, label, f'{job.description}: cancelled', True, True, job_result
+    elif job.total > 0:
+        status = f'{job.description}: {job.processed}/{job.total} frames'
+        return progress, label, status, False, False, job_result
+    else:
+        return progress, label, f'{job.description}...', False, False, job_result
+
+
+@BLUEPRINT.callback(Output('job_status', 'children'),
+                     Input('cancel_job', 'n_clicks'),
+                     State('job_id', 'data'))
+@timed()
+def cancel_job(n_clicks, job_id):
+    changed_id = [i['prop_id'] for i in callback_context.triggered][0]
+    if changed_id == 'cancel_job.n_clicks':
+        global JOB_RUNNER
+        JOB_RUNNER.cancel(job_id)
+        return 'Cancelling...'
+    else:
+        return no_update
+
+
+@BLUEPRINT.callback([Output('spectrum', 'figure'),
+                      Output('store_plot', 'data'),
+                      Output('x_coord_group', 'style'),
+                      Output('y_coord_group', 'style'),
+                      Output('frame_group', 'style')],
+                     Input('job_result', 'data'),
+                     [State('x_coord_group', 'style'),
+                      State('y_coord_group', 'style'),
+                      State('frame_group', 'style')])
+@timed()
+def show_average_spectrum_result(job_result, x_coord_group_style, y_coord_group_style, frame_group_style):
+    global JOB_RUNNER
+    job = JOB_RUNNER.get(job_result['job_id'])
+    if job is None or job.name != 'average_spectrum' or job.status != 'done':
+        return no_update
+    fig, figure_key = plot_spectrum(job.result['m/z'].values, job.result['Intensity'].values)
+    x_coord_group_style['display'] = 'none'
+    y_coord_group_style['display'] = 'none'
+    frame_group_style['display'] = 'none'
+    return fig, figure_key, x_coord_group_style, y_coord_group_style, frame_group_style
+
+
+@BLUEPRINT.callback([Output('ion_image', 'figure'),
+                      Output('store_ion_image', 'data')],
+                     Input('job_result', 'data'))
+@timed()
+def show_ion_image_result(job_result):
+    global JOB_RUNNER
+    job = JOB_RUNNER.get(job_result['job_id'])
+    if job is None or job.name != 'ion_image' or job.result is None:
+        return no_update
+    fig, pyramid_key = job.result
+    return fig, pyramid_key
+
+
+@BLUEPRINT.callback(Output('mz', 'value'),
+                     Input('spectrum', 'clickData'))
+@timed()
 def update_mz_from_spectrum(peak):
     changed_id = [i['prop_id'] for i in callback_context.triggered][0]
     if changed_id == 'spectrum.clickData':
-        global DATA
         mz = round(peak['points'][0]['x'], 4)
         return mz
 
 
-@app.callback([Output('spectrum', 'figure'),
-               Output('store_plot', 'data'),
-               Output('x_coord', 'value'),
-               Output('y_coord', 'value'),
-               Output('frame', 'value')],
-              Input('ion_image', 'clickData'))
-def update_spectrum_from_ion_image(coords):
+@BLUEPRINT.callback([Output('job_id', 'data'),
+                      Output('job_interval', 'disabled')],
+                     Input('ion_image', 'selectedData'),
+                     [State('ion_image_options', 'value'),
+                      State('mz_bin_width', 'value'),
+                      State('mz_bin_unit', 'value'),
+                      State('session_id', 'data'),
+                      State('job_id', 'data')])
+@timed()
+def show_roi_average_spectrum(selected_data, ion_image_options, mz_bin_width, mz_bin_unit, session_id, job_id):
+    changed_id = [i['prop_id'] for i in callback_context.triggered][0]
+    if changed_id == 'ion_image.selectedData':
+        global SESSIONS
+        handle = SESSIONS.get_handle(session_id)
+        if handle is None or handle.pixel_index is None:
+            return no_update
+        frame_ids = get_roi_frame_ids(handle.pixel_index, selected_data)
+        if frame_ids.size == 0:
+            return no_update
+        return submit_job('average_spectrum', get_roi_average_spectrum_df, session_id,
+                          (frame_ids, ion_image_options, mz_bin_width, mz_bin_unit),
+                          f'Calculating average spectrum of {frame_ids.size} selected pixels', job_id)
+    else:
+        return no_update
+
+
+@BLUEPRINT.callback([Output('spectrum', 'figure'),
+                      Output('store_plot', 'data'),
+                      Output('x_coord', 'value'),
+                      Output('y_coord', 'value'),
+                      Output('frame', 'value')],
+                     Input('ion_image', 'clickData'),
+                     State('session_id', 'data'))
+@timed()
+def update_spectrum_from_ion_image(coords, session_id):
     changed_id = [i['prop_id'] for i in callback_context.triggered][0]
     if changed_id == 'ion_image.clickData':
-        global DATA
-        x_coord = int(coords['points'][0]['x']) + int(DATA.analysis['GlobalMetadata']['ImagingAreaMinXIndexPos'])
-        y_coord = int(coords['points'][0]['y']) + int(DATA.analysis['GlobalMetadata']['ImagingAreaMinYIndexPos'])
-        maldiframeinfo_dict = \
-            DATA.analysis['MaldiFrameInfo'][(DATA.analysis['MaldiFrameInfo']['XIndexPos'] == x_coord) &
-                                            (DATA.analysis['MaldiFrameInfo']['YIndexPos'] == y_coord)].to_dict(
-                orient='records')[0]
-        spectrum = TsfSpectrum(DATA, frame=maldiframeinfo_dict['Frame'], mode='profile')
-        fig = get_spectrum(spectrum)
-        return fig, Serverside(fig), x_coord, y_coord, maldiframeinfo_dict['Frame']
-
-
-@app.callback(Output('spectrum', 'figure', allow_duplicate=True),
-              Input('spectrum', 'relayoutData'),
-              State('store_plot', 'data'),
-              prevent_initial_call=True,
-              memoize=True)
-def resample_spectrum(relayoutdata: dict, fig: FigureResampler):
+        global SESSIONS
+        handle = SESSIONS.get_handle(session_id)
+        if handle is None:
+            return no_update
+        x_coord = int(coords['points'][0]['x']) + handle.pixel_index.min_x
+        y_coord = int(coords['points'][0]['y']) + handle.pixel_index.min_y
+        frame = handle.pixel_index.get_frame(x_coord, y_coord)
+        if frame is None:
+            return no_update
+        spectrum = handle.spectrum_cache.get(frame)
+        handle.spectrum_cache.prefetch_neighbors(frame)
+        fig, figure_key = plot_spectrum(spectrum.mz_array, spectrum.intensity_array)
+        return fig, figure_key, x_coord, y_coord, frame
+
+
+@BLUEPRINT.callback(Output('spectrum', 'figure', allow_duplicate=True),
+                     Input('spectrum', 'relayoutData'),
+                     State('store_plot', 'data'),
+                     prevent_initial_call=True)
+@timed()
+def resample_spectrum(relayoutdata: dict, figure_key: str):
     """
     Dash callback used for spectrum resampling to improve plotly figure performance.
 
     :param relayoutdata: Input signal with dictionary with spectrum_plot relayoutData.
-    :param fig: State signal for data store for plotly_resampler.
+    :param figure_key: State signal with the figure data store key of the displayed spectrum.
     :return: Figure object used to update spectrum_plot figure.
     """
-    if fig is None:
+    global FIGURE_DATA_STORE
+    global SPECTRUM_DOWNSAMPLER
+    global SPECTRUM_N_SHOWN_SAMPLES
+    if figure_key is None:
+        return no_update
+    arrays = FIGURE_DATA_STORE.get(figure_key)
+    if arrays is None:
+        return no_update
+    figure = get_spectrum_figure(*arrays, downsampler=SPECTRUM_DOWNSAMPLER, n_shown_samples=SPECTRUM_N_SHOWN_SAMPLES)
+    return figure.construct_update_data_patch(relayoutdata)
+
+
+@BLUEPRINT.callback(Output('ion_image', 'figure', allow_duplicate=True),
+                     Input('ion_image', 'relayoutData'),
+                     State('store_ion_image', 'data'),
+                     prevent_initial_call=True)
+@timed()
+def update_ion_image_tiles(relayoutdata: dict, pyramid_key: str):
+    """
+    Dash callback used to replace the ion image with the tiles of its image pyramid that are visible after zooming or
+    panning, at the finest resolution that fits in the graph.
+
+    :param relayoutdata: Input signal with dictionary with ion_image relayoutData.
+    :param pyramid_key: State signal with the image pyramid store key of the displayed ion image.
+    :return: Patch of the ion_image figure data.
+    """
+    global IMAGE_PYRAMID_STORE
+    if pyramid_key is None or relayoutdata is None:
+        return no_update
+    ranges = get_relayout_ranges(relayoutdata)
+    entry = IMAGE_PYRAMID_STORE.get(pyramid_key)
+    if ranges is None or entry is None:
         return no_update
-    return fig.construct_update_data_patch(relayoutdata)
+    pyramid, get_figure = entry
+    patch = Patch()
+    patch['data'] = get_figure(*pyramid.get_view(*ranges)).to_dict()['data']
+    return patch
 
 
 if __name__ == '__main__':
-    app.run_server(debug=False)
+    get_app().run_server(debug=False)
@@ -0,0 +1,206 @@
+import os
+import json
+import threading
+import numpy as np
+from TSFImagingDataViewer.metrics import timed
+from TSFImagingDataViewer.util import get_dataset_fingerprint, get_mz_window, get_tmp_path, read_spectrum
+
+DATACUBE_FILENAME = 'datacube.npy'
+DATACUBE_AXES_FILENAME = 'datacube_axes.npz'
+DATACUBE_METADATA_FILENAME = 'datacube.json'
+DATACUBE_PROGRESS_INTERVAL = 256
+DATACUBE_LOCKS = {}
+DATACUBE_LOCKS_LOCK = threading.Lock()
+
+
+class Datacube(object):
+    """
+    Memory-mapped profile datacube (frames x shared profile m/z axis or m/z bins) built from a TSF dataset.
+
+    :param intensities: Memory-mapped float32 array of intensities with shape (number of frames, number of m/z values).
+    :type intensities: numpy.memmap
+    :param mz_array: Shared profile m/z axis or m/z bin centers.
+    :type mz_array: numpy.array
+    :param frame_ids: Frame ID corresponding to each row of the datacube.
+    :type frame_ids: numpy.array
+    """
+    def __init__(self, intensities, mz_array, frame_ids):
+        self.intensities = intensities
+        self.mz_array = mz_array
+        self.frame_ids = frame_ids
+
+    def sum_mass_range(self, lower_mass_range, upper_mass_range):
+        """
+        Sum the intensities of every frame between the lower and upper mass ranges (inclusive).
+
+        :param lower_mass_range: Mass in Daltons to use for the lower mass range.
+        :type lower_mass_range: float
+        :param upper_mass_range: Mass in Daltons to use for the upper mass range.
+        :type upper_mass_range: float
+        :return: Numpy array containing the summed intensity of each frame in the same order as frame_ids.
+        :rtype: numpy.array
+        """
+        mz_window = get_mz_window(self.mz_array, lower_mass_range, upper_mass_range)
+        return np.sum(self.intensities[:, mz_window], axis=1, dtype=np.float64)
+
+
+def get_datacube_paths(bruker_dot_d_file, mz_bins=None):
+    """
+    Get the paths to the files used to store the datacube within a Bruker .d directory. Binned datacubes are stored in
+    separate files for each binning.
+
+    :param bruker_dot_d_file: Path to the .d directory of interest.
+    :type bruker_dot_d_file: str
+    :param mz_bins: Optional m/z bins of the datacube.
+    :type mz_bins: TSFImagingDataViewer.util.MzBins | None
+    :return: Tuple of paths to the intensity array, axes, and metadata files.
+    :rtype: tuple[str]
+    """
+    suffix = '' if mz_bins is None else mz_bins.get_suffix()
+    paths = []
+    for filename in [DATACUBE_FILENAME, DATACUBE_AXES_FILENAME, DATACUBE_METADATA_FILENAME]:
+        root, extension = os.path.splitext(filename)
+        paths.append(os.path.join(bruker_dot_d_file, f'{root}{suffix}{extension}'))
+    return tuple(paths)
+
+
+def get_datacube_lock(cube_path):
+    """
+    Get the lock used to serialize builds of a datacube.
+
+    :param cube_path: Path to the intensity array of the datacube.
+    :type cube_path: str
+    :return: Lock of the datacube.
+    :rtype: threading.Lock
+    """
+    cube_path = os.path.normpath(os.path.abspath(cube_path))
+    with DATACUBE_LOCKS_LOCK:
+        lock = DATACUBE_LOCKS.get(cube_path)
+        if lock is None:
+            lock = DATACUBE_LOCKS[cube_path] = threading.Lock()
+        return lock
+
+
+def load_datacube(data, mz_bins=None):
+    """
+    Load a previously built datacube for a TSF dataset if it exists and is not stale.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param mz_bins: Optional m/z bins of the datacube.
+    :type mz_bins: TSFImagingDataViewer.util.MzBins | None
+    :return: Memory-mapped datacube or None if no valid datacube is found.
+    :rtype: TSFImagingDataViewer.datacube.Datacube | None
+    """
+    cube_path, axes_path, metadata_path = get_datacube_paths(data.source_file, mz_bins)
+    if not all(os.path.isfile(path) for path in [cube_path, axes_path, metadata_path]):
+        return None
+    with open(metadata_path, 'r') as metadata_file:
+        metadata = json.load(metadata_file)
+    if metadata.get('fingerprint') != get_dataset_fingerprint(data.source_file):
+        return None
+    if metadata.get('mz_bins') != (None if mz_bins is None else mz_bins.get_params()):
+        return None
+    with np.load(axes_path) as axes:
+        mz_array = axes['mz_array']
+        frame_ids = axes['frame_ids']
+    intensities = np.load(cube_path, mmap_mode='r')
+    if intensities.shape != (frame_ids.size, mz_array.size):
+        return None
+    return Datacube(intensities, mz_array, frame_ids)
+
+
+@timed()
+def build_datacube(data, progress_callback=None, mz_bins=None):
+    """
+    Build the datacube for a TSF dataset by reading every profile spectrum once and writing it to a memory-mapped
+    float32 array stored in the .d directory. Unless the spectra are binned, the profile m/z axis must be shared by
+    every frame. Every file is written to a uniquely named temporary file and moved into place once it is complete,
+    so a datacube that is memory-mapped elsewhere is never modified. Use get_datacube() to serialize concurrent
+    builds of the same datacube.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param progress_callback: Optional function called with the number of frames processed so far and the total
+        number of frames. May raise an exception to stop the build.
+    :type progress_callback: function | None
+    :param mz_bins: Optional m/z bins used to bin each spectrum, reducing the size of the datacube to one value per bin
+        and frame.
+    :type mz_bins: TSFImagingDataViewer.util.MzBins | None
+    :return: Memory-mapped datacube.
+    :rtype: TSFImagingDataViewer.datacube.Datacube
+    """
+    cube_path, axes_path, metadata_path = get_datacube_paths(data.source_file, mz_bins)
+    fingerprint = get_dataset_fingerprint(data.source_file)
+    frame_ids = data.analysis['Frames']['Id'].values
+    tmp_cube_path = get_tmp_path(cube_path)
+    tmp_axes_path = get_tmp_path(axes_path)
+    tmp_metadata_path = get_tmp_path(metadata_path)
+    intensities = None
+    mz_array = None
+    try:
+        for row, i in enumerate(frame_ids):
+            spectrum = read_spectrum(data, i)
+            if intensities is None:
+                mz_array = spectrum.mz_array if mz_bins is None else mz_bins.mz_array
+                intensities = np.lib.format.open_memmap(tmp_cube_path,
+                                                        mode='w+',
+                                                        dtype=np.float32,
+                                                        shape=(frame_ids.size, mz_array.size))
+            elif mz_bins is None and (spectrum.mz_array.size != mz_array.size or
+                                      spectrum.mz_array[0] != mz_array[0] or spectrum.mz_array[-1] != mz_array[-1]):
+                raise ValueError(f'Frame {i} does not share the profile m/z axis of frame {frame_ids[0]}.')
+            if mz_bins is None:
+                intensities[row, :] = spectrum.intensity_array
+            else:
+                intensities[row, :] = mz_bins.bin_spectrum(spectrum.mz_array, spectrum.intensity_array)
+            if progress_callback is not None and ((row + 1) % DATACUBE_PROGRESS_INTERVAL == 0 or
+                                                  row + 1 == frame_ids.size):
+                progress_callback(row + 1, frame_ids.size)
+        intensities.flush()
+        del intensities
+        with open(tmp_axes_path, 'wb') as axes_file:
+            np.savez(axes_file, mz_array=mz_array, frame_ids=frame_ids)
+        with open(tmp_metadata_path, 'w') as metadata_file:
+            json.dump({'fingerprint': fingerprint,
+                       'shape': [int(frame_ids.size), int(mz_array.size)],
+                       'mz_bins': None if mz_bins is None else mz_bins.get_params()},
+                      metadata_file)
+        # The previous metadata is removed first and the new metadata is moved into place last so that a partially
+        # replaced datacube is never mistaken for a valid one.
+        if os.path.isfile(metadata_path):
+            os.remove(metadata_path)
+        os.replace(tmp_cube_path, cube_path)
+        os.replace(tmp_axes_path, axes_path)
+        os.replace(tmp_metadata_path, metadata_path)
+    finally:
+        for path in [tmp_cube_path, tmp_axes_path, tmp_metadata_path]:
+            if os.path.isfile(path):
+                os.remove(path)
+    return Datacube(np.load(cube_path, mmap_mode='r'), mz_array, frame_ids)
+
+
+def get_datacube(data, progress_callback=None, mz_bins=None):
+    """
+    Get the datacube for a TSF dataset, building it if it does not exist yet or if the raw data has changed. Builds
+    of the same datacube are serialized, so concurrent callers wait for a single build and then load its result.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param progress_callback: Optional function called with the number of frames processed so far and the total
+        number of frames while building the datacube.
+    :type progress_callback: function | None
+    :param mz_bins: Optional m/z bins of the datacube.
+    :type mz_bins: TSFImagingDataViewer.util.MzBins | None
+    :return: Memory-mapped datacube.
+    :rtype: TSFImagingDataViewer.datacube.Datacube
+    """
+    datacube = load_datacube(data, mz_bins)
+    if datacube is not None:
+        return datacube
+    with get_datacube_lock(get_datacube_paths(data.source_file, mz_bins)[0]):
+        # Another caller may have built the datacube while waiting for the lock.
+        datacube = load_datacube(data, mz_bins)
+        if datacube is None:
+            datacube = build_datacube(data, progress_callback=progress_callback, mz_bins=mz_bins)
+    return datacube
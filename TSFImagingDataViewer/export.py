@@ -0,0 +1,643 @@
+import os
+import json
+import uuid
+import hashlib
+from abc import ABC, abstractmethod
+from xml.sax.saxutils import quoteattr
+import numpy as np
+from TSFImagingDataViewer import VERSION
+from TSFImagingDataViewer.metrics import timed
+from TSFImagingDataViewer.parallel import iter_frame_chunks
+from TSFImagingDataViewer.util import get_dataset_fingerprint, get_pixel_index, read_spectrum
+
+# HDF5 and Zarr are optional; an ImportError is only raised when exporting to a format whose package is missing.
+try:
+    import h5py
+except ImportError:
+    h5py = None
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+EXPORT_FORMATS = ['hdf5', 'zarr', 'imzml']
+EXPORT_EXTENSIONS = {'hdf5': '.h5', 'zarr': '.zarr', 'imzml': '.imzML'}
+EXPORT_PROGRESS_SUFFIX = '.export.json'
+EXPORT_PROGRESS_VERSION = 1
+# Frames per chunk. Each chunk is held in memory as float32 (i.e. 64 frames x 100,000 data points is 25 MB), and at
+# most EXPORT_PENDING_CHUNKS_PER_WORKER chunks per worker are read ahead of the chunk being written.
+EXPORT_CHUNK_SIZE = 64
+EXPORT_MZ_CHUNK_SIZE = 4096
+EXPORT_PENDING_CHUNKS_PER_WORKER = 2
+IBD_UUID_SIZE = 16
+IBD_HASH_BLOCK_SIZE = 16 * 1024 ** 2
+
+
+def is_same_mz_axis(mz_array, reference_mz_array):
+    """
+    Check whether a profile m/z axis is the same as a reference m/z axis using its size and end points.
+
+    :param mz_array: Numpy array containing m/z values.
+    :type mz_array: numpy.array
+    :param reference_mz_array: Numpy array containing the reference m/z values.
+    :type reference_mz_array: numpy.array
+    :return: True if the m/z axes are the same.
+    :rtype: bool
+    """
+    return mz_array.size == reference_mz_array.size and \
+        (mz_array.size == 0 or (mz_array[0] == reference_mz_array[0] and mz_array[-1] == reference_mz_array[-1]))
+
+
+@timed()
+def read_intensities(data, frame_ids, mz_bins=None):
+    """
+    Read the profile spectra of a list of frames into a 2D array. Used as the per chunk reducer for export_spectra().
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param frame_ids: List of frame IDs.
+    :type frame_ids: list[int]
+    :param mz_bins: Optional m/z bins used to bin each spectrum.
+    :type mz_bins: TSFImagingDataViewer.util.MzBins | None
+    :return: Tuple of the m/z array shared by the frames and a float32 numpy array with shape (number of frames,
+        number of m/z values) containing intensities.
+    :rtype: tuple[numpy.array]
+    """
+    mz_array = None if mz_bins is None else mz_bins.mz_array
+    intensities = None
+    for row, i in enumerate(frame_ids):
+        spectrum = read_spectrum(data, i)
+        if mz_bins is not None:
+            intensity_array = mz_bins.bin_spectrum(spectrum.mz_array, spectrum.intensity_array)
+        elif mz_array is None or is_same_mz_axis(spectrum.mz_array, mz_array):
+            mz_array = spectrum.mz_array
+            intensity_array = spectrum.intensity_array
+        else:
+            raise ValueError(f'Frame {i} does not share the profile m/z axis of frame {frame_ids[0]}.')
+        if intensities is None:
+            intensities = np.empty((len(frame_ids), intensity_array.size), dtype=np.float32)
+        intensities[row, :] = intensity_array
+    return mz_array, intensities
+
+
+class CubeWriter(ABC):
+    """
+    Base class of the writers used by export_spectra(). Holds the arrays shared by every format; subclasses implement
+    create(), open(), write(), and finalize() for their format.
+
+    :param path: Path to the output file.
+    :type path: str
+    :param mz_array: Shared m/z axis of every spectrum.
+    :type mz_array: numpy.array
+    :param frame_ids: Frame ID of each spectrum.
+    :type frame_ids: numpy.array
+    :param x_coords: X coordinate (XIndexPos) of each spectrum.
+    :type x_coords: numpy.array
+    :param y_coords: Y coordinate (YIndexPos) of each spectrum.
+    :type y_coords: numpy.array
+    :param chunks: Chunk shape of the intensities (frames, m/z values).
+    :type chunks: tuple[int]
+    :param attrs: Attributes describing the export.
+    :type attrs: dict
+    """
+    def __init__(self, path, mz_array, frame_ids, x_coords, y_coords, chunks, attrs):
+        self.path = path
+        self.mz_array = mz_array
+        self.frame_ids = frame_ids
+        self.x_coords = x_coords
+        self.y_coords = y_coords
+        self.chunks = chunks
+        self.attrs = attrs
+        self.file = None
+
+    def get_paths(self):
+        """
+        Get the paths written by the writer.
+
+        :return: List of paths.
+        :rtype: list[str]
+        """
+        return [self.path]
+
+    @abstractmethod
+    def create(self):
+        """
+        Create new output files, replacing any existing files.
+        """
+
+    @abstractmethod
+    def open(self):
+        """
+        Open partially written output files to continue writing them.
+        """
+
+    @abstractmethod
+    def write(self, start, intensities):
+        """
+        Write the intensities of consecutive frames.
+
+        :param start: Position of the first frame.
+        :type start: int
+        :param intensities: 2D numpy array with shape (number of frames, number of m/z values).
+        :type intensities: numpy.array
+        """
+
+    def flush(self):
+        """
+        Flush written frames to disk.
+        """
+        self.file.flush()
+
+    @abstractmethod
+    def finalize(self):
+        """
+        Mark the output as complete once every frame has been written.
+        """
+
+    def close(self):
+        """
+        Close the file.
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class HDF5CubeWriter(CubeWriter):
+    """
+    Writes spectra to an HDF5 file containing a chunked, gzip compressed 'intensities' dataset (frames x m/z values)
+    along with the 'mz', 'frame_ids', 'x', and 'y' datasets. The 'complete' attribute is set once every frame has been
+    written. See CubeWriter for the parameters.
+    """
+    def __init__(self, path, mz_array, frame_ids, x_coords, y_coords, chunks, attrs):
+        if h5py is None:
+            raise ImportError('h5py is required to export HDF5 files. Install it with "pip install h5py".')
+        super().__init__(path, mz_array, frame_ids, x_coords, y_coords, chunks, attrs)
+        self.intensities = None
+
+    def create(self):
+        """
+        Create a new HDF5 file, replacing any existing file.
+        """
+        self.file = h5py.File(self.path, 'w')
+        self.intensities = self.file.create_dataset('intensities',
+                                                    shape=(self.frame_ids.size, self.mz_array.size),
+                                                    dtype=np.float32,
+                                                    chunks=self.chunks,
+                                                    compression='gzip',
+                                                    shuffle=True)
+        self.file.create_dataset('mz', data=self.mz_array)
+        self.file.create_dataset('frame_ids', data=self.frame_ids)
+        self.file.create_dataset('x', data=self.x_coords)
+        self.file.create_dataset('y', data=self.y_coords)
+        self.file.attrs.update(self.attrs)
+        self.file.attrs['complete'] = False
+
+    def open(self):
+        """
+        Open a partially written HDF5 file to continue writing it.
+        """
+        self.file = h5py.File(self.path, 'r+')
+        self.intensities = self.file['intensities']
+        if self.intensities.shape != (self.frame_ids.size, self.mz_array.size):
+            raise ValueError(f'{self.path} does not match the dataset being exported.')
+
+    def write(self, start, intensities):
+        """
+        Write the intensities of consecutive frames.
+
+        :param start: Position of the first frame.
+        :type start: int
+        :param intensities: 2D numpy array with shape (number of frames, number of m/z values).
+        :type intensities: numpy.array
+        """
+        self.intensities[start:start + intensities.shape[0], :] = intensities
+
+    def finalize(self):
+        """
+        Mark the file as complete.
+        """
+        self.file.attrs['complete'] = True
+
+    def close(self):
+        """
+        Close the file.
+        """
+        super().close()
+        self.intensities = None
+
+
+class ZarrCubeWriter(CubeWriter):
+    """
+    Writes spectra to a Zarr group containing a chunked, compressed 'intensities' array (frames x m/z values) along
+    with the 'mz', 'frame_ids', 'x', and 'y' arrays. The 'complete' attribute is set once every frame has been written.
+    See CubeWriter for the parameters.
+    """
+    def __init__(self, path, mz_array, frame_ids, x_coords, y_coords, chunks, attrs):
+        if zarr is None:
+            raise ImportError('zarr is required to export Zarr stores. Install it with "pip install zarr".')
+        super().__init__(path, mz_array, frame_ids, x_coords, y_coords, chunks, attrs)
+        self.intensities = None
+
+    def create(self):
+        """
+        Create a new Zarr group, replacing any existing group.
+        """
+        self.file = zarr.open_group(self.path, mode='w')
+        # The default compressor of the installed Zarr version is used.
+        self.intensities = self.file.create_dataset('intensities',
+                                                    shape=(self.frame_ids.size, self.mz_array.size),
+                                                    chunks=self.chunks,
+                                                    dtype=np.float32)
+        for name, array in [('mz', self.mz_array), ('frame_ids', self.frame_ids), ('x', self.x_coords),
+                            ('y', self.y_coords)]:
+            self.file.create_dataset(name, shape=array.shape, dtype=array.dtype)[:] = array
+        self.file.attrs.update(self.attrs)
+        self.file.attrs['complete'] = False
+
+    def open(self):
+        """
+        Open a partially written Zarr group to continue writing it.
+        """
+        self.file = zarr.open_group(self.path, mode='r+')
+        self.intensities = self.file['intensities']
+        if self.intensities.shape != (self.frame_ids.size, self.mz_array.size):
+            raise ValueError(f'{self.path} does not match the dataset being exported.')
+
+    def write(self, start, intensities):
+        """
+        Write the intensities of consecutive frames.
+
+        :param start: Position of the first frame.
+        :type start: int
+        :param intensities: 2D numpy array with shape (number of frames, number of m/z values).
+        :type intensities: numpy.array
+        """
+        self.intensities[start:start + intensities.shape[0], :] = intensities
+
+    def flush(self):
+        """
+        Written chunks are stored immediately, so there is nothing to flush.
+        """
+        pass
+
+    def finalize(self):
+        """
+        Mark the group as complete.
+        """
+        self.file.attrs['complete'] = True
+
+    def close(self):
+        """
+        Release the group.
+        """
+        self.file = None
+        self.intensities = None
+
+
+class ImzMLWriter(CubeWriter):
+    """
+    Writes spectra to a continuous mode imzML file and its .ibd binary file. The .ibd file starts with a 16 byte UUID
+    followed by the shared m/z array as 64-bit floats and the intensities of each frame as 32-bit floats, so every chunk
+    of frames is written at a fixed offset. The imzML metadata, which contains the SHA-1 of the .ibd file, is written
+    by finalize(). Pixel positions are 1-based and relative to the minimum coordinates. See CubeWriter for the
+    parameters.
+    """
+    def __init__(self, path, mz_array, frame_ids, x_coords, y_coords, chunks, attrs):
+        super().__init__(path, mz_array, frame_ids, x_coords, y_coords, chunks, attrs)
+        self.ibd_path = os.path.splitext(path)[0] + '.ibd'
+        self.uuid = None
+        self.mz_offset = IBD_UUID_SIZE
+        self.intensities_offset = self.mz_offset + mz_array.size * 8
+        self.ibd_size = self.intensities_offset + frame_ids.size * mz_array.size * 4
+
+    def get_paths(self):
+        """
+        Get the paths written by the writer.
+
+        :return: List of paths.
+        :rtype: list[str]
+        """
+        return [self.path, self.ibd_path]
+
+    def create(self):
+        """
+        Create a new .ibd file containing the UUID and m/z array, replacing any existing file. The imzML file is only
+        written once every frame has been written.
+        """
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        self.uuid = uuid.uuid4()
+        self.file = open(self.ibd_path, 'w+b')
+        self.file.write(self.uuid.bytes)
+        self.file.write(np.asarray(self.mz_array, dtype='<f8').tobytes())
+        self.file.truncate(self.ibd_size)
+
+    def open(self):
+        """
+        Open a partially written .ibd file to continue writing it.
+        """
+        if os.path.getsize(self.ibd_path) != self.ibd_size:
+            raise ValueError(f'{self.ibd_path} does not match the dataset being exported.')
+        self.file = open(self.ibd_path, 'r+b')
+        self.uuid = uuid.UUID(bytes=self.file.read(IBD_UUID_SIZE))
+
+    def write(self, start, intensities):
+        """
+        Write the intensities of consecutive frames.
+
+        :param start: Position of the first frame.
+        :type start: int
+        :param intensities: 2D numpy array with shape (number of frames, number of m/z values).
+        :type intensities: numpy.array
+        """
+        self.file.seek(self.intensities_offset + start * self.mz_array.size * 4)
+        self.file.write(np.asarray(intensities, dtype='<f4').tobytes())
+
+    def get_ibd_sha1(self):
+        """
+        Calculate the SHA-1 of the .ibd file.
+
+        :return: Uppercase hexadecimal SHA-1.
+        :rtype: str
+        """
+        sha1 = hashlib.sha1()
+        self.file.seek(0)
+        for block in iter(lambda: self.file.read(IBD_HASH_BLOCK_SIZE), b''):
+            sha1.update(block)
+        return sha1.hexdigest().upper()
+
+    def finalize(self):
+        """
+        Write the imzML file. The file is written to a temporary path and moved into place once it is complete.
+        """
+        self.file.flush()
+        sha1 = self.get_ibd_sha1()
+        x_positions = self.x_coords - np.min(self.x_coords) + 1
+        y_positions = self.y_coords - np.min(self.y_coords) + 1
+        mz_length = self.mz_array.size
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='ISO-8859-1') as imzml_file:
+            imzml_file.write(IMZML_HEADER.format(uuid=f'{{{str(self.uuid).upper()}}}',
+                                                 sha1=sha1,
+                                                 version=VERSION,
+                                                 source=quoteattr(str(self.attrs.get('source', ''))),
+                                                 max_x=int(np.max(x_positions, initial=0)),
+                                                 max_y=int(np.max(y_positions, initial=0)),
+                                                 n_spectra=self.frame_ids.size))
+            for index, (frame, x_position, y_position) in enumerate(zip(self.frame_ids, x_positions, y_positions)):
+                imzml_file.write(IMZML_SPECTRUM.format(index=index,
+                                                       frame=int(frame),
+                                                       x=int(x_position),
+                                                       y=int(y_position),
+                                                       mz_length=mz_length,
+                                                       mz_encoded_length=mz_length * 8,
+                                                       mz_offset=self.mz_offset,
+                                                       intensity_length=mz_length,
+                                                       intensity_encoded_length=mz_length * 4,
+                                                       intensity_offset=self.intensities_offset +
+                                                       index * mz_length * 4))
+            imzml_file.write(IMZML_FOOTER)
+        os.replace(tmp_path, self.path)
+
+
+IMZML_HEADER = '''<?xml version="1.0" encoding="ISO-8859-1"?>
+<mzML xmlns="http://psi.hupo.org/ms/mzml" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" \
+xsi:schemaLocation="http://psi.hupo.org/ms/mzml http://psidev.info/files/ms/mzML/xsd/mzML1.1.0_idx.xsd" version="1.1">
+  <cvList count="3">
+    <cv id="MS" fullName="Proteomics Standards Initiative Mass Spectrometry Ontology" version="4.1.0" \
+URI="http://purl.obolibrary.org/obo/ms.obo"/>
+    <cv id="UO" fullName="Unit Ontology" version="releases/2020-03-10" URI="http://purl.obolibrary.org/obo/uo.obo"/>
+    <cv id="IMS" fullName="Imaging MS Ontology" version="1.1.0" \
+URI="https://raw.githubusercontent.com/imzML/imzML/master/imagingMS.obo"/>
+  </cvList>
+  <fileDescription>
+    <fileContent>
+      <cvParam cvRef="MS" accession="MS:1000579" name="MS1 spectrum" value=""/>
+      <cvParam cvRef="MS" accession="MS:1000128" name="profile spectrum" value=""/>
+      <cvParam cvRef="IMS" accession="IMS:1000080" name="universally unique identifier" value="{uuid}"/>
+      <cvParam cvRef="IMS" accession="IMS:1000091" name="ibd SHA-1" value="{sha1}"/>
+      <cvParam cvRef="IMS" accession="IMS:1000030" name="continuous" value=""/>
+    </fileContent>
+    <sourceFileList count="1">
+      <sourceFile id="source" name={source} location={source}/>
+    </sourceFileList>
+  </fileDescription>
+  <referenceableParamGroupList count="2">
+    <referenceableParamGroup id="mzArray">
+      <cvParam cvRef="MS" accession="MS:1000514" name="m/z array" value="" unitCvRef="MS" unitAccession="MS:1000040" \
+unitName="m/z"/>
+      <cvParam cvRef="MS" accession="MS:1000523" name="64-bit float" value=""/>
+      <cvParam cvRef="MS" accession="MS:1000576" name="no compression" value=""/>
+      <cvParam cvRef="IMS" accession="IMS:1000101" name="external data" value="true"/>
+    </referenceableParamGroup>
+    <referenceableParamGroup id="intensityArray">
+      <cvParam cvRef="MS" accession="MS:1000515" name="intensity array" value="" unitCvRef="MS" \
+unitAccession="MS:1000131" unitName="number of detector counts"/>
+      <cvParam cvRef="MS" accession="MS:1000521" name="32-bit float" value=""/>
+      <cvParam cvRef="MS" accession="MS:1000576" name="no compression" value=""/>
+      <cvParam cvRef="IMS" accession="IMS:1000101" name="external data" value="true"/>
+    </referenceableParamGroup>
+  </referenceableParamGroupList>
+  <softwareList count="1">
+    <software id="TSFImagingDataViewer" version="{version}">
+      <cvParam cvRef="MS" accession="MS:1000799" name="custom unreleased software tool" value="TSFImagingDataViewer"/>
+    </software>
+  </softwareList>
+  <scanSettingsList count="1">
+    <scanSettings id="scanSettings">
+      <cvParam cvRef="IMS" accession="IMS:1000042" name="max count of pixels x" value="{max_x}"/>
+      <cvParam cvRef="IMS" accession="IMS:1000043" name="max count of pixels y" value="{max_y}"/>
+    </scanSettings>
+  </scanSettingsList>
+  <instrumentConfigurationList count="1">
+    <instrumentConfiguration id="instrumentConfiguration">
+      <cvParam cvRef="MS" accession="MS:1000031" name="instrument model" value=""/>
+    </instrumentConfiguration>
+  </instrumentConfigurationList>
+  <dataProcessingList count="1">
+    <dataProcessing id="export">
+      <processingMethod order="1" softwareRef="TSFImagingDataViewer">
+        <cvParam cvRef="MS" accession="MS:1000544" name="Conversion to mzML" value=""/>
+      </processingMethod>
+    </dataProcessing>
+  </dataProcessingList>
+  <run id="run" defaultInstrumentConfigurationRef="instrumentConfiguration">
+    <spectrumList count="{n_spectra}" defaultDataProcessingRef="export">
+'''
+IMZML_SPECTRUM = '''      <spectrum id="frame={frame}" defaultArrayLength="0" index="{index}">
+        <cvParam cvRef="MS" accession="MS:1000579" name="MS1 spectrum" value=""/>
+        <cvParam cvRef="MS" accession="MS:1000511" name="ms level" value="1"/>
+        <cvParam cvRef="MS" accession="MS:1000128" name="profile spectrum" value=""/>
+        <scanList count="1">
+          <cvParam cvRef="MS" accession="MS:1000795" name="no combination" value=""/>
+          <scan instrumentConfigurationRef="instrumentConfiguration">
+            <cvParam cvRef="IMS" accession="IMS:1000050" name="position x" value="{x}"/>
+            <cvParam cvRef="IMS" accession="IMS:1000051" name="position y" value="{y}"/>
+          </scan>
+        </scanList>
+        <binaryDataArrayList count="2">
+          <binaryDataArray encodedLength="0">
+            <referenceableParamGroupRef ref="mzArray"/>
+            <cvParam cvRef="IMS" accession="IMS:1000103" name="external array length" value="{mz_length}"/>
+            <cvParam cvRef="IMS" accession="IMS:1000104" name="external encoded length" value="{mz_encoded_length}"/>
+            <cvParam cvRef="IMS" accession="IMS:1000102" name="external offset" value="{mz_offset}"/>
+            <binary/>
+          </binaryDataArray>
+          <binaryDataArray encodedLength="0">
+            <referenceableParamGroupRef ref="intensityArray"/>
+            <cvParam cvRef="IMS" accession="IMS:1000103" name="external array length" value="{intensity_length}"/>
+            <cvParam cvRef="IMS" accession="IMS:1000104" name="external encoded length" \
+value="{intensity_encoded_length}"/>
+            <cvParam cvRef="IMS" accession="IMS:1000102" name="external offset" value="{intensity_offset}"/>
+            <binary/>
+          </binaryDataArray>
+        </binaryDataArrayList>
+      </spectrum>
+'''
+IMZML_FOOTER = '''    </spectrumList>
+  </run>
+</mzML>
+'''
+EXPORT_WRITERS = {'hdf5': HDF5CubeWriter, 'zarr': ZarrCubeWriter, 'imzml': ImzMLWriter}
+
+
+def load_export_progress(progress_path, params):
+    """
+    Load the number of frames written by a previous export with the same parameters.
+
+    :param progress_path: Path to the progress file.
+    :type progress_path: str
+    :param params: Parameters of the export.
+    :type params: dict
+    :return: Number of frames already written, or 0 if there is no previous export with the same parameters.
+    :rtype: int
+    """
+    if not os.path.isfile(progress_path):
+        return 0
+    with open(progress_path, 'r') as progress_file:
+        progress = json.load(progress_file)
+    if progress.get('params') != params:
+        return 0
+    return int(progress['n_exported'])
+
+
+def save_export_progress(progress_path, params, n_exported):
+    """
+    Save the number of frames written so far. The previous progress file is replaced atomically.
+
+    :param progress_path: Path to the progress file.
+    :type progress_path: str
+    :param params: Parameters of the export.
+    :type params: dict
+    :param n_exported: Number of frames written so far.
+    :type n_exported: int
+    """
+    tmp_progress_path = progress_path + '.tmp'
+    with open(tmp_progress_path, 'w') as progress_file:
+        json.dump({'params': params, 'n_exported': n_exported}, progress_file)
+    os.replace(tmp_progress_path, progress_path)
+
+
+@timed()
+def export_spectra(data, output_prefix, formats=('hdf5',), mz_bins=None, workers=1, chunk_size=EXPORT_CHUNK_SIZE,
+                   mz_chunk_size=EXPORT_MZ_CHUNK_SIZE, progress_callback=None):
+    """
+    Export the spectrum of every frame of a TSF dataset to HDF5, Zarr, and/or continuous mode imzML in a single pass
+    over the frames. Frames are read in chunks of chunk_size frames, in worker processes if workers is greater than 1,
+    and each chunk is written to every format in frame order before it is released, so memory use does not depend on
+    the size of the dataset. The number of frames written is saved to output_prefix + '.export.json' after every chunk;
+    if an export with the same parameters was interrupted, it continues from the last chunk that was written. Unless
+    the spectra are binned, the profile m/z axis must be shared by every frame.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param output_prefix: Path of the output files without extension.
+    :type output_prefix: str
+    :param formats: Output formats. Any of 'hdf5' (.h5), 'zarr' (.zarr), and 'imzml' (.imzML and .ibd).
+    :type formats: list[str] | tuple[str]
+    :param mz_bins: Optional m/z bins used to bin each spectrum.
+    :type mz_bins: TSFImagingDataViewer.util.MzBins | None
+    :param workers: Number of worker processes used to read frames.
+    :type workers: int
+    :param chunk_size: Number of frames per chunk. Also used as the frame chunk size of HDF5 and Zarr outputs.
+    :type chunk_size: int
+    :param mz_chunk_size: Number of m/z values per chunk of HDF5 and Zarr outputs.
+    :type mz_chunk_size: int
+    :param progress_callback: Optional function called with the number of frames written so far and the total number
+        of frames after each chunk. May raise an exception to stop the export, which can be resumed later.
+    :type progress_callback: function | None
+    :return: Dictionary mapping each format to the list of paths written.
+    :rtype: dict
+    """
+    for export_format in formats:
+        if export_format not in EXPORT_WRITERS:
+            raise ValueError(f'Invalid export format {export_format}. Choose from {", ".join(EXPORT_FORMATS)}.')
+    pixel_index = get_pixel_index(data)
+    frame_ids = pixel_index.frame_ids
+    if frame_ids.size == 0:
+        raise ValueError(f'{data.source_file} does not contain any frames.')
+    mz_array = read_spectrum(data, frame_ids[0]).mz_array if mz_bins is None else mz_bins.mz_array
+    fingerprint = get_dataset_fingerprint(data.source_file)
+    params = {'version': EXPORT_PROGRESS_VERSION,
+              'fingerprint': fingerprint,
+              'formats': sorted(formats),
+              'mz_bins': None if mz_bins is None else mz_bins.get_params(),
+              'chunk_size': int(chunk_size),
+              'mz_chunk_size': int(mz_chunk_size),
+              'shape': [int(frame_ids.size), int(mz_array.size)]}
+    attrs = {'source': os.path.abspath(data.source_file),
+             'fingerprint': json.dumps(fingerprint),
+             'mz_bins': json.dumps(params['mz_bins']),
+             'software': f'TSFImagingDataViewer {VERSION}'}
+    chunks = (max(1, min(int(chunk_size), frame_ids.size)), max(1, min(int(mz_chunk_size), mz_array.size)))
+    writers = {export_format: EXPORT_WRITERS[export_format](output_prefix + EXPORT_EXTENSIONS[export_format],
+                                                            mz_array,
+                                                            frame_ids,
+                                                            pixel_index.x_coords,
+                                                            pixel_index.y_coords,
+                                                            chunks,
+                                                            attrs)
+               for export_format in formats}
+    progress_path = output_prefix + EXPORT_PROGRESS_SUFFIX
+    n_exported = load_export_progress(progress_path, params)
+    try:
+        if n_exported > 0:
+            try:
+                for writer in writers.values():
+                    writer.open()
+            except Exception:
+                # Outputs that are missing or cannot be opened are written again from the start.
+                for writer in writers.values():
+                    writer.close()
+                n_exported = 0
+        if n_exported == 0:
+            for writer in writers.values():
+                writer.create()
+            save_export_progress(progress_path, params, 0)
+        if progress_callback is not None:
+            progress_callback(n_exported, frame_ids.size)
+        for chunk_mz_array, intensities in iter_frame_chunks(data,
+                                                             frame_ids[n_exported:],
+                                                             read_intensities,
+                                                             (mz_bins,),
+                                                             workers=workers,
+                                                             chunk_size=chunk_size,
+                                                             max_pending=workers * EXPORT_PENDING_CHUNKS_PER_WORKER):
+            if not is_same_mz_axis(chunk_mz_array, mz_array):
+                raise ValueError(f'Frame {frame_ids[n_exported]} does not share the profile m/z axis of frame '
+                                 f'{frame_ids[0]}.')
+            for writer in writers.values():
+                writer.write(n_exported, intensities)
+                writer.flush()
+            n_exported += intensities.shape[0]
+            save_export_progress(progress_path, params, n_exported)
+            if progress_callback is not None:
+                progress_callback(n_exported, frame_ids.size)
+        for writer in writers.values():
+            writer.finalize()
+    finally:
+        for writer in writers.values():
+            writer.close()
+    os.remove(progress_path)
+    return {export_format: writer.get_paths() for export_format, writer in writers.items()}
@@ -0,0 +1,198 @@
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+JOB_HISTORY_SIZE = 16
+
+
+class JobCancelledError(Exception):
+    """
+    Raised from a job's progress callback once cancellation of the job has been requested.
+    """
+    pass
+
+
+class Job(object):
+    """
+    Long running calculation executed in the background by a JobRunner.
+
+    :param name: Name of the job used by the dashboard to decide how to display its result (i.e. 'average_spectrum').
+    :type name: str
+    :param description: Human readable description shown next to the progress bar.
+    :type description: str
+    """
+    def __init__(self, name, description=''):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.description = description
+        self.status = 'pending'
+        self.processed = 0
+        self.total = 0
+        self.result = None
+        self.result_version = 0
+        self.error = None
+        self._cancel_event = threading.Event()
+
+    def report_progress(self, processed, total, partial_result=None):
+        """
+        Update the progress of the job. Intended to be passed as the progress_callback of long running functions.
+
+        :param processed: Number of items processed so far.
+        :type processed: int
+        :param total: Total number of items to process.
+        :type total: int
+        :param partial_result: Optional intermediate result (i.e. a low resolution preview) to display until the job
+            is done.
+        """
+        if self._cancel_event.is_set():
+            raise JobCancelledError(f'Job {self.id} was cancelled.')
+        self.processed = int(processed)
+        self.total = int(total)
+        if partial_result is not None:
+            self.set_result(partial_result)
+
+    def set_result(self, result):
+        """
+        Set the current result of the job and increment result_version so that pollers can tell it has changed.
+
+        :param result: Result of the job.
+        """
+        self.result = result
+        self.result_version += 1
+
+    def cancel(self):
+        """
+        Request cancellation of the job. The job stops the next time it reports progress.
+        """
+        self._cancel_event.set()
+        if self.status == 'pending':
+            self.status = 'cancelled'
+
+    def is_cancelled(self):
+        """
+        Check whether cancellation of the job has been requested.
+
+        :return: True if the job has been cancelled.
+        :rtype: bool
+        """
+        return self._cancel_event.is_set()
+
+    def is_finished(self):
+        """
+        Check whether the job is no longer pending or running.
+
+        :return: True if the job has completed, failed, or been cancelled.
+        :rtype: bool
+        """
+        return self.status in ['done', 'failed', 'cancelled']
+
+    def get_progress(self):
+        """
+        Get the progress of the job as a percentage.
+
+        :return: Progress between 0 and 100.
+        :rtype: float
+        """
+        if self.status == 'done':
+            return 100.0
+        if self.total <= 0:
+            return 0.0
+        return 100.0 * self.processed / self.total
+
+
+class JobRunner(object):
+    """
+    Runs long calculations on background threads so that Dash callbacks can return immediately and poll for progress.
+    Only the most recent jobs are kept once they have finished.
+
+    :param max_workers: Number of jobs that can run concurrently.
+    :type max_workers: int
+    """
+    def __init__(self, max_workers=1):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, name, func, *args, description='', **kwargs):
+        """
+        Submit a job. func is called with the keyword argument progress_callback set to the job's report_progress()
+        method in addition to args and kwargs, and its return value is stored as the result of the job.
+
+        :param name: Name of the job.
+        :type name: str
+        :param func: Function to run in the background.
+        :type func: function
+        :param description: Human readable description shown next to the progress bar.
+        :type description: str
+        :return: Submitted job.
+        :rtype: TSFImagingDataViewer.jobs.Job
+        """
+        job = Job(name, description)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+        self._executor.submit(self._run, job, func, args, kwargs)
+        return job
+
+    def _run(self, job, func, args, kwargs):
+        if job.is_cancelled():
+            job.status = 'cancelled'
+            return
+        job.status = 'running'
+        try:
+            job.set_result(func(*args, progress_callback=job.report_progress, **kwargs))
+            job.status = 'done'
+        except JobCancelledError:
+            job.status = 'cancelled'
+        except Exception as error:
+            job.error = error
+            job.status = 'failed'
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.is_finished()]
+        for job_id in finished[:max(0, len(self._jobs) - JOB_HISTORY_SIZE)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        """
+        Get a job by ID.
+
+        :param job_id: Job ID.
+        :type job_id: str
+        :return: Job or None if no job with the ID exists.
+        :rtype: TSFImagingDataViewer.jobs.Job | None
+        """
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """
+        Request cancellation of a job.
+
+        :param job_id: Job ID.
+        :type job_id: str
+        :return: True if a job with the ID exists.
+        :rtype: bool
+        """
+        job = self.get(job_id)
+        if job is None:
+            return False
+        job.cancel()
+        return True
+
+    def cancel_all(self):
+        """
+        Request cancellation of every pending or running job.
+        """
+        with self._lock:
+            for job in self._jobs.values():
+                if not job.is_finished():
+                    job.cancel()
+
+    def shutdown(self):
+        """
+        Cancel every job and stop the background threads.
+        """
+        self.cancel_all()
+        self._executor.shutdown(wait=False, cancel_futures=True)
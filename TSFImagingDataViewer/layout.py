@@ -9,15 +9,82 @@ import dash_bootstrap_components as dbc
 from TSFImagingDataViewer.util import blank_figure
 
 
-def get_dashboard_layout():
+def get_dashboard_layout(datasets=None):
     """
     Get the dashboard layout for TSFImagingDataViewer.
 
+    :param datasets: Datasets that can be loaded in server mode, relative to the data directory of the server. If None,
+        datasets are chosen with a directory dialog instead and the dataset dropdown is hidden.
+    :type datasets: list[str] | None
     :return: Dash dashboard layout
     :rtype: html.Div
     """
     dashboard_layout = html.Div(
         [
+            # Progress of background jobs is kept outside of dcc.Loading so that polling does not show the spinner.
+            dbc.Row(
+                [
+                    dbc.Col(
+                        dbc.Progress(
+                            id='job_progress',
+                            value=0,
+                            label='',
+                            striped=True,
+                            style={'margin': '20px',
+                                   'height': '20px'}
+                        ),
+                        width={'size': 6, 'offset': 1}
+                    ),
+                    dbc.Col(
+                        html.Div(
+                            '',
+                            id='job_status',
+                            style={'margin': '20px'}
+                        ),
+                        width=3
+                    ),
+                    dbc.Col(
+                        dbc.Button(
+                            'Cancel',
+                            id='cancel_job',
+                            color='secondary',
+                            style={'margin': '10px',
+                                   'display': 'flex',
+                                   'justify-content': 'center',
+                                   'width': '95%'},
+                            disabled=True
+                        ),
+                        width=1
+                    ),
+                    dcc.Interval(
+                        id='job_interval',
+                        interval=500,
+                        disabled=True
+                    ),
+                    dcc.Store(id='job_id'),
+                    dcc.Store(id='job_result'),
+                    # The session ID is kept in the browser tab's session storage so that reloading the page reuses
+                    # the same session. It is created by the register_session callback on the first page load.
+                    dcc.Store(id='session_id', storage_type='session')
+                ]
+            ),
+            # In server mode, datasets are chosen from the data directory of the server instead of a directory dialog,
+            # which would open on the server.
+            dbc.Row(
+                [
+                    dbc.Col(
+                        dcc.Dropdown(
+                            id='dot_d_path',
+                            options=[] if datasets is None else datasets,
+                            placeholder='Select a Bruker *.d directory',
+                            style={'margin-top': '20px'}
+                        ),
+                        width={'size': 6, 'offset': 3}
+                    )
+                ],
+                id='dot_d_path_group',
+                style={'display': 'none' if datasets is None else 'flex'}
+            ),
             dcc.Loading(
                 [
                     dbc.Row(
@@ -72,12 +139,44 @@ def get_dashboard_layout():
                             )
                         ]
                     ),
+                    dbc.Row(
+                        [
+                            dbc.Col(
+                                dbc.InputGroup(
+                                    [
+                                        dbc.InputGroupText('m/z Bin Width'),
+                                        dbc.Input(
+                                            id='mz_bin_width',
+                                            placeholder='0 (no binning)',
+                                            value=0,
+                                            type='number',
+                                            min=0,
+                                            max=1000000,
+                                            step=0.00001
+                                        ),
+                                        dbc.Select(
+                                            id='mz_bin_unit',
+                                            options=[{'label': 'Da', 'value': 'Da'},
+                                                     {'label': 'ppm', 'value': 'ppm'}],
+                                            value='Da'
+                                        )
+                                    ],
+                                    id='mz_bin_group',
+                                    style={'margin': '20px',
+                                           'display': 'flex',
+                                           'width': '95%'}
+                                ),
+                                width={'size': 4, 'offset': 3}
+                            )
+                        ]
+                    ),
                     dbc.Row(
                         [
                             dbc.Col(
                                 dcc.Graph(
                                     id='ion_image',
                                     figure=blank_figure(),
+                                    config={'modeBarButtonsToAdd': ['select2d', 'lasso2d']},
                                     style={'width': '95%'}
                                 ),
                                 width=12
@@ -106,7 +205,7 @@ def get_dashboard_layout():
                                            'display': 'flex',
                                            'width': '95%'}
                                 ),
-                                width={'size': 2, 'offset': 2}
+                                width={'size': 2, 'offset': 1}
                             ),
                             dbc.Col(
                                 dbc.InputGroup(
@@ -149,6 +248,65 @@ def get_dashboard_layout():
                                     disabled=True
                                 ),
                                 width=2
+                            ),
+                            dbc.Col(
+                                dbc.Checklist(
+                                    id='ion_image_options',
+                                    options=[{'label': 'Use Datacube Cache', 'value': 'datacube'},
+                                             {'label': 'Use Centroid m/z Index', 'value': 'centroid_index'},
+                                             {'label': 'Progressive Ion Images', 'value': 'progressive'}],
+                                    value=['progressive'],
+                                    switch=True,
+                                    style={'margin': '20px'}
+                                ),
+                                width=2
+                            )
+                        ]
+                    ),
+                    dbc.Row(
+                        [
+                            dbc.Col(
+                                dbc.InputGroup(
+                                    [
+                                        dbc.InputGroupText('Multi-Channel m/z'),
+                                        dbc.Textarea(
+                                            id='ion_image_targets',
+                                            placeholder='One m/z per line (m/z, tolerance, Da/ppm)',
+                                            value='',
+                                            rows=3,
+                                            disabled=True
+                                        )
+                                    ],
+                                    id='ion_image_targets_group',
+                                    style={'margin': '20px',
+                                           'display': 'flex',
+                                           'width': '95%'}
+                                ),
+                                width={'size': 5, 'offset': 1}
+                            ),
+                            dbc.Col(
+                                dbc.Select(
+                                    id='ion_image_mode',
+                                    options=[{'label': 'Panels', 'value': 'panels'},
+                                             {'label': 'RGB Overlay', 'value': 'rgb'}],
+                                    value='panels',
+                                    style={'margin': '20px',
+                                           'width': '95%'},
+                                    disabled=True
+                                ),
+                                width=2
+                            ),
+                            dbc.Col(
+                                dbc.Button(
+                                    'Update Multi-Channel Ion Image',
+                                    id='update_multichannel_ion_image',
+                                    style={'margin': '20px',
+                                           'display': 'flex',
+                                           'justify-content': 'center',
+                                           'width': '95%'},
+                                    disabled=True
+                                ),
+                                width=3
                             )
                         ]
                     ),
@@ -254,13 +412,17 @@ def get_dashboard_layout():
                             dbc.ModalHeader(
                                 dbc.ModalTitle('Error')
                             ),
-                            dbc.ModalBody('The selected *.d directory does not contain TSF format data.')
+                            dbc.ModalBody(
+                                'The selected *.d directory does not contain TSF format data.',
+                                id='load_tsf_error_message'
+                            )
                         ],
                         id='load_tsf_error_modal',
                         centered=True,
                         is_open=False
                     ),
                     dcc.Store(id='store_plot'),
+                    dcc.Store(id='store_ion_image'),
                     dcc.Store(id='dot_d_directory', data='')
                 ],
                 delay_hide=0,
@@ -0,0 +1,251 @@
+import time
+import json
+import bisect
+import logging
+import threading
+import functools
+from logging.handlers import RotatingFileHandler
+
+METRICS_PREFIX = 'tsfimagingdataviewer'
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+METRICS_LOG_MAX_BYTES = 10 * 1024 ** 2
+METRICS_LOG_BACKUP_COUNT = 5
+METRICS_LOGGER = logging.getLogger('TSFImagingDataViewer.metrics')
+
+
+class Histogram(object):
+    """
+    Cumulative histogram of observed values with fixed bucket upper bounds.
+
+    :param buckets: Sorted bucket upper bounds. An implicit +Inf bucket is always included.
+    :type buckets: tuple[float]
+    """
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """
+        Add a value to the histogram.
+
+        :param value: Observed value.
+        :type value: float
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get_cumulative_counts(self):
+        """
+        Get the number of observations less than or equal to each bucket upper bound, including +Inf.
+
+        :return: List of cumulative counts.
+        :rtype: list[int]
+        """
+        cumulative_counts = []
+        total = 0
+        for count in self.counts:
+            total += count
+            cumulative_counts.append(total)
+        return cumulative_counts
+
+
+class MetricsRegistry(object):
+    """
+    Thread-safe registry of labelled counters and histograms. Metrics only cover the current process; work done in
+    worker processes is counted through the number of frames reduced per chunk.
+
+    :param buckets: Bucket upper bounds used for every histogram.
+    :type buckets: tuple[float]
+    """
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increment a counter.
+
+        :param name: Name of the counter.
+        :type name: str
+        :param value: Amount to increment the counter by.
+        :type value: int | float
+        :param labels: Labels identifying the time series (i.e. cache='spectrum').
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """
+        Add a value to a histogram.
+
+        :param name: Name of the histogram.
+        :type name: str
+        :param value: Observed value.
+        :type value: float
+        :param labels: Labels identifying the time series (i.e. function='util.read_spectrum').
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def get_counter(self, name, **labels):
+        """
+        Get the current value of a counter.
+
+        :param name: Name of the counter.
+        :type name: str
+        :param labels: Labels identifying the time series.
+        :return: Value of the counter, or 0 if it has not been incremented.
+        :rtype: int | float
+        """
+        with self._lock:
+            return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def reset(self):
+        """
+        Remove every counter and histogram.
+        """
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def to_dict(self):
+        """
+        Get every metric as a JSON serializable dictionary.
+
+        :return: Dictionary containing lists of counters and histograms.
+        :rtype: dict
+        """
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self._counters.items())]
+            histograms = [{'name': name,
+                           'labels': dict(labels),
+                           'buckets': list(histogram.buckets) + ['+Inf'],
+                           'cumulative_counts': histogram.get_cumulative_counts(),
+                           'sum': histogram.sum,
+                           'count': histogram.count,
+                           'mean': histogram.sum / histogram.count if histogram.count else 0.0}
+                          for (name, labels), histogram in sorted(self._histograms.items())]
+        return {'counters': counters, 'histograms': histograms}
+
+    def to_prometheus(self):
+        """
+        Get every metric in the Prometheus text exposition format.
+
+        :return: Metrics as text.
+        :rtype: str
+        """
+        def format_labels(labels):
+            if not labels:
+                return ''
+            return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+        lines = []
+        with self._lock:
+            typed_names = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                metric_name = f'{METRICS_PREFIX}_{name}'
+                if metric_name not in typed_names:
+                    lines.append(f'# TYPE {metric_name} counter')
+                    typed_names.add(metric_name)
+                lines.append(f'{metric_name}{format_labels(labels)} {value}')
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                metric_name = f'{METRICS_PREFIX}_{name}'
+                if metric_name not in typed_names:
+                    lines.append(f'# TYPE {metric_name} histogram')
+                    typed_names.add(metric_name)
+                bucket_bounds = [str(bucket) for bucket in histogram.buckets] + ['+Inf']
+                for bucket_bound, count in zip(bucket_bounds, histogram.get_cumulative_counts()):
+                    lines.append(f'{metric_name}_bucket{format_labels(labels + (("le", bucket_bound),))} {count}')
+                lines.append(f'{metric_name}_sum{format_labels(labels)} {histogram.sum}')
+                lines.append(f'{metric_name}_count{format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = MetricsRegistry()
+
+
+def timed(name=None):
+    """
+    Decorator that records the wall time of every call of a function in the 'duration_seconds' histogram and the
+    number of calls that raised an exception in the 'errors_total' counter, both labelled with the function name. If a
+    metrics log is enabled, every call is also written to it.
+
+    :param name: Name used to label the metrics. Defaults to '<module>.<function>'.
+    :type name: str | None
+    :return: Decorator.
+    :rtype: function
+    """
+    def decorator(func):
+        function_name = name if name is not None else f'{func.__module__.rsplit(".", 1)[-1]}.{func.__name__}'
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            error = None
+            try:
+                return func(*args, **kwargs)
+            except BaseException as exception:
+                error = type(exception).__name__
+                raise
+            finally:
+                duration = time.perf_counter() - start
+                METRICS.observe('duration_seconds', duration, function=function_name)
+                if error is not None:
+                    METRICS.inc('errors_total', function=function_name)
+                if METRICS_LOGGER.handlers:
+                    METRICS_LOGGER.info(json.dumps({'time': time.time(),
+                                                    'function': function_name,
+                                                    'duration': duration,
+                                                    'error': error}))
+        return wrapper
+    return decorator
+
+
+def enable_metrics_log(path, max_bytes=METRICS_LOG_MAX_BYTES, backup_count=METRICS_LOG_BACKUP_COUNT):
+    """
+    Write one JSON line per timed call to a rotating log file.
+
+    :param path: Path to the log file.
+    :type path: str
+    :param max_bytes: Maximum size of the log file before it is rotated.
+    :type max_bytes: int
+    :param backup_count: Number of rotated log files to keep.
+    :type backup_count: int
+    """
+    handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    METRICS_LOGGER.addHandler(handler)
+    METRICS_LOGGER.setLevel(logging.INFO)
+    METRICS_LOGGER.propagate = False
+
+
+def register_metrics_routes(server, registry=METRICS):
+    """
+    Add the /metrics (Prometheus text format) and /metrics.json routes to a Flask server.
+
+    :param server: Flask server (i.e. app.server of a Dash app).
+    :type server: flask.Flask
+    :param registry: Metrics registry to expose.
+    :type registry: TSFImagingDataViewer.metrics.MetricsRegistry
+    """
+    # Imported here so that the startup timing in TSFImagingDataViewer.py can use this module before Flask is loaded.
+    from flask import Response, jsonify
+
+    @server.route('/metrics')
+    def get_metrics():
+        return Response(registry.to_prometheus(), mimetype='text/plain; version=0.0.4')
+
+    @server.route('/metrics.json')
+    def get_metrics_json():
+        return jsonify(registry.to_dict())
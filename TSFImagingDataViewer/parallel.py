@@ -0,0 +1,179 @@
+import os
+import multiprocessing
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from pyTDFSDK.classes import TsfData
+from pyTDFSDK.init_tdf_sdk import init_tdf_sdk_api
+from TSFImagingDataViewer.metrics import METRICS
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+DEFAULT_CHUNK_SIZE = 512
+# Worker processes are spawned rather than forked. The viewer runs job, prefetch, and server threads that hold locks
+# (i.e. SDK and metrics locks), and a forked worker would inherit any lock held at the time of the fork in its held
+# state and deadlock on its first use.
+WORKER_START_METHOD = 'spawn'
+WORKER_DATA = None
+
+
+def get_frame_chunks(frame_ids, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Split a list of frame IDs into contiguous chunks.
+
+    :param frame_ids: List of frame IDs.
+    :type frame_ids: numpy.array | list[int]
+    :param chunk_size: Maximum number of frames per chunk.
+    :type chunk_size: int
+    :return: List of chunks of frame IDs.
+    :rtype: list
+    """
+    chunk_size = max(1, int(chunk_size))
+    return [frame_ids[i:i + chunk_size] for i in range(0, len(frame_ids), chunk_size)]
+
+
+def init_worker(bruker_dot_d_file):
+    """
+    Open a TSF dataset handle for the current worker process.
+
+    :param bruker_dot_d_file: Path to the .d directory of interest.
+    :type bruker_dot_d_file: str
+    """
+    global WORKER_DATA
+    WORKER_DATA = TsfData(bruker_dot_d_file, init_tdf_sdk_api())
+
+
+def reduce_chunk_in_worker(reducer, frame_ids, reducer_args):
+    """
+    Reduce a chunk of frames using the TSF dataset handle opened by init_worker().
+
+    :param reducer: Function with the signature reducer(data, frame_ids, *reducer_args).
+    :type reducer: function
+    :param frame_ids: Chunk of frame IDs.
+    :type frame_ids: numpy.array | list[int]
+    :param reducer_args: Additional arguments passed to the reducer.
+    :type reducer_args: tuple
+    :return: Partial result returned by the reducer.
+    """
+    return reducer(WORKER_DATA, frame_ids, *reducer_args)
+
+
+def create_worker_pool(bruker_dot_d_file, workers):
+    """
+    Create a process pool in which every worker opens its own handle to a TSF dataset.
+
+    :param bruker_dot_d_file: Path to the .d directory of interest.
+    :type bruker_dot_d_file: str
+    :param workers: Number of worker processes.
+    :type workers: int
+    :return: Process pool.
+    :rtype: concurrent.futures.ProcessPoolExecutor
+    """
+    return ProcessPoolExecutor(max_workers=workers,
+                               mp_context=multiprocessing.get_context(WORKER_START_METHOD),
+                               initializer=init_worker,
+                               initargs=(bruker_dot_d_file,))
+
+
+@contextmanager
+def worker_pool(data, workers):
+    """
+    Context manager providing a process pool that can be shared by several calls of iter_frame_chunks(), i.e. by every
+    pass of a job, so that worker processes are only started once. Provides None if workers is 1 or less.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param workers: Number of worker processes.
+    :type workers: int
+    :return: Process pool or None.
+    """
+    if int(workers) <= 1:
+        yield None
+        return
+    executor = create_worker_pool(data.source_file, int(workers))
+    try:
+        yield executor
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def iter_frame_chunks(data, frame_ids, reducer, reducer_args=(), workers=1, chunk_size=DEFAULT_CHUNK_SIZE,
+                      max_pending=None, pool=None):
+    """
+    Split frame IDs into contiguous chunks and reduce each chunk to a partial result, either in the current process or
+    in a process pool in which every worker opens its own handle to the dataset. Partial results are always yielded in
+    chunk order, so merging them gives the same result regardless of the number of workers.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param frame_ids: List of frame IDs to process.
+    :type frame_ids: numpy.array | list[int]
+    :param reducer: Picklable module level function with the signature reducer(data, frame_ids, *reducer_args).
+    :type reducer: function
+    :param reducer_args: Additional arguments passed to the reducer.
+    :type reducer_args: tuple
+    :param workers: Number of worker processes. If 1, chunks are reduced in the current process.
+    :type workers: int
+    :param chunk_size: Maximum number of frames per chunk.
+    :type chunk_size: int
+    :param max_pending: Maximum number of chunks submitted to the process pool that have not been yielded yet. Bounds
+        the memory used by partial results when they are large and consumed slowly. Defaults to no limit.
+    :type max_pending: int | None
+    :param pool: Optional process pool from worker_pool() to use instead of starting a new one. The pool is not shut
+        down when the generator finishes.
+    :type pool: concurrent.futures.ProcessPoolExecutor | None
+    :return: Generator yielding partial results in chunk order.
+    """
+    chunks = get_frame_chunks(frame_ids, chunk_size)
+    workers = min(int(workers), len(chunks))
+    if workers <= 1:
+        for chunk in chunks:
+            partial = reducer(data, chunk, *reducer_args)
+            METRICS.inc('frames_reduced_total', len(chunk), reducer=reducer.__name__)
+            yield partial
+    else:
+        if max_pending is None:
+            max_pending = len(chunks)
+        max_pending = max(int(max_pending), workers)
+        executor = create_worker_pool(data.source_file, workers) if pool is None else pool
+        pending = deque()
+        try:
+            for position, chunk in enumerate(chunks):
+                pending.append((chunk, executor.submit(reduce_chunk_in_worker, reducer, chunk, reducer_args)))
+                # Results are waited for once max_pending chunks are in flight or every chunk has been submitted.
+                while pending and (len(pending) >= max_pending or position == len(chunks) - 1):
+                    done_chunk, future = pending.popleft()
+                    partial = future.result()
+                    METRICS.inc('frames_reduced_total', len(done_chunk), reducer=reducer.__name__)
+                    yield partial
+        finally:
+            # Chunks that have not started yet are cancelled if the caller stops consuming results early.
+            if pool is None:
+                executor.shutdown(wait=True, cancel_futures=True)
+            else:
+                for done_chunk, future in pending:
+                    future.cancel()
+
+
+def map_frame_chunks(data, frame_ids, reducer, reducer_args=(), workers=1, chunk_size=DEFAULT_CHUNK_SIZE, pool=None):
+    """
+    Reduce every chunk of frames with iter_frame_chunks() and collect the partial results.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param frame_ids: List of frame IDs to process.
+    :type frame_ids: numpy.array | list[int]
+    :param reducer: Picklable module level function with the signature reducer(data, frame_ids, *reducer_args).
+    :type reducer: function
+    :param reducer_args: Additional arguments passed to the reducer.
+    :type reducer_args: tuple
+    :param workers: Number of worker processes. If 1, chunks are reduced in the current process.
+    :type workers: int
+    :param chunk_size: Maximum number of frames per chunk.
+    :type chunk_size: int
+    :param pool: Optional process pool from worker_pool().
+    :type pool: concurrent.futures.ProcessPoolExecutor | None
+    :return: List of partial results in chunk order.
+    :rtype: list
+    """
+    return list(iter_frame_chunks(data, frame_ids, reducer, reducer_args, workers=workers, chunk_size=chunk_size,
+                                  pool=pool))
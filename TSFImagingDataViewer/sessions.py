@@ -0,0 +1,293 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from pyTDFSDK.classes import TsfData
+from pyTDFSDK.init_tdf_sdk import init_tdf_sdk_api
+from TSFImagingDataViewer.cache import ResultCache, SpectrumCache
+from TSFImagingDataViewer.metrics import METRICS
+from TSFImagingDataViewer.util import get_dataset_metadata, get_pixel_index
+
+DATASET_POOL_SIZE = 8
+DATASET_IDLE_TIMEOUT = 10 * 60
+SESSION_TIMEOUT = 60 * 60
+
+
+class DatasetPoolFullError(Exception):
+    """
+    Raised when a dataset cannot be opened because every handle in the pool is in use.
+    """
+    pass
+
+
+class DatasetHandle(object):
+    """
+    Open TSF dataset shared by every session and job using it, along with its per-dataset caches. The handle is opened
+    lazily by its own lock so that opening one dataset does not block sessions using other datasets.
+
+    :param path: Path to the .d directory.
+    :type path: str
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+        self.result_cache = None
+        self.metadata = None
+        self.pixel_index = None
+        self.spectrum_cache = None
+        self.refcount = 0
+        self.last_used = time.monotonic()
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def open(self):
+        """
+        Open the dataset and build its metadata, pixel index, and caches if they have not been built yet.
+        """
+        with self._lock:
+            if self.data is not None:
+                return
+            data = TsfData(self.path, init_tdf_sdk_api())
+            self.result_cache = ResultCache(self.path)
+            self.metadata = get_dataset_metadata(data, self.result_cache)
+            self.pixel_index = get_pixel_index(data)
+            self.spectrum_cache = SpectrumCache(data, self.pixel_index)
+            self.data = data
+            METRICS.inc('dataset_handles_opened_total')
+
+    def close(self):
+        """
+        Stop the spectrum cache and drop the references to the dataset. The SDK handle is released once the last job
+        using the dataset has finished.
+        """
+        with self._lock:
+            self.closed = True
+            if self.spectrum_cache is not None:
+                self.spectrum_cache.close()
+            self.data = None
+            self.result_cache = None
+            self.metadata = None
+            self.pixel_index = None
+            self.spectrum_cache = None
+
+
+class DatasetPool(object):
+    """
+    Bounded pool of open dataset handles keyed by path. Handles are reference counted; a handle that is no longer
+    referenced is kept open for idle_timeout seconds in case it is reopened, and is closed earlier if its slot is
+    needed for another dataset.
+
+    :param max_handles: Maximum number of open handles.
+    :type max_handles: int
+    :param idle_timeout: Number of seconds an unreferenced handle is kept open.
+    :type idle_timeout: float
+    """
+    def __init__(self, max_handles=DATASET_POOL_SIZE, idle_timeout=DATASET_IDLE_TIMEOUT):
+        self.max_handles = max_handles
+        self.idle_timeout = idle_timeout
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, path):
+        """
+        Get a reference to the handle of a dataset, opening it if needed. Every call must be paired with release().
+
+        :param path: Path to the .d directory.
+        :type path: str
+        :return: Open dataset handle.
+        :rtype: TSFImagingDataViewer.sessions.DatasetHandle
+        """
+        path = os.path.normpath(os.path.abspath(path))
+        with self._lock:
+            evicted = self._evict(1 if path not in self._handles else 0)
+            handle = self._handles.get(path)
+            if handle is None:
+                if len(self._handles) >= self.max_handles:
+                    self._close_handles(evicted)
+                    raise DatasetPoolFullError(f'All {self.max_handles} dataset handles are in use.')
+                handle = self._handles[path] = DatasetHandle(path)
+            handle.refcount += 1
+            self._handles.move_to_end(path)
+        self._close_handles(evicted)
+        try:
+            handle.open()
+        except BaseException:
+            with self._lock:
+                handle.refcount -= 1
+                if handle.refcount == 0 and self._handles.get(path) is handle:
+                    del self._handles[path]
+            raise
+        return handle
+
+    def retain(self, handle):
+        """
+        Add a reference to a handle that is already referenced elsewhere, i.e. for the duration of a job.
+
+        :param handle: Dataset handle.
+        :type handle: TSFImagingDataViewer.sessions.DatasetHandle
+        :return: False if the handle has already been closed.
+        :rtype: bool
+        """
+        with self._lock:
+            if handle.closed:
+                return False
+            handle.refcount += 1
+            return True
+
+    def release(self, handle):
+        """
+        Remove a reference to a handle. Unreferenced handles that have been idle for longer than idle_timeout are
+        closed.
+
+        :param handle: Dataset handle.
+        :type handle: TSFImagingDataViewer.sessions.DatasetHandle
+        """
+        with self._lock:
+            handle.refcount -= 1
+            handle.last_used = time.monotonic()
+            evicted = self._evict(0)
+        self._close_handles(evicted)
+
+    def _evict(self, n_slots):
+        # Called with the lock held. Handles are closed by the caller once the lock has been released.
+        now = time.monotonic()
+        evicted = []
+        for path, handle in list(self._handles.items()):
+            if handle.refcount > 0:
+                continue
+            if len(self._handles) + n_slots > self.max_handles or now - handle.last_used > self.idle_timeout:
+                del self._handles[path]
+                evicted.append(handle)
+        return evicted
+
+    def _close_handles(self, handles):
+        for handle in handles:
+            handle.close()
+            METRICS.inc('dataset_handles_evicted_total')
+
+    def close(self):
+        """
+        Close every handle in the pool.
+        """
+        with self._lock:
+            handles = list(self._handles.values())
+            self._handles.clear()
+        self._close_handles(handles)
+
+
+class Session(object):
+    """
+    State of one browser session.
+
+    :param session_id: Session ID.
+    :type session_id: str
+    """
+    def __init__(self, session_id):
+        self.id = session_id
+        self.handle = None
+        self.last_used = time.monotonic()
+
+
+class SessionRegistry(object):
+    """
+    Maps browser sessions to the dataset handle each of them has loaded, so that several users of the same server can
+    view different datasets. Sessions that have not been used for timeout seconds are removed and their handles
+    released.
+
+    :param pool: Pool used to open datasets.
+    :type pool: TSFImagingDataViewer.sessions.DatasetPool
+    :param timeout: Number of seconds after which an unused session is removed.
+    :type timeout: float
+    """
+    def __init__(self, pool, timeout=SESSION_TIMEOUT):
+        self.pool = pool
+        self.timeout = timeout
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get_handle(self, session_id):
+        """
+        Get the dataset handle loaded by a session.
+
+        :param session_id: Session ID.
+        :type session_id: str
+        :return: Dataset handle or None if the session has not loaded a dataset.
+        :rtype: TSFImagingDataViewer.sessions.DatasetHandle | None
+        """
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            session.last_used = time.monotonic()
+            return session.handle
+
+    def register(self, session_id):
+        """
+        Register a session when its page is loaded. If the session already exists (i.e. the page was reloaded), the
+        dataset it had loaded is released, since the reloaded page starts without a dataset.
+
+        :param session_id: Session ID.
+        :type session_id: str
+        """
+        self.expire()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            previous_handle = None if session is None else session.handle
+            self._sessions[session_id] = Session(session_id)
+        if previous_handle is not None:
+            self.pool.release(previous_handle)
+
+    def open_dataset(self, session_id, path):
+        """
+        Load a dataset in a session, releasing the dataset previously loaded by the session. If the pool is full, the
+        session keeps its previous dataset.
+
+        :param session_id: Session ID.
+        :type session_id: str
+        :param path: Path to the .d directory.
+        :type path: str
+        :return: Dataset handle.
+        :rtype: TSFImagingDataViewer.sessions.DatasetHandle
+        """
+        self.expire()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = Session(session_id)
+            previous_handle = session.handle
+            session.handle = None
+            session.last_used = time.monotonic()
+        # The previous dataset is released first so that its slot can be reused if the pool is full.
+        if previous_handle is not None:
+            self.pool.release(previous_handle)
+        try:
+            handle = self.pool.acquire(path)
+        except DatasetPoolFullError:
+            if previous_handle is not None:
+                session.handle = self.pool.acquire(previous_handle.path)
+            raise
+        session.handle = handle
+        return handle
+
+    def close_session(self, session_id):
+        """
+        Remove a session and release its dataset handle.
+
+        :param session_id: Session ID.
+        :type session_id: str
+        """
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is not None and session.handle is not None:
+            self.pool.release(session.handle)
+
+    def expire(self):
+        """
+        Remove every session that has not been used for timeout seconds.
+        """
+        now = time.monotonic()
+        with self._lock:
+            expired = [session_id for session_id, session in self._sessions.items()
+                       if now - session.last_used > self.timeout]
+        for session_id in expired:
+            self.close_session(session_id)
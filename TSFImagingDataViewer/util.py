@@ -7,32 +7,410 @@
 
 import os
 import copy
+import json
+import weakref
+import tempfile
+import threading
 import numpy as np
-import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly_resampler import FigureResampler
+from plotly_resampler.aggregation import MinMaxLTTB, MinMaxAggregator, MinMaxOverlapAggregator, LTTB, EveryNthPoint
 from pyTDFSDK.classes import TsfSpectrum
+from TSFImagingDataViewer.metrics import METRICS, timed
+from TSFImagingDataViewer.parallel import iter_frame_chunks, map_frame_chunks, worker_pool, DEFAULT_CHUNK_SIZE
+
+SCHEMA_EXTENSIONS = {'.tdf': 'TDF', '.tsf': 'TSF', '.baf': 'BAF'}
+DATASET_LISTING_MAX_DEPTH = 4
+DATASET_METADATA = weakref.WeakKeyDictionary()
+PIXEL_INDICES = weakref.WeakKeyDictionary()
+# One lock per dataset: calls on the same SDK handle are serialized while different datasets are read concurrently.
+SDK_LOCKS = weakref.WeakKeyDictionary()
+SDK_LOCKS_LOCK = threading.Lock()
+AVERAGE_CHECKPOINT_FILENAME = 'average_checkpoint.npz'
+AVERAGE_CHECKPOINT_INTERVAL = 4096
+PROGRESSIVE_STRIDES = (4, 2, 1)
+SPECTRUM_DOWNSAMPLERS = {'MinMaxLTTB': MinMaxLTTB,
+                         'MinMaxAggregator': MinMaxAggregator,
+                         'MinMaxOverlapAggregator': MinMaxOverlapAggregator,
+                         'LTTB': LTTB,
+                         'EveryNthPoint': EveryNthPoint}
+DEFAULT_SPECTRUM_DOWNSAMPLER = 'MinMaxLTTB'
+DEFAULT_SPECTRUM_N_SHOWN_SAMPLES = 1000
+IMAGE_TILE_SIZE = 128
+IMAGE_MAX_VIEW_SIZE = 384
 
 
 # Copied from TIMSCONVERT.
 def schema_detection(bruker_dot_d_file):
     """
-    Detect the schema used by the raw data in the Bruker .d directory.
+    Detect the schema used by the raw data in the Bruker .d directory. Only the top level of the directory is listed
+    and the first analysis file found (i.e. analysis.tsf) decides the schema, so subdirectories on slow network shares
+    are never traversed.
 
     :param bruker_dot_d_file: Path to the .d directory of interest.
     :type: str
-    :return: Capitalized schema extension (TDF, TSF, or BAF).
+    :return: Capitalized schema extension (TDF, TSF, or BAF), or None if no analysis file is found.
+    :rtype: str | None
+    """
+    with os.scandir(bruker_dot_d_file) as entries:
+        for entry in entries:
+            schema = SCHEMA_EXTENSIONS.get(os.path.splitext(entry.name)[1].lower())
+            if schema is not None and entry.is_file():
+                return schema
+    return None
+
+
+def list_datasets(data_dir, max_depth=DATASET_LISTING_MAX_DEPTH):
+    """
+    List the Bruker .d directories within a data directory. .d directories are not traversed, and neither are
+    directories more than max_depth levels below the data directory, so that large shares are listed quickly.
+
+    :param data_dir: Path to the data directory.
+    :type data_dir: str
+    :param max_depth: Maximum number of directory levels below the data directory that are listed.
+    :type max_depth: int
+    :return: Sorted list of paths to .d directories relative to the data directory.
+    :rtype: list[str]
+    """
+    datasets = []
+    for dirpath, dirnames, filenames in os.walk(data_dir):
+        depth = os.path.relpath(dirpath, data_dir).count(os.sep) + 1 if dirpath != data_dir else 0
+        for dirname in [dirname for dirname in dirnames if dirname.endswith('.d')]:
+            datasets.append(os.path.relpath(os.path.join(dirpath, dirname), data_dir))
+            dirnames.remove(dirname)
+        if depth >= max_depth:
+            dirnames.clear()
+    return sorted(datasets)
+
+
+def resolve_dataset_path(data_dir, dataset):
+    """
+    Get the path to a dataset listed by list_datasets(). Paths that resolve to a location outside of the data directory
+    are rejected.
+
+    :param data_dir: Path to the data directory.
+    :type data_dir: str
+    :param dataset: Path to the .d directory relative to the data directory.
+    :type dataset: str
+    :return: Absolute path to the .d directory or None if it is outside of the data directory.
+    :rtype: str | None
+    """
+    if not dataset:
+        return None
+    # Symbolic links within the data directory are followed, but '..' and absolute paths cannot leave it.
+    data_dir = os.path.normpath(os.path.abspath(data_dir))
+    path = os.path.normpath(os.path.join(data_dir, dataset))
+    if path == data_dir or os.path.commonpath([data_dir, path]) != data_dir:
+        return None
+    return path
+
+
+def get_sdk_lock(data):
+    """
+    Get the lock used to serialize SDK calls on a dataset.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :return: Lock of the dataset.
+    :rtype: threading.RLock
+    """
+    with SDK_LOCKS_LOCK:
+        lock = SDK_LOCKS.get(data)
+        if lock is None:
+            lock = SDK_LOCKS[data] = threading.RLock()
+        return lock
+
+
+def read_spectrum(data, frame, mode='profile'):
+    """
+    Read a spectrum from a TSF dataset. Reads of the same dataset are serialized so that it can be shared between
+    threads. Only the number of frames and bytes read are counted, since timing every frame would add a histogram
+    sample and a metrics log line per frame; reads are timed by the functions calling this one.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param frame: Frame ID.
+    :type frame: int
+    :param mode: Spectrum mode to read ('profile' or 'centroid').
+    :type mode: str
+    :return: Spectrum object.
+    :rtype: pyTDFSDK.classes.TsfSpectrum
+    """
+    with get_sdk_lock(data):
+        spectrum = TsfSpectrum(data, frame=int(frame), mode=mode)
+    METRICS.inc('frames_read_total', mode=mode)
+    METRICS.inc('bytes_decoded_total', spectrum.mz_array.nbytes + spectrum.intensity_array.nbytes, mode=mode)
+    return spectrum
+
+
+def get_dataset_fingerprint(bruker_dot_d_file):
+    """
+    Get a fingerprint of the raw data in a Bruker .d directory used to detect when cached results are stale.
+
+    :param bruker_dot_d_file: Path to the .d directory of interest.
+    :type bruker_dot_d_file: str
+    :return: Dictionary containing the size and modification time of analysis.tsf and analysis.tsf_bin.
+    :rtype: dict
+    """
+    fingerprint = {}
+    for fname in ['analysis.tsf', 'analysis.tsf_bin']:
+        path = os.path.join(bruker_dot_d_file, fname)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            fingerprint[fname] = [stat.st_size, stat.st_mtime_ns]
+        else:
+            fingerprint[fname] = None
+    return fingerprint
+
+
+def get_tmp_path(path):
+    """
+    Create an empty temporary file with a unique name in the same directory as a path, so that it can be moved to the
+    path with os.replace() once it has been written.
+
+    :param path: Path the temporary file will replace.
+    :type path: str
+    :return: Path to the temporary file.
     :rtype: str
     """
-    exts = [os.path.splitext(fname)[1] for dirpath, dirnames, filenames in os.walk(bruker_dot_d_file)
-            for fname in filenames]
-    if '.tdf' in exts and '.tsf' not in exts and '.baf' not in exts:
-        return 'TDF'
-    elif '.tsf' in exts and '.tdf' not in exts and '.baf' not in exts:
-        return 'TSF'
-    elif '.baf' in exts and '.tdf' not in exts and '.tsf' not in exts:
-        return 'BAF'
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=os.path.dirname(path))
+    os.close(fd)
+    return tmp_path
+
+
+class DatasetMetadata(object):
+    """
+    Metadata of a TSF dataset parsed from its GlobalMetadata, Frames, and MaldiFrameInfo tables.
+
+    :param mz_acq_range: Tuple of the lower and upper m/z of the acquisition range.
+    :type mz_acq_range: tuple[float]
+    :param imaging_area: Tuple of the minimum X, maximum X, minimum Y, and maximum Y coordinates of the imaging area.
+    :type imaging_area: tuple[int]
+    :param frame_ids: Frame IDs in the order of the Frames table.
+    :type frame_ids: numpy.array
+    :param x_coords: X coordinate (XIndexPos) of each frame.
+    :type x_coords: numpy.array
+    :param y_coords: Y coordinate (YIndexPos) of each frame.
+    :type y_coords: numpy.array
+    :param summed_intensities: Summed intensity of each frame, or None if the Frames table does not contain them.
+    :type summed_intensities: numpy.array | None
+    """
+    def __init__(self, mz_acq_range, imaging_area, frame_ids, x_coords, y_coords, summed_intensities=None):
+        self.mz_acq_range_lower, self.mz_acq_range_upper = float(mz_acq_range[0]), float(mz_acq_range[1])
+        self.min_x, self.max_x, self.min_y, self.max_y = (int(value) for value in imaging_area)
+        self.frame_ids = frame_ids
+        self.x_coords = x_coords
+        self.y_coords = y_coords
+        self.summed_intensities = summed_intensities
+
+    def get_arrays(self):
+        """
+        Get the metadata as a dictionary of numpy arrays that can be stored in a ResultCache.
+
+        :return: Dictionary of numpy arrays.
+        :rtype: dict
+        """
+        arrays = {'mz_acq_range': np.array([self.mz_acq_range_lower, self.mz_acq_range_upper]),
+                  'imaging_area': np.array([self.min_x, self.max_x, self.min_y, self.max_y], dtype=np.int64),
+                  'frame_ids': self.frame_ids,
+                  'x_coords': self.x_coords,
+                  'y_coords': self.y_coords}
+        if self.summed_intensities is not None:
+            arrays['summed_intensities'] = self.summed_intensities
+        return arrays
+
+
+def parse_dataset_metadata(data):
+    """
+    Parse the metadata of a TSF dataset from the tables loaded by pyTDFSDK.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :return: Dataset metadata.
+    :rtype: TSFImagingDataViewer.util.DatasetMetadata
+    """
+    global_metadata = data.analysis['GlobalMetadata']
+    frames = data.analysis['Frames']
+    frame_ids = frames['Id'].values.astype(np.int64)
+    maldiframeinfo = data.analysis['MaldiFrameInfo'].set_index('Frame').loc[frame_ids]
+    summed_intensities = None
+    if 'SummedIntensities' in frames.columns:
+        summed_intensities = frames['SummedIntensities'].values.astype(np.float64)
+    return DatasetMetadata((global_metadata['MzAcqRangeLower'], global_metadata['MzAcqRangeUpper']),
+                           (global_metadata['ImagingAreaMinXIndexPos'], global_metadata['ImagingAreaMaxXIndexPos'],
+                            global_metadata['ImagingAreaMinYIndexPos'], global_metadata['ImagingAreaMaxYIndexPos']),
+                           frame_ids,
+                           maldiframeinfo['XIndexPos'].values.astype(np.int64),
+                           maldiframeinfo['YIndexPos'].values.astype(np.int64),
+                           summed_intensities)
+
+
+def write_dataset_metadata(metadata, result_cache):
+    """
+    Store dataset metadata in a result cache. Failures are ignored since the cache only speeds up opening the dataset
+    again (i.e. the .d directory may be on a read-only share).
+
+    :param metadata: Dataset metadata.
+    :type metadata: TSFImagingDataViewer.util.DatasetMetadata
+    :param result_cache: Result cache of the dataset.
+    :type result_cache: TSFImagingDataViewer.cache.ResultCache
+    """
+    arrays = metadata.get_arrays()
+    try:
+        result_cache.put('dataset_metadata', {}, arrays, exact=tuple(arrays.keys()))
+    except OSError:
+        pass
+
+
+@timed()
+def get_dataset_metadata(data, result_cache=None):
+    """
+    Get the metadata of a TSF dataset. The metadata is parsed once per dataset and shared by every subsequent call. If
+    a result cache is provided, the parsed metadata is loaded from it when available and otherwise written to it on a
+    background thread so that the next time the dataset is opened the tables do not need to be parsed again.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param result_cache: Optional result cache of the dataset.
+    :type result_cache: TSFImagingDataViewer.cache.ResultCache | None
+    :return: Dataset metadata.
+    :rtype: TSFImagingDataViewer.util.DatasetMetadata
+    """
+    if data not in DATASET_METADATA:
+        arrays = result_cache.get('dataset_metadata', {}) if result_cache is not None else None
+        if arrays is not None:
+            # Copied out of the memory-mapped files so that the cache entry can still be evicted.
+            arrays = {name: np.array(array) for name, array in arrays.items()}
+            metadata = DatasetMetadata(arrays['mz_acq_range'],
+                                       arrays['imaging_area'],
+                                       arrays['frame_ids'],
+                                       arrays['x_coords'],
+                                       arrays['y_coords'],
+                                       arrays.get('summed_intensities'))
+        else:
+            metadata = parse_dataset_metadata(data)
+            if result_cache is not None:
+                threading.Thread(target=write_dataset_metadata, args=(metadata, result_cache), daemon=True).start()
+        DATASET_METADATA[data] = metadata
+    return DATASET_METADATA[data]
+
+
+class PixelIndex(object):
+    """
+    Integer row and column indices of each frame within the imaging area of a TSF dataset.
+
+    :param frame_ids: Frame IDs in the order of the Frames table.
+    :type frame_ids: numpy.array
+    :param x_coords: X coordinate (XIndexPos) of each frame.
+    :type x_coords: numpy.array
+    :param y_coords: Y coordinate (YIndexPos) of each frame.
+    :type y_coords: numpy.array
+    :param min_x: Minimum X coordinate of the imaging area.
+    :type min_x: int
+    :param max_x: Maximum X coordinate of the imaging area.
+    :type max_x: int
+    :param min_y: Minimum Y coordinate of the imaging area.
+    :type min_y: int
+    :param max_y: Maximum Y coordinate of the imaging area.
+    :type max_y: int
+    """
+    def __init__(self, frame_ids, x_coords, y_coords, min_x, max_x, min_y, max_y):
+        self.frame_ids = frame_ids
+        self.x_coords = x_coords
+        self.y_coords = y_coords
+        self.min_x = min_x
+        self.min_y = min_y
+        self.cols = x_coords - min_x
+        self.rows = y_coords - min_y
+        # Frames outside of the imaging area reported in GlobalMetadata still get a pixel.
+        self.shape = (int(max(max_y - min_y, np.max(self.rows, initial=0))) + 1,
+                      int(max(max_x - min_x, np.max(self.cols, initial=0))) + 1)
+        # Dense (row, column) -> frame ID lookup. 0 is used for pixels without a frame.
+        self.frame_grid = np.zeros(self.shape, dtype=np.int64)
+        self.frame_grid[self.rows, self.cols] = frame_ids
+        # Frame ID -> position in frame_ids lookup. -1 is used for frame IDs that do not exist.
+        self.frame_positions = np.full(int(np.max(frame_ids, initial=0)) + 1, -1, dtype=np.int64)
+        self.frame_positions[frame_ids] = np.arange(frame_ids.size)
+
+    def get_frame(self, x_coord, y_coord):
+        """
+        Get the frame ID acquired at the given coordinates.
+
+        :param x_coord: X coordinate (XIndexPos).
+        :type x_coord: int
+        :param y_coord: Y coordinate (YIndexPos).
+        :type y_coord: int
+        :return: Frame ID or None if no frame was acquired at the given coordinates.
+        :rtype: int | None
+        """
+        if x_coord is None or y_coord is None:
+            return None
+        row = int(y_coord) - self.min_y
+        col = int(x_coord) - self.min_x
+        if row < 0 or col < 0 or row >= self.shape[0] or col >= self.shape[1]:
+            return None
+        frame = int(self.frame_grid[row, col])
+        if frame == 0:
+            return None
+        return frame
+
+    def get_coords(self, frame):
+        """
+        Get the coordinates at which a frame was acquired.
+
+        :param frame: Frame ID.
+        :type frame: int
+        :return: Tuple of the X and Y coordinates or None if the frame does not exist.
+        :rtype: tuple[int] | None
+        """
+        if frame is None or int(frame) < 0 or int(frame) >= self.frame_positions.size:
+            return None
+        position = self.frame_positions[int(frame)]
+        if position == -1:
+            return None
+        return int(self.x_coords[position]), int(self.y_coords[position])
+
+    def scatter(self, values):
+        """
+        Scatter per frame values into a 2D image. Pixels without a frame are set to 0.
+
+        :param values: Numpy array containing one value per frame in the same order as frame_ids, or a 2D array with
+            shape (number of frames, number of channels) to scatter several channels at once.
+        :type values: numpy.array
+        :return: 2D numpy array with shape (number of rows, number of columns), or 3D numpy array with shape
+            (number of channels, number of rows, number of columns) if values is 2D.
+        :rtype: numpy.array
+        """
+        if values.ndim == 2:
+            image = np.zeros((values.shape[1],) + self.shape, dtype=np.float64)
+            image[:, self.rows, self.cols] = values.T
+        else:
+            image = np.zeros(self.shape, dtype=np.float64)
+            image[self.rows, self.cols] = values
+        return image
+
+
+@timed()
+def get_pixel_index(data):
+    """
+    Get the pixel index for a TSF dataset. The index is computed once per dataset and shared by every subsequent call.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :return: Pixel index containing the row and column of each frame.
+    :rtype: TSFImagingDataViewer.util.PixelIndex
+    """
+    if data not in PIXEL_INDICES:
+        metadata = get_dataset_metadata(data)
+        PIXEL_INDICES[data] = PixelIndex(metadata.frame_ids,
+                                         metadata.x_coords,
+                                         metadata.y_coords,
+                                         metadata.min_x,
+                                         metadata.max_x,
+                                         metadata.min_y,
+                                         metadata.max_y)
+    return PIXEL_INDICES[data]
 
 
 def get_ppm_tolerance(mz, ppm):
@@ -70,7 +448,469 @@ def trim_spectrum(mz_array, intensity_array, lower_mass_range, upper_mass_range)
     return mz_array, intensity_array
 
 
-def create_average_spectrum(data, frame_ids, full=False):
+def get_mz_window(mz_array, lower_mass_range, upper_mass_range):
+    """
+    Find the slice of a sorted m/z array containing features between the lower and upper mass ranges (inclusive)
+    using a binary search. Equivalent to trim_spectrum() without copying the arrays.
+
+    :param mz_array: Sorted numpy array containing m/z values.
+    :type mz_array: numpy.array
+    :param lower_mass_range: Mass in Daltons to use for the lower mass range.
+    :type lower_mass_range: float
+    :param upper_mass_range: Mass in Daltons to use for the upper mass range.
+    :type upper_mass_range: float
+    :return: Slice that can be applied to the m/z array and any intensity array sharing the same m/z axis.
+    :rtype: slice
+    """
+    return slice(int(np.searchsorted(mz_array, lower_mass_range, side='left')),
+                 int(np.searchsorted(mz_array, upper_mass_range, side='right')))
+
+
+def is_mz_window_valid(mz_array, mz_window, lower_mass_range, upper_mass_range):
+    """
+    Check whether an m/z window found on a reference m/z axis selects exactly the features between the lower and upper
+    mass ranges (inclusive) of another sorted m/z array. Only the values at the edges of the window are checked.
+
+    :param mz_array: Sorted numpy array containing m/z values.
+    :type mz_array: numpy.array
+    :param mz_window: Slice returned by get_mz_window().
+    :type mz_window: slice
+    :param lower_mass_range: Mass in Daltons to use for the lower mass range.
+    :type lower_mass_range: float
+    :param upper_mass_range: Mass in Daltons to use for the upper mass range.
+    :type upper_mass_range: float
+    :return: Whether the window can be applied to the m/z array.
+    :rtype: bool
+    """
+    start = mz_window.start
+    stop = mz_window.stop
+    if stop > mz_array.size:
+        return False
+    if start > 0 and mz_array[start - 1] >= lower_mass_range:
+        return False
+    if start < mz_array.size and mz_array[start] < lower_mass_range:
+        return False
+    if stop > 0 and mz_array[stop - 1] > upper_mass_range:
+        return False
+    if stop < mz_array.size and mz_array[stop] <= upper_mass_range:
+        return False
+    return True
+
+
+class MzBins(object):
+    """
+    Binned m/z axis spanning an m/z range with either fixed-width bins in Daltons or bins whose width scales with m/z in
+    ppm. Profile spectra are binned by summing the intensities of the data points within each bin, where each bin
+    includes its lower edge and excludes its upper edge, except for the last bin, which includes both.
+
+    :param lower_mz: Lower edge of the first bin.
+    :type lower_mz: float
+    :param upper_mz: m/z that the last bin must reach.
+    :type upper_mz: float
+    :param bin_width: Width of each bin.
+    :type bin_width: float
+    :param bin_unit: Bin width unit. Either 'Da' or 'ppm'.
+    :type bin_unit: str
+    """
+    def __init__(self, lower_mz, upper_mz, bin_width, bin_unit='Da'):
+        if bin_width <= 0:
+            raise ValueError('The m/z bin width must be greater than 0.')
+        if upper_mz <= lower_mz:
+            raise ValueError(f'Invalid m/z range {lower_mz} - {upper_mz}.')
+        self.bin_width = float(bin_width)
+        self.bin_unit = bin_unit
+        if bin_unit == 'Da':
+            n_bins = int(np.ceil((upper_mz - lower_mz) / bin_width))
+            self.edges = lower_mz + np.arange(n_bins + 1) * bin_width
+        elif bin_unit == 'ppm':
+            # Each edge is bin_width ppm above the previous edge.
+            n_bins = int(np.ceil(np.log(upper_mz / lower_mz) / np.log1p(bin_width / 1e6)))
+            self.edges = lower_mz * np.exp(np.arange(n_bins + 1) * np.log1p(bin_width / 1e6))
+        else:
+            raise ValueError(f'Invalid m/z bin unit {bin_unit}.')
+        self.mz_array = (self.edges[:-1] + self.edges[1:]) / 2
+        self.size = self.mz_array.size
+        self._positions = None
+
+    def get_params(self):
+        """
+        Get the parameters of the bins, i.e. to identify cached results calculated from binned spectra.
+
+        :return: Dictionary containing the bin width and bin unit.
+        :rtype: dict
+        """
+        return {'bin_width': self.bin_width, 'bin_unit': self.bin_unit}
+
+    def get_suffix(self):
+        """
+        Get a suffix identifying the bins in file names.
+
+        :return: File name suffix.
+        :rtype: str
+        """
+        return f'_bin{self.bin_width:g}{self.bin_unit}'
+
+    def _get_positions(self, mz_array):
+        # The profile m/z axis is expected to be shared across frames, so the bin edges are only located within it again
+        # when it changes.
+        positions = self._positions
+        if positions is None or positions[0].size != mz_array.size or positions[0][0] != mz_array[0] or \
+                positions[0][-1] != mz_array[-1]:
+            starts = np.searchsorted(mz_array, self.edges)
+            starts[-1] = np.searchsorted(mz_array, self.edges[-1], side='right')
+            nonempty = starts[:-1] < starts[1:]
+            positions = (mz_array, starts[:-1][nonempty], int(starts[-1]), nonempty)
+            self._positions = positions
+        return positions[1:]
+
+    def bin_spectrum(self, mz_array, intensity_array):
+        """
+        Bin a profile spectrum. Data points outside of the bins are ignored.
+
+        :param mz_array: Numpy array containing m/z values in ascending order.
+        :type mz_array: numpy.array
+        :param intensity_array: Numpy array containing intensity values.
+        :type intensity_array: numpy.array
+        :return: Numpy array containing the summed intensity of each bin.
+        :rtype: numpy.array
+        """
+        binned_array = np.zeros(self.size, dtype=np.float64)
+        if mz_array.size == 0:
+            return binned_array
+        starts, stop, nonempty = self._get_positions(mz_array)
+        if starts.size > 0:
+            # Empty bins are skipped so that each reduced segment ends where the next non-empty bin starts.
+            binned_array[nonempty] = np.add.reduceat(intensity_array[:stop], starts, dtype=np.float64)
+        return binned_array
+
+    def __getstate__(self):
+        # The located bin edges are recomputed by worker processes.
+        state = self.__dict__.copy()
+        state['_positions'] = None
+        return state
+
+
+def get_mz_bins(data, bin_width, bin_unit='Da'):
+    """
+    Get the m/z bins spanning the acquisition m/z range (MzAcqRangeLower to MzAcqRangeUpper) of a TSF dataset.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param bin_width: Width of each bin. If 0 or None, spectra are not binned.
+    :type bin_width: float | None
+    :param bin_unit: Bin width unit. Either 'Da' or 'ppm'.
+    :type bin_unit: str
+    :return: m/z bins or None if spectra are not binned.
+    :rtype: TSFImagingDataViewer.util.MzBins | None
+    """
+    if not bin_width or bin_width <= 0:
+        return None
+    metadata = get_dataset_metadata(data)
+    return MzBins(metadata.mz_acq_range_lower, metadata.mz_acq_range_upper, bin_width, bin_unit)
+
+
+class DecodedSpectrum(object):
+    """
+    Picklable copy of the arrays of a decoded spectrum, used to return spectra read in worker processes.
+
+    :param frame: Frame ID.
+    :type frame: int
+    :param mz_array: Array containing m/z values.
+    :type mz_array: numpy.array
+    :param intensity_array: Array containing intensity values.
+    :type intensity_array: numpy.array
+    """
+    def __init__(self, frame, mz_array, intensity_array):
+        self.frame = frame
+        self.mz_array = mz_array
+        self.intensity_array = intensity_array
+
+
+class SpectrumAccumulator(object):
+    """
+    Streaming reducer for profile spectra sharing the same m/z axis. The sum, maximum, and number of non-zero
+    intensities of each m/z bin are updated in place in preallocated arrays.
+
+    :param mz_bins: Optional m/z bins. If provided, each spectrum is binned before it is added.
+    :type mz_bins: TSFImagingDataViewer.util.MzBins | None
+    """
+    def __init__(self, mz_bins=None):
+        self.mz_bins = mz_bins
+        self.mz_array = None
+        self.sum_array = None
+        self.max_array = None
+        self.count_array = None
+        self.n_spectra = 0
+        self._nonzero = None
+
+    def _allocate(self, mz_array):
+        self.mz_array = mz_array
+        self.sum_array = np.zeros(mz_array.size, dtype=np.float64)
+        self.max_array = np.zeros(mz_array.size, dtype=np.float64)
+        self.count_array = np.zeros(mz_array.size, dtype=np.int64)
+        self._nonzero = np.zeros(mz_array.size, dtype=bool)
+
+    def add_spectrum(self, mz_array, intensity_array):
+        """
+        Add a profile spectrum to the accumulator.
+
+        :param mz_array: Numpy array containing m/z values. Only the m/z array of the first spectrum is kept.
+        :type mz_array: numpy.array
+        :param intensity_array: Numpy array containing intensity values.
+        :type intensity_array: numpy.array
+        """
+        if self.mz_bins is not None:
+            intensity_array = self.mz_bins.bin_spectrum(mz_array, intensity_array)
+            mz_array = self.mz_bins.mz_array
+        if self.sum_array is None:
+            self._allocate(mz_array)
+        np.add(self.sum_array, intensity_array, out=self.sum_array)
+        np.maximum(self.max_array, intensity_array, out=self.max_array)
+        np.greater(intensity_array, 0, out=self._nonzero)
+        np.add(self.count_array, self._nonzero, out=self.count_array)
+        self.n_spectra += 1
+
+    def add_intensities(self, mz_array, intensities):
+        """
+        Add several profile spectra sharing the same m/z axis at once. The spectra are not binned, so they must already
+        be on the m/z axis of the accumulator (i.e. rows of a datacube built with the same m/z bins).
+
+        :param mz_array: Numpy array containing m/z values. Only the m/z array of the first spectra is kept.
+        :type mz_array: numpy.array
+        :param intensities: 2D numpy array with shape (number of spectra, number of m/z values) containing intensity
+            values.
+        :type intensities: numpy.array
+        """
+        if intensities.shape[0] == 0:
+            return
+        if self.sum_array is None:
+            self._allocate(mz_array)
+        np.add(self.sum_array, np.sum(intensities, axis=0, dtype=np.float64), out=self.sum_array)
+        np.maximum(self.max_array, np.max(intensities, axis=0), out=self.max_array)
+        np.add(self.count_array, np.count_nonzero(intensities > 0, axis=0), out=self.count_array)
+        self.n_spectra += intensities.shape[0]
+
+    def iter_add_frames(self, data, frame_ids):
+        """
+        Read and add the profile spectrum of each frame, yielding the number of frames added so far after each frame.
+
+        :param data: TSF dataset.
+        :type data: pyTDFSDK.classes.TsfData
+        :param frame_ids: List of frame IDs to add.
+        :type frame_ids: list[int]
+        :return: Generator yielding the number of frames added so far.
+        """
+        for count, i in enumerate(frame_ids, start=1):
+            spectrum = read_spectrum(data, i)
+            self.add_spectrum(spectrum.mz_array, spectrum.intensity_array)
+            yield count
+
+    def add_frames(self, data, frame_ids):
+        """
+        Read and add the profile spectrum of each frame.
+
+        :param data: TSF dataset.
+        :type data: pyTDFSDK.classes.TsfData
+        :param frame_ids: List of frame IDs to add.
+        :type frame_ids: list[int]
+        """
+        for count in self.iter_add_frames(data, frame_ids):
+            pass
+
+    def merge(self, other):
+        """
+        Merge another accumulator into this one in place.
+
+        :param other: Accumulator to merge.
+        :type other: TSFImagingDataViewer.util.SpectrumAccumulator
+        """
+        if other.sum_array is None:
+            return
+        if self.sum_array is None:
+            self._allocate(other.mz_array)
+        np.add(self.sum_array, other.sum_array, out=self.sum_array)
+        np.maximum(self.max_array, other.max_array, out=self.max_array)
+        np.add(self.count_array, other.count_array, out=self.count_array)
+        self.n_spectra += other.n_spectra
+
+    def get_average(self):
+        """
+        Get the average intensity of each m/z bin across every added spectrum.
+
+        :return: Numpy array containing average intensity values.
+        :rtype: numpy.array
+        """
+        if self.n_spectra == 0:
+            raise ValueError('Unable to average spectra: no spectra have been added.')
+        return self.sum_array / self.n_spectra
+
+    def get_base_peak(self):
+        """
+        Get the maximum intensity of each m/z bin across every added spectrum.
+
+        :return: Numpy array containing maximum intensity values.
+        :rtype: numpy.array
+        """
+        return self.max_array
+
+    def __getstate__(self):
+        # The scratch buffer does not need to be sent back from worker processes.
+        state = self.__dict__.copy()
+        state['_nonzero'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.sum_array is not None:
+            self._nonzero = np.zeros(self.sum_array.size, dtype=bool)
+
+
+@timed()
+def sum_spectra(data, frame_ids, mz_bins=None):
+    """
+    Accumulate the profile spectra of a list of frames. Used as the per chunk reducer for accumulate_spectra().
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param frame_ids: List of frame IDs to accumulate.
+    :type frame_ids: list[int]
+    :param mz_bins: Optional m/z bins used to bin each spectrum.
+    :type mz_bins: TSFImagingDataViewer.util.MzBins | None
+    :return: Accumulator containing the spectra of every frame.
+    :rtype: TSFImagingDataViewer.util.SpectrumAccumulator
+    """
+    accumulator = SpectrumAccumulator(mz_bins)
+    accumulator.add_frames(data, frame_ids)
+    return accumulator
+
+
+@timed()
+def read_spectra(data, frame_ids):
+    """
+    Read the profile spectra of a list of frames. Used as the per chunk reducer for iter_accumulate_roi_spectra() when
+    the spectra read are added to the spectrum cache.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param frame_ids: List of frame IDs to read.
+    :type frame_ids: list[int]
+    :return: List of decoded spectra.
+    :rtype: list[TSFImagingDataViewer.util.DecodedSpectrum]
+    """
+    spectra = []
+    for i in frame_ids:
+        spectrum = read_spectrum(data, i)
+        spectra.append(DecodedSpectrum(int(i), spectrum.mz_array, spectrum.intensity_array))
+    return spectra
+
+
+@timed()
+def sum_mass_ranges(data, frame_ids, mass_ranges):
+    """
+    Sum the intensities between each pair of lower and upper mass ranges (inclusive) of each frame in a list of frames
+    while reading every frame only once. Used as the per chunk reducer for get_ion_images_array().
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param frame_ids: List of frame IDs.
+    :type frame_ids: list[int]
+    :param mass_ranges: List of tuples containing the lower and upper mass ranges in Daltons.
+    :type mass_ranges: list[tuple[float]]
+    :return: Numpy array with shape (number of frames, number of mass ranges) containing summed intensities.
+    :rtype: numpy.array
+    """
+    intensities = np.zeros((len(frame_ids), len(mass_ranges)), dtype=np.float64)
+    mz_windows = None
+    for row, i in enumerate(frame_ids):
+        spectrum = read_spectrum(data, i)
+        if mz_windows is None:
+            mz_windows = [get_mz_window(spectrum.mz_array, lower_mass_range, upper_mass_range)
+                          for lower_mass_range, upper_mass_range in mass_ranges]
+        for col, (lower_mass_range, upper_mass_range) in enumerate(mass_ranges):
+            # The profile m/z axis is expected to be shared across frames; fall back to trimming if it is not.
+            if is_mz_window_valid(spectrum.mz_array, mz_windows[col], lower_mass_range, upper_mass_range):
+                intensities[row, col] = np.sum(spectrum.intensity_array[mz_windows[col]])
+            else:
+                mz_array, intensity_array = trim_spectrum(spectrum.mz_array,
+                                                          spectrum.intensity_array,
+                                                          lower_mass_range,
+                                                          upper_mass_range)
+                intensities[row, col] = np.sum(intensity_array)
+    return intensities
+
+
+def sum_mass_range(data, frame_ids, lower_mass_range, upper_mass_range):
+    """
+    Sum the intensities between the lower and upper mass ranges (inclusive) of each frame in a list of frames.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param frame_ids: List of frame IDs.
+    :type frame_ids: list[int]
+    :param lower_mass_range: Mass in Daltons to use for the lower mass range.
+    :type lower_mass_range: float
+    :param upper_mass_range: Mass in Daltons to use for the upper mass range.
+    :type upper_mass_range: float
+    :return: Numpy array containing the summed intensity of each frame.
+    :rtype: numpy.array
+    """
+    return sum_mass_ranges(data, frame_ids, [(lower_mass_range, upper_mass_range)])[:, 0]
+
+
+def iter_accumulate_spectra(data, frame_ids, workers=1, chunk_size=DEFAULT_CHUNK_SIZE, accumulator=None,
+                            mz_bins=None):
+    """
+    Accumulate the profile spectra of a list of frames, yielding progress after each chunk of frames. Chunks are merged
+    in order, so the result only depends on the chunk size and not on the number of workers.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param frame_ids: List of frame IDs to accumulate.
+    :type frame_ids: list[int]
+    :param workers: Number of worker processes used to read frames.
+    :type workers: int
+    :param chunk_size: Number of frames accumulated per chunk.
+    :type chunk_size: int
+    :param accumulator: Optional accumulator containing previously processed frames to continue from.
+    :type accumulator: TSFImagingDataViewer.util.SpectrumAccumulator | None
+    :param mz_bins: Optional m/z bins used to bin each spectrum. Must match the bins of accumulator.
+    :type mz_bins: TSFImagingDataViewer.util.MzBins | None
+    :return: Generator yielding the number of frames accumulated so far and the accumulator.
+    """
+    if accumulator is None:
+        accumulator = SpectrumAccumulator(mz_bins)
+    for partial_accumulator in iter_frame_chunks(data, frame_ids, sum_spectra, (mz_bins,), workers=workers,
+                                                 chunk_size=chunk_size):
+        accumulator.merge(partial_accumulator)
+        yield accumulator.n_spectra, accumulator
+
+
+def accumulate_spectra(data, frame_ids, workers=1, chunk_size=DEFAULT_CHUNK_SIZE, mz_bins=None):
+    """
+    Accumulate the profile spectra of a list of frames.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param frame_ids: List of frame IDs to accumulate.
+    :type frame_ids: list[int]
+    :param workers: Number of worker processes used to read frames.
+    :type workers: int
+    :param chunk_size: Number of frames accumulated per chunk.
+    :type chunk_size: int
+    :param mz_bins: Optional m/z bins used to bin each spectrum.
+    :type mz_bins: TSFImagingDataViewer.util.MzBins | None
+    :return: Accumulator containing the sum, maximum, and non-zero count of each m/z bin.
+    :rtype: TSFImagingDataViewer.util.SpectrumAccumulator
+    """
+    accumulator = SpectrumAccumulator(mz_bins)
+    for n_processed, accumulator in iter_accumulate_spectra(data, frame_ids, workers=workers, chunk_size=chunk_size,
+                                                            mz_bins=mz_bins):
+        pass
+    return accumulator
+
+
+@timed()
+def create_average_spectrum(data, frame_ids, full=False, workers=1, chunk_size=DEFAULT_CHUNK_SIZE, mz_bins=None):
     """
     Create an average spectrum from a TsfData dataset for a list of frames.
 
@@ -80,19 +920,390 @@ def create_average_spectrum(data, frame_ids, full=False):
     :type frame_ids: list[int]
     :param full: Whether the average being calculated is a full or average spectrum.
     :type full: bool
+    :param workers: Number of worker processes used to read frames.
+    :type workers: int
+    :param chunk_size: Number of frames summed per chunk.
+    :type chunk_size: int
+    :param mz_bins: Optional m/z bins used to bin each spectrum.
+    :type mz_bins: TSFImagingDataViewer.util.MzBins | None
     :return: Numpy array containing average intensity values.
     :rtype: numpy.array
     """
-    intensity_array = np.array([])
-    for i in frame_ids:
-        spectrum = TsfSpectrum(data, frame=i, mode='profile')
-        if intensity_array.size == 0:
-            intensity_array = spectrum.intensity_array
-            mz_array = spectrum.mz_array  # assume m/z axis for profile data is the same
-        else:
-            intensity_array = np.sum([intensity_array, spectrum.intensity_array], axis=0)
-    intensity_array = intensity_array / len(frame_ids)
-    return mz_array, intensity_array
+    accumulator = accumulate_spectra(data, frame_ids, workers=workers, chunk_size=chunk_size, mz_bins=mz_bins)
+    return accumulator.mz_array, accumulator.get_average()
+
+
+def get_average_checkpoint_path(data, mz_bins=None):
+    """
+    Get the path to the average spectrum checkpoint within the .d directory of a TSF dataset. Averages of binned
+    spectra are checkpointed to a separate file for each binning.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param mz_bins: Optional m/z bins of the average.
+    :type mz_bins: TSFImagingDataViewer.util.MzBins | None
+    :return: Path to the checkpoint.
+    :rtype: str
+    """
+    if mz_bins is None:
+        return os.path.join(data.source_file, AVERAGE_CHECKPOINT_FILENAME)
+    root, extension = os.path.splitext(AVERAGE_CHECKPOINT_FILENAME)
+    return os.path.join(data.source_file, f'{root}{mz_bins.get_suffix()}{extension}')
+
+
+def load_average_checkpoint(data, mz_bins=None):
+    """
+    Load the average spectrum checkpoint saved within the .d directory of a TSF dataset. Checkpoints saved before the
+    raw data was modified are ignored.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param mz_bins: Optional m/z bins of the average.
+    :type mz_bins: TSFImagingDataViewer.util.MzBins | None
+    :return: Tuple of the accumulator and the sorted frame IDs it contains. If no valid checkpoint is found, the
+        accumulator is empty.
+    :rtype: tuple[TSFImagingDataViewer.util.SpectrumAccumulator, numpy.array]
+    """
+    accumulator = SpectrumAccumulator(mz_bins)
+    checkpoint_path = get_average_checkpoint_path(data, mz_bins)
+    if os.path.isfile(checkpoint_path):
+        with np.load(checkpoint_path) as checkpoint:
+            if json.loads(str(checkpoint['fingerprint'])) == get_dataset_fingerprint(data.source_file):
+                accumulator.mz_array = checkpoint['mz_array']
+                accumulator.sum_array = checkpoint['sum_array']
+                accumulator.max_array = checkpoint['max_array']
+                accumulator.count_array = checkpoint['count_array']
+                accumulator.n_spectra = int(checkpoint['n_spectra'])
+                accumulator._nonzero = np.zeros(accumulator.sum_array.size, dtype=bool)
+                return accumulator, checkpoint['frame_ids']
+    return accumulator, np.array([], dtype=np.int64)
+
+
+def save_average_checkpoint(data, accumulator, frame_ids, mz_bins=None):
+    """
+    Save an average spectrum checkpoint within the .d directory of a TSF dataset. The previous checkpoint is replaced
+    atomically so that an interruption never leaves a partially written checkpoint behind.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param accumulator: Accumulator containing the processed frames.
+    :type accumulator: TSFImagingDataViewer.util.SpectrumAccumulator
+    :param frame_ids: Frame IDs contained in the accumulator.
+    :type frame_ids: numpy.array
+    :param mz_bins: Optional m/z bins of the average.
+    :type mz_bins: TSFImagingDataViewer.util.MzBins | None
+    """
+    checkpoint_path = get_average_checkpoint_path(data, mz_bins)
+    # Concurrent jobs on the same dataset each write their own temporary file.
+    tmp_checkpoint_path = get_tmp_path(checkpoint_path)
+    try:
+        # A file object is passed so that np.savez() does not append .npz to the temporary path.
+        with open(tmp_checkpoint_path, 'wb') as checkpoint_file:
+            np.savez(checkpoint_file,
+                     fingerprint=json.dumps(get_dataset_fingerprint(data.source_file)),
+                     mz_array=accumulator.mz_array,
+                     sum_array=accumulator.sum_array,
+                     max_array=accumulator.max_array,
+                     count_array=accumulator.count_array,
+                     n_spectra=accumulator.n_spectra,
+                     frame_ids=np.sort(frame_ids))
+        os.replace(tmp_checkpoint_path, checkpoint_path)
+    finally:
+        if os.path.isfile(tmp_checkpoint_path):
+            os.remove(tmp_checkpoint_path)
+
+
+def iter_resume_accumulate_spectra(data, frame_ids, workers=1, chunk_size=DEFAULT_CHUNK_SIZE,
+                                   checkpoint_interval=AVERAGE_CHECKPOINT_INTERVAL, mz_bins=None):
+    """
+    Accumulate the profile spectra of a list of frames, continuing from the checkpoint saved within the .d directory
+    when its frames are a subset of the requested frames (i.e. upgrading an average estimate to a full average or
+    resuming an interrupted run). Checkpoints are saved every checkpoint_interval frames and once all frames have been
+    processed. If the checkpoint contains frames that were not requested, the frames are accumulated from scratch and
+    the checkpoint is left untouched.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param frame_ids: List of frame IDs to accumulate.
+    :type frame_ids: list[int]
+    :param workers: Number of worker processes used to read frames.
+    :type workers: int
+    :param chunk_size: Number of frames accumulated per chunk.
+    :type chunk_size: int
+    :param checkpoint_interval: Minimum number of newly processed frames between checkpoints.
+    :type checkpoint_interval: int
+    :param mz_bins: Optional m/z bins used to bin each spectrum.
+    :type mz_bins: TSFImagingDataViewer.util.MzBins | None
+    :return: Generator yielding the number of frames accumulated so far and the accumulator.
+    """
+    frame_ids = np.unique(frame_ids)
+    accumulator, processed_frame_ids = load_average_checkpoint(data, mz_bins)
+    if np.setdiff1d(processed_frame_ids, frame_ids).size != 0:
+        yield from iter_accumulate_spectra(data, frame_ids, workers=workers, chunk_size=chunk_size, mz_bins=mz_bins)
+        return
+    remaining_frame_ids = np.setdiff1d(frame_ids, processed_frame_ids)
+    n_previous = accumulator.n_spectra
+    n_checkpoint = n_previous
+    yield n_previous, accumulator
+    for n_processed, accumulator in iter_accumulate_spectra(data,
+                                                            remaining_frame_ids,
+                                                            workers=workers,
+                                                            chunk_size=chunk_size,
+                                                            accumulator=accumulator,
+                                                            mz_bins=mz_bins):
+        if n_processed - n_checkpoint >= checkpoint_interval or n_processed - n_previous == remaining_frame_ids.size:
+            save_average_checkpoint(data,
+                                    accumulator,
+                                    np.concatenate((processed_frame_ids,
+                                                    remaining_frame_ids[:n_processed - n_previous])),
+                                    mz_bins)
+            n_checkpoint = n_processed
+        yield n_processed, accumulator
+
+
+@timed()
+def resume_average_spectrum(data, frame_ids, workers=1, chunk_size=DEFAULT_CHUNK_SIZE,
+                            checkpoint_interval=AVERAGE_CHECKPOINT_INTERVAL, progress_callback=None, mz_bins=None):
+    """
+    Create an average spectrum from a TsfData dataset for a list of frames, reusing and updating the checkpoint saved
+    within the .d directory. See iter_resume_accumulate_spectra().
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param frame_ids: List of frame IDs to average.
+    :type frame_ids: list[int]
+    :param workers: Number of worker processes used to read frames.
+    :type workers: int
+    :param chunk_size: Number of frames summed per chunk.
+    :type chunk_size: int
+    :param checkpoint_interval: Minimum number of newly processed frames between checkpoints.
+    :type checkpoint_interval: int
+    :param progress_callback: Optional function called with the number of frames processed so far and the total
+        number of frames after each chunk. May raise an exception to stop the calculation.
+    :type progress_callback: function | None
+    :param mz_bins: Optional m/z bins used to bin each spectrum.
+    :type mz_bins: TSFImagingDataViewer.util.MzBins | None
+    :return: Tuple of the m/z array and the average intensity array.
+    :rtype: tuple[numpy.array]
+    """
+    n_frames = np.unique(frame_ids).size
+    for n_processed, accumulator in iter_resume_accumulate_spectra(data,
+                                                                   frame_ids,
+                                                                   workers=workers,
+                                                                   chunk_size=chunk_size,
+                                                                   checkpoint_interval=checkpoint_interval,
+                                                                   mz_bins=mz_bins):
+        if progress_callback is not None:
+            progress_callback(n_processed, n_frames)
+    return accumulator.mz_array, accumulator.get_average()
+
+
+def get_points_in_polygon(x, y, polygon_x, polygon_y):
+    """
+    Test which points are inside a polygon using the even-odd rule. The test is vectorized over the points, so x and y
+    can be any arrays that broadcast against each other (i.e. a row of columns and a column of rows).
+
+    :param x: Numpy array containing the x values of the points.
+    :type x: numpy.array
+    :param y: Numpy array containing the y values of the points.
+    :type y: numpy.array
+    :param polygon_x: x values of the polygon vertices.
+    :type polygon_x: numpy.array
+    :param polygon_y: y values of the polygon vertices.
+    :type polygon_y: numpy.array
+    :return: Boolean numpy array with the broadcast shape of x and y.
+    :rtype: numpy.array
+    """
+    inside = np.zeros(np.broadcast(x, y).shape, dtype=bool)
+    j = len(polygon_x) - 1
+    for i in range(len(polygon_x)):
+        if polygon_y[i] != polygon_y[j]:
+            crosses = (polygon_y[i] > y) != (polygon_y[j] > y)
+            x_intersect = (polygon_x[j] - polygon_x[i]) * (y - polygon_y[i]) / (polygon_y[j] - polygon_y[i]) + \
+                polygon_x[i]
+            inside ^= crosses & (x < x_intersect)
+        j = i
+    return inside
+
+
+def get_roi_mask(selected_data, shape):
+    """
+    Get the pixels of an image whose centers are within a box or lasso selection made on its graph. Pixel centers are
+    at their full resolution column and row, which is how ion image figures are plotted at every pyramid level.
+
+    :param selected_data: selectedData of the graph.
+    :type selected_data: dict | None
+    :param shape: Shape of the image (number of rows, number of columns).
+    :type shape: tuple[int]
+    :return: 2D boolean numpy array or None if selectedData does not contain a box or lasso selection.
+    :rtype: numpy.array | None
+    """
+    if not selected_data:
+        return None
+    is_box = bool(selected_data.get('range'))
+    if is_box:
+        selection = selected_data['range']
+    elif selected_data.get('lassoPoints'):
+        selection = selected_data['lassoPoints']
+    else:
+        return None
+    # Panels of multi-channel ion images share pixel coordinates, so the axes of whichever panel was selected are used.
+    x_values = next((value for key, value in selection.items() if key.startswith('x')), None)
+    y_values = next((value for key, value in selection.items() if key.startswith('y')), None)
+    if not x_values or not y_values:
+        return None
+    x_values = np.asarray(x_values, dtype=np.float64)
+    y_values = np.asarray(y_values, dtype=np.float64)
+    # Only the pixels within the bounding box of the selection are tested.
+    row_start = max(int(np.ceil(np.min(y_values))), 0)
+    row_stop = min(int(np.floor(np.max(y_values))) + 1, shape[0])
+    col_start = max(int(np.ceil(np.min(x_values))), 0)
+    col_stop = min(int(np.floor(np.max(x_values))) + 1, shape[1])
+    mask = np.zeros(shape, dtype=bool)
+    if row_start >= row_stop or col_start >= col_stop:
+        return mask
+    if is_box:
+        mask[row_start:row_stop, col_start:col_stop] = True
+    else:
+        mask[row_start:row_stop, col_start:col_stop] = get_points_in_polygon(
+            np.arange(col_start, col_stop)[np.newaxis, :],
+            np.arange(row_start, row_stop)[:, np.newaxis],
+            x_values,
+            y_values)
+    return mask
+
+
+def get_roi_frame_ids(pixel_index, selected_data):
+    """
+    Get the frame IDs of the pixels within a box or lasso selection made on an ion image graph.
+
+    :param pixel_index: Pixel index of the dataset.
+    :type pixel_index: TSFImagingDataViewer.util.PixelIndex
+    :param selected_data: selectedData of the ion image graph.
+    :type selected_data: dict | None
+    :return: Sorted numpy array of frame IDs. Empty if nothing is selected.
+    :rtype: numpy.array
+    """
+    mask = get_roi_mask(selected_data, pixel_index.shape)
+    if mask is None:
+        return np.array([], dtype=np.int64)
+    frame_ids = pixel_index.frame_grid[mask]
+    return np.sort(frame_ids[frame_ids != 0])
+
+
+def iter_accumulate_roi_spectra(data, frame_ids, spectrum_cache=None, datacube=None, workers=1,
+                                chunk_size=DEFAULT_CHUNK_SIZE, mz_bins=None):
+    """
+    Accumulate the profile spectra of the frames within a region of interest, yielding progress after each chunk of
+    frames. If a datacube is provided, the rows of the frames are added directly from it a chunk at a time. Otherwise,
+    frames that are already in the spectrum cache are added from memory and the remaining frames are read in chunks,
+    in worker processes if workers is greater than 1. If the spectra read fit in the spectrum cache, they are added to
+    it so that overlapping regions do not read them again; larger regions are summed in the worker processes instead
+    so that they do not evict every other cached spectrum.
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param frame_ids: List of frame IDs to accumulate.
+    :type frame_ids: list[int]
+    :param spectrum_cache: Optional spectrum cache of the dataset.
+    :type spectrum_cache: TSFImagingDataViewer.cache.SpectrumCache | None
+    :param datacube: Optional datacube of the dataset.
+    :type datacube: TSFImagingDataViewer.datacube.Datacube | None
+    :param workers: Number of worker processes used to read frames.
+    :type workers: int
+    :param chunk_size: Number of frames accumulated per chunk.
+    :type chunk_size: int
+    :param mz_bins: Optional m/z bins used to bin each spectrum. A datacube must have been built with the same bins.
+    :type mz_bins: TSFImagingDataViewer.util.MzBins | None
+    :return: Generator yielding the number of frames accumulated so far and the accumulator.
+    """
+    frame_ids = np.unique(frame_ids)
+    accumulator = SpectrumAccumulator(mz_bins)
+    if datacube is not None:
+        # Rows are read in ascending order to keep reads from the memory-mapped datacube sequential.
+        rows = np.flatnonzero(np.isin(datacube.frame_ids, frame_ids))
+        for start in range(0, rows.size, chunk_size):
+            accumulator.add_intensities(datacube.mz_array, datacube.intensities[rows[start:start + chunk_size]])
+            yield accumulator.n_spectra, accumulator
+        return
+    remaining_frame_ids = frame_ids
+    if spectrum_cache is not None:
+        is_cached = np.zeros(frame_ids.size, dtype=bool)
+        for position, i in enumerate(frame_ids):
+            spectrum = spectrum_cache.get_cached(i)
+            if spectrum is not None:
+                accumulator.add_spectrum(spectrum.mz_array, spectrum.intensity_array)
+                is_cached[position] = True
+        remaining_frame_ids = frame_ids[~is_cached]
+        if accumulator.n_spectra > 0:
+            yield accumulator.n_spectra, accumulator
+        if remaining_frame_ids.size > 0:
+            # The size of the first spectrum read is used to estimate whether every spectrum fits in the cache.
+            spectrum = spectrum_cache.get(remaining_frame_ids[0])
+            accumulator.add_spectrum(spectrum.mz_array, spectrum.intensity_array)
+            remaining_frame_ids = remaining_frame_ids[1:]
+            yield accumulator.n_spectra, accumulator
+            n_bytes = spectrum.mz_array.nbytes + spectrum.intensity_array.nbytes
+            if n_bytes * remaining_frame_ids.size <= spectrum_cache.max_bytes:
+                for spectra in iter_frame_chunks(data,
+                                                 remaining_frame_ids,
+                                                 read_spectra,
+                                                 workers=workers,
+                                                 chunk_size=chunk_size,
+                                                 max_pending=workers):
+                    for spectrum in spectra:
+                        accumulator.add_spectrum(spectrum.mz_array, spectrum.intensity_array)
+                        spectrum_cache.put(spectrum.frame, spectrum)
+                    yield accumulator.n_spectra, accumulator
+                return
+    if remaining_frame_ids.size > 0:
+        yield from iter_accumulate_spectra(data,
+                                           remaining_frame_ids,
+                                           workers=workers,
+                                           chunk_size=chunk_size,
+                                           accumulator=accumulator,
+                                           mz_bins=mz_bins)
+
+
+@timed()
+def create_roi_average_spectrum(data, frame_ids, spectrum_cache=None, datacube=None, workers=1,
+                                chunk_size=DEFAULT_CHUNK_SIZE, progress_callback=None, mz_bins=None):
+    """
+    Create an average spectrum from a TsfData dataset for the frames within a region of interest. See
+    iter_accumulate_roi_spectra().
+
+    :param data: TSF dataset.
+    :type data: pyTDFSDK.classes.TsfData
+    :param frame_ids: List of frame IDs to average.
+    :type frame_ids: list[int]
+    :param spectrum_cache: Optional spectrum cache of the dataset.
+    :type spectrum_cache: TSFImagingDataViewer.cache.SpectrumCache | None
+    :param datacube: Optional datacube of the dataset.
+    :type datacube: TSFImagingDataViewer.datacube.Datacube | None
+    :param workers: Number of worker processes used to read frames.
+    :type workers: int
+    :param chunk_size: Number of frames summed per chunk.
+    :type chunk_size: int
+    :param progress_callback: Optional function called with the number of frames processed so far and the total
+        number of frames after each chunk. May raise an exception to stop the calculation.
+    :type progress_callback: function | None
+    :param mz_bins: Optional m/z bins used to bin each spectrum.
+    :type mz_bins: TSFImagingDataViewer.util.MzBins | None
+    :return: Tuple of the m/z array and the average intensity array.
+    :rtype: tuple[numpy.array]
+    """
+    n_frames = np.unique(frame_ids).size
+    accumulator = SpectrumAccumulator(mz_bins)
+    for n_processed, accumulator in iter_accumulate_roi_spectra(data,
+                                                                frame_ids,
+                                                                spectrum_cache=spectrum_cache,
+                                                                datacube=datacube,
+                                                                workers=workers,
+                                                                chunk_size=chunk_size,
+                                                                mz_bins=mz_bins):
+        if progress_callback is not None:
+            progress_callback(n_processed, n_frames)
+    return accumulator.mz_array, accumulator.get_average()
 
 
 # Copied for pyMALDIviz.
@@ -109,48 +1320,77 @@ def blank_figure():
     return fig
 
 
+@timed()
+def get_spectrum_figure(mz_array, intensity_array, downsampler=DEFAULT_SPECTRUM_DOWNSAMPLER,
+                        n_shown_samples=DEFAULT_SPECTRUM_N_SHOWN_SAMPLES):
+    """
+    Plot a spectrum to a plotly_resampler.FigureResampler figure. The m/z and intensity arrays are passed to the
+    resampler as high frequency data without being copied, so they must not be modified afterwards.
+
+    :param mz_array: Array containing m/z values.
+    :type mz_array: numpy.array
+    :param intensity_array: Array containing intensity values.
+    :type intensity_array: numpy.array
+    :param downsampler: Name of the downsampler in SPECTRUM_DOWNSAMPLERS or a plotly_resampler aggregator instance.
+    :type downsampler: str | plotly_resampler.aggregation.AbstractAggregator
+    :param n_shown_samples: Maximum number of data points sent to the browser for the current view.
+    :type n_shown_samples: int
+    :return: Plotly figure containing mass spectrum.
+    """
+    if isinstance(downsampler, str):
+        downsampler = SPECTRUM_DOWNSAMPLERS[downsampler]()
+    fig = FigureResampler(go.Figure(),
+                          default_n_shown_samples=n_shown_samples,
+                          default_downsampler=downsampler)
+    fig.add_trace(go.Scattergl(mode='lines',
+                               showlegend=False,
+                               hovertemplate='m/z=%{x:.4f}<br>Intensity=%{y:.1f}<extra></extra>'),
+                  hf_x=np.asarray(mz_array),
+                  hf_y=np.asarray(intensity_array))
+    fig.update_layout(xaxis_title='m/z',
+                      yaxis_title='Intensity',
+                      xaxis_tickformat='d',
+                      yaxis_tickformat='~e')
+    return fig
+
+
 # Copied for pyMALDIviz.
-def get_spectrum(spectrum):
+def get_spectrum(spectrum, downsampler=DEFAULT_SPECTRUM_DOWNSAMPLER, n_shown_samples=DEFAULT_SPECTRUM_N_SHOWN_SAMPLES):
     """
-    Plot the spectrum to a plotly.express.line plot wrapped by plotly_resampler.FigureResampler.
+    Plot the spectrum to a plotly_resampler.FigureResampler figure.
 
     :param spectrum: Spectrum object whose data is used to generate the figure.
     :type spectrum: pyTDFSDK.classes.TsfSpectrum
+    :param downsampler: Name of the downsampler in SPECTRUM_DOWNSAMPLERS or a plotly_resampler aggregator instance.
+    :type downsampler: str | plotly_resampler.aggregation.AbstractAggregator
+    :param n_shown_samples: Maximum number of data points sent to the browser for the current view.
+    :type n_shown_samples: int
     :return: Plotly figure containing mass spectrum.
     """
-    spectrum_df = pd.DataFrame({'m/z': copy.deepcopy(spectrum.mz_array),
-                                'Intensity': copy.deepcopy(spectrum.intensity_array)})
-    fig = FigureResampler(px.line(data_frame=spectrum_df,
-                                  x='m/z',
-                                  y='Intensity',
-                                  hover_data={'m/z': ':.4f',
-                                              'Intensity': ':.1f'}))
-    fig.update_layout(xaxis_tickformat='d',
-                      yaxis_tickformat='~e')
-    return fig
+    return get_spectrum_figure(spectrum.mz_array, spectrum.intensity_array, downsampler=downsampler,
+                               n_shown_samples=n_shown_samples)
 
 
-def get_spectrum_from_arrays(spectrum_df):
+def get_spectrum_from_arrays(spectrum_df, downsampler=DEFAULT_SPECTRUM_DOWNSAMPLER,
+                             n_shown_samples=DEFAULT_SPECTRUM_N_SHOWN_SAMPLES):
     """
-    Plot the spectrum to a plotly.express.line plot wrapped by plotly_resampler.FigureResampler.
+    Plot the spectrum to a plotly_resampler.FigureResampler figure.
 
     :param spectrum_df: Spectrum dataframe containing columns 'm/z' and 'Intensity'.
     :type spectrum_df: pandas.DataFrame
+    :param downsampler: Name of the downsampler in SPECTRUM_DOWNSAMPLERS or a plotly_resampler aggregator instance.
+    :type downsampler: str | plotly_resampler.aggregation.AbstractAggregator
+    :param n_shown_samples: Maximum number of data points sent to the browser for the current view.
+    :type n_shown_samples: int
     :return: Plotly figure containing mass spectrum.
     """
-    fig = FigureResampler(px.line(data_frame=spectrum_df,
-                                  x='m/z',
-                                  y='Intensity',
-                                  hover_data={'m/z': ':.4f',
-                                              'Intensity': ':.1f'}))
-    fig.update_layout(xaxis_tickformat='d',
-                      yaxis_tickformat='~e')
-    return fig
+    return get_spectrum_figure(spectrum_df['m/z'].values, spectrum_df['Intensity'].values, downsampler=downsampler,
+                               n_shown_samples=n_shown_samples)
 
 
-def get_ion_image(data, mz, mz_tolerance, mz_tolerance_unit):
+def get_mass_range(data, mz, mz_tolerance, mz_tolerance_unit):
     """
-    Plot the ion image to a plotly.express.imshow plot.
+    Get the lower and upper mass ranges for an m/z value and tolerance, clipped to the acquisition mass range.
 
     :param data: TSF dataset loaded by pyTDFSDK.
     :type data: pyTDFSDK.classes.TsfData
@@ -160,7 +1400,8 @@ def get_ion_image(data, mz, mz_tolerance, mz_tolerance_unit):
     :type mz_tolerance: float
     :param mz_tolerance_unit: Whether the m/z tolerance is in Da or ppm. If not specified, the default tolerance is 0.
     :type mz_tolerance_unit: str
-    :return: Plotly figure containing ion image.
+    :return: Tuple of the lower and upper mass ranges in Daltons.
+    :rtype: tuple[float]
     """
     if mz_tolerance_unit == 'Da':
         tolerance = mz_tolerance
@@ -171,44 +1412,505 @@ def get_ion_image(data, mz, mz_tolerance, mz_tolerance_unit):
 
     lower_mass_range = mz - tolerance
     upper_mass_range = mz + tolerance
-    mz_min = float(data.analysis['GlobalMetadata']['MzAcqRangeLower'])
-    mz_max = float(data.analysis['GlobalMetadata']['MzAcqRangeUpper'])
+    metadata = get_dataset_metadata(data)
+    mz_min = metadata.mz_acq_range_lower
+    mz_max = metadata.mz_acq_range_upper
     if lower_mass_range < mz_min:
         lower_mass_range = mz_min
     if upper_mass_range > mz_max:
         upper_mass_range = mz_max
-    min_x = int(data.analysis['GlobalMetadata']['ImagingAreaMinXIndexPos'])
-    max_x = int(data.analysis['GlobalMetadata']['ImagingAreaMaxXIndexPos'])
-    min_y = int(data.analysis['GlobalMetadata']['ImagingAreaMinYIndexPos'])
-    max_y = int(data.analysis['GlobalMetadata']['ImagingAreaMaxYIndexPos'])
+    return lower_mass_range, upper_mass_range
 
-    frame_ids = data.analysis['Frames']['Id'].values
-    list_of_scan_dicts = []
-    for i in frame_ids:
-        spectrum = TsfSpectrum(data, frame=i, mode='profile')
-        mz_array, intensity_array = trim_spectrum(spectrum.mz_array,
-                                                  spectrum.intensity_array,
-                                                  lower_mass_range,
-                                                  upper_mass_range)
-        list_of_scan_dicts.append({'intensity': np.sum(intensity_array),
-                                   'x_coord': spectrum.coord[0],
-                                   'y_coord': spectrum.coord[1]})
-    intensity_df = pd.DataFrame(list_of_scan_dicts)
-    intensity_df['x_coord'] = intensity_df['x_coord'] - min_x
-    intensity_df['y_coord'] = intensity_df['y_coord'] - min_y
-    if np.sum(intensity_df['intensity']) == 0:
+
+def parse_mz_targets(text, default_mz_tolerance=0, default_mz_tolerance_unit='Da'):
+    """
+    Parse a list of ion image targets with one target per line formatted as 'm/z', 'm/z, tolerance', or
+    'm/z, tolerance, unit'. Missing tolerances and units are replaced by the defaults.
+
+    :param text: Text containing one target per line.
+    :type text: str
+    :param default_mz_tolerance: m/z tolerance used for targets without a tolerance.
+    :type default_mz_tolerance: float
+    :param default_mz_tolerance_unit: m/z tolerance unit used for targets without a unit.
+    :type default_mz_tolerance_unit: str
+    :return: List of tuples containing the m/z value, m/z tolerance, and m/z tolerance unit of each target.
+    :rtype: list[tuple]
+    """
+    targets = []
+    for line in text.splitlines():
+        values = [value.strip() for value in line.replace(';', ',').split(',') if value.strip()]
+        if not values:
+            continue
+        mz = float(values[0])
+        mz_tolerance = float(values[1]) if len(values) > 1 else default_mz_tolerance
+        mz_tolerance_unit = values[2] if len(values) > 2 else default_mz_tolerance_unit
+        if mz_tolerance_unit not in ['Da', 'ppm']:
+            raise ValueError(f'Invalid m/z tolerance unit: {mz_tolerance_unit}')
+        targets.append((mz, mz_tolerance, mz_tolerance_unit))
+    return targets
+
+
+@timed()
+def get_ion_images_array(data, targets, datacube=None, centroid_index=None, workers=1, chunk_size=DEFAULT_CHUNK_SIZE,
+                         progress_callback=None):
+    """
+    Get the ion images of several m/z targets as a 3D array using a single pass over the frames.
+
+    :param data: TSF dataset loaded by pyTDFSDK.
+    :type data: pyTDFSDK.classes.TsfData
+    :param targets: List of tuples containing the m/z value, m/z tolerance (+/-), and m/z tolerance unit ('Da' or
+        'ppm') of each target.
+    :type targets: list[tuple]
+    :param datacube: Optional memory-mapped datacube for the dataset. If provided, intensities are summed from the
+        datacube instead of reading every frame.
+    :type datacube: TSFImagingDataViewer.datacube.Datacube | None
+    :param centroid_index: Optional centroid index for the dataset. If provided, the intensities of the peaks in the
+        index are summed instead of reading every frame. Takes precedence over the datacube.
+    :type centroid_index: TSFImagingDataViewer.centroid_index.CentroidIndex | None
+    :param workers: Number of worker processes used to read frames.
+    :type workers: int
+    :param chunk_size: Number of frames processed per chunk.
+    :type chunk_size: int
+    :param progress_callback: Optional function called with the number of frames processed so far and the total
+        number of frames after each chunk. May raise an exception to stop the calculation.
+    :type progress_callback: function | None
+    :return: 3D numpy array with shape (number of targets, number of rows, number of columns) containing ion images.
+    :rtype: numpy.array
+    """
+    mass_ranges = [get_mass_range(data, mz, mz_tolerance, mz_tolerance_unit)
+                   for mz, mz_tolerance, mz_tolerance_unit in targets]
+    pixel_index = get_pixel_index(data)
+
+    if centroid_index is not None:
+        intensities = np.stack([centroid_index.sum_mass_range(lower_mass_range, upper_mass_range)
+                                for lower_mass_range, upper_mass_range in mass_ranges], axis=1)
+    elif datacube is not None:
+        intensities = np.stack([datacube.sum_mass_range(lower_mass_range, upper_mass_range)
+                                for lower_mass_range, upper_mass_range in mass_ranges], axis=1)
+    else:
+        partial_intensities = []
+        n_processed = 0
+        for partial in iter_frame_chunks(data,
+                                         pixel_index.frame_ids,
+                                         sum_mass_ranges,
+                                         (mass_ranges,),
+                                         workers=workers,
+                                         chunk_size=chunk_size):
+            partial_intensities.append(partial)
+            n_processed += partial.shape[0]
+            if progress_callback is not None:
+                progress_callback(n_processed, pixel_index.frame_ids.size)
+        intensities = np.concatenate(partial_intensities)
+    return pixel_index.scatter(intensities)
+
+
+def get_ion_image_array(data, mz, mz_tolerance, mz_tolerance_unit, datacube=None, centroid_index=None, workers=1,
+                        chunk_size=DEFAULT_CHUNK_SIZE, progress_callback=None):
+    """
+    Get the ion image as a 2D array in which each pixel contains the summed intensity within the m/z tolerance.
+
+    :param data: TSF dataset loaded by pyTDFSDK.
+    :type data: pyTDFSDK.classes.TsfData
+    :param mz: m/z value of interest.
+    :type mz: float
+    :param mz_tolerance: m/z tolerance to be used (+/-).
+    :type mz_tolerance: float
+    :param mz_tolerance_unit: Whether the m/z tolerance is in Da or ppm. If not specified, the default tolerance is 0.
+    :type mz_tolerance_unit: str
+    :param datacube: Optional memory-mapped datacube for the dataset. If provided, intensities are summed from the
+        datacube instead of reading every frame.
+    :type datacube: TSFImagingDataViewer.datacube.Datacube | None
+    :param centroid_index: Optional centroid index for the dataset. If provided, the intensities of the peaks in the
+        index are summed instead of reading every frame. Takes precedence over the datacube.
+    :type centroid_index: TSFImagingDataViewer.centroid_index.CentroidIndex | None
+    :param workers: Number of worker processes used to read frames.
+    :type workers: int
+    :param chunk_size: Number of frames processed per chunk.
+    :type chunk_size: int
+    :param progress_callback: Optional function called with the number of frames processed so far and the total
+        number of frames after each chunk. May raise an exception to stop the calculation.
+    :type progress_callback: function | None
+    :return: 2D numpy array containing the ion image.
+    :rtype: numpy.array
+    """
+    return get_ion_images_array(data,
+                                [(mz, mz_tolerance, mz_tolerance_unit)],
+                                datacube=datacube,
+                                centroid_index=centroid_index,
+                                workers=workers,
+                                chunk_size=chunk_size,
+                                progress_callback=progress_callback)[0]
+
+
+@timed()
+def get_tic_image_array(data, workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Get the total ion count (TIC) image as a 2D array. The summed intensity of each frame is taken from the Frames table
+    if available; otherwise, every frame is read and summed.
+
+    :param data: TSF dataset loaded by pyTDFSDK.
+    :type data: pyTDFSDK.classes.TsfData
+    :param workers: Number of worker processes used to read frames if the Frames table does not contain summed
+        intensities.
+    :type workers: int
+    :param chunk_size: Number of frames processed per chunk.
+    :type chunk_size: int
+    :return: 2D numpy array containing the TIC image.
+    :rtype: numpy.array
+    """
+    pixel_index = get_pixel_index(data)
+    summed_intensities = get_dataset_metadata(data).summed_intensities
+    if summed_intensities is not None:
+        # The pixel index and the metadata share the frame order of the Frames table.
+        tic = summed_intensities
+    else:
+        tic = np.concatenate(map_frame_chunks(data,
+                                              pixel_index.frame_ids,
+                                              sum_mass_ranges,
+                                              ([(-np.inf, np.inf)],),
+                                              workers=workers,
+                                              chunk_size=chunk_size))[:, 0]
+    return pixel_index.scatter(tic)
+
+
+def iter_ion_images_array(data, targets, strides=PROGRESSIVE_STRIDES, datacube=None, centroid_index=None, workers=1,
+                          chunk_size=DEFAULT_CHUNK_SIZE, progress_callback=None):
+    """
+    Progressively calculate the ion images of several m/z targets from coarse to fine resolution. Each pass reads the
+    frames on every stride-th row and column that have not been read by a previous pass, and yields a preview in which
+    each pixel takes the value of the nearest pixel read so far above and to the left of it. A final pass with a stride
+    of 1 is always performed, so the last images yielded are identical to those from get_ion_images_array(). If a
+    datacube or centroid index is provided, the full resolution images are yielded in a single pass.
+
+    :param data: TSF dataset loaded by pyTDFSDK.
+    :type data: pyTDFSDK.classes.TsfData
+    :param targets: List of tuples containing the m/z value, m/z tolerance (+/-), and m/z tolerance unit ('Da' or
+        'ppm') of each target.
+    :type targets: list[tuple]
+    :param strides: Row and column strides of each pass in descending order.
+    :type strides: tuple[int]
+    :param datacube: Optional memory-mapped datacube for the dataset.
+    :type datacube: TSFImagingDataViewer.datacube.Datacube | None
+    :param centroid_index: Optional centroid index for the dataset.
+    :type centroid_index: TSFImagingDataViewer.centroid_index.CentroidIndex | None
+    :param workers: Number of worker processes used to read frames.
+    :type workers: int
+    :param chunk_size: Number of frames processed per chunk.
+    :type chunk_size: int
+    :param progress_callback: Optional function called with the number of frames processed so far and the total
+        number of frames after each chunk. May raise an exception to stop the calculation.
+    :type progress_callback: function | None
+    :return: Generator yielding tuples of the number of frames processed so far, the stride of the pass, and a 3D
+        numpy array with shape (number of targets, number of rows, number of columns) containing the ion images.
+    """
+    pixel_index = get_pixel_index(data)
+    n_frames = pixel_index.frame_ids.size
+    if centroid_index is not None or datacube is not None:
+        yield n_frames, 1, get_ion_images_array(data,
+                                                targets,
+                                                datacube=datacube,
+                                                centroid_index=centroid_index,
+                                                progress_callback=progress_callback)
+        return
+
+    mass_ranges = [get_mass_range(data, mz, mz_tolerance, mz_tolerance_unit)
+                   for mz, mz_tolerance, mz_tolerance_unit in targets]
+    intensities = np.zeros((n_frames, len(mass_ranges)), dtype=np.float64)
+    is_read = np.zeros(n_frames, dtype=bool)
+    n_processed = 0
+    # Every pass shares the same worker processes.
+    with worker_pool(data, workers) as pool:
+        for stride in sorted({int(stride) for stride in strides if int(stride) > 1} | {1}, reverse=True):
+            positions = np.flatnonzero(~is_read & (pixel_index.rows % stride == 0) & (pixel_index.cols % stride == 0))
+            offset = 0
+            for partial in iter_frame_chunks(data,
+                                             pixel_index.frame_ids[positions],
+                                             sum_mass_ranges,
+                                             (mass_ranges,),
+                                             workers=workers,
+                                             chunk_size=chunk_size,
+                                             pool=pool):
+                intensities[positions[offset:offset + partial.shape[0]]] = partial
+                offset += partial.shape[0]
+                n_processed += partial.shape[0]
+                if progress_callback is not None:
+                    progress_callback(n_processed, n_frames)
+            is_read[positions] = True
+            ion_images = pixel_index.scatter(intensities)
+            if stride > 1:
+                # Fill each stride x stride block with the value of the pixel read at its top left corner.
+                rows = np.arange(pixel_index.shape[0]) // stride * stride
+                cols = np.arange(pixel_index.shape[1]) // stride * stride
+                ion_images = ion_images[:, rows[:, np.newaxis], cols[np.newaxis, :]]
+            yield n_processed, stride, ion_images
+
+
+def downsample_image(image):
+    """
+    Halve the resolution of an image by taking the maximum of each 2x2 block of pixels. Images with an odd number of
+    rows or columns are padded with zeros.
+
+    :param image: 2D image, or 3D stack of images with shape (number of channels, number of rows, number of columns).
+    :type image: numpy.array
+    :return: Downsampled image.
+    :rtype: numpy.array
+    """
+    rows, cols = image.shape[-2:]
+    padding = [(0, 0)] * (image.ndim - 2) + [(0, rows % 2), (0, cols % 2)]
+    padded_image = np.pad(image, padding)
+    return padded_image.reshape(image.shape[:-2] + (padded_image.shape[-2] // 2, 2,
+                                                    padded_image.shape[-1] // 2, 2)).max(axis=(-3, -1))
+
+
+class ImagePyramid(object):
+    """
+    Multi-resolution pyramid of an ion or TIC image split into fixed-size tiles. Level 0 is the full resolution image
+    and each following level halves the resolution with downsample_image(), so the intensity range is the same at every
+    level. Levels are added until the whole image fits in a single tile.
+
+    :param image: 2D image, or 3D stack of images with shape (number of channels, number of rows, number of columns).
+    :type image: numpy.array
+    :param tile_size: Number of pixels along each side of a tile.
+    :type tile_size: int
+    """
+    def __init__(self, image, tile_size=IMAGE_TILE_SIZE):
+        self.tile_size = tile_size
+        self.shape = image.shape[-2:]
+        self.levels = [image]
+        while max(self.levels[-1].shape[-2:]) > tile_size:
+            self.levels.append(downsample_image(self.levels[-1]))
+        self.nbytes = sum(level.nbytes for level in self.levels)
+
+    def get_tile(self, level, tile_row, tile_col):
+        """
+        Get a tile of the pyramid. Tiles on the bottom and right edges of a level may be smaller than tile_size.
+
+        :param level: Pyramid level. 0 is the full resolution image.
+        :type level: int
+        :param tile_row: Row of the tile within the level.
+        :type tile_row: int
+        :param tile_col: Column of the tile within the level.
+        :type tile_col: int
+        :return: Tile as a view of the level.
+        :rtype: numpy.array
+        """
+        return self.levels[level][...,
+                                  tile_row * self.tile_size:(tile_row + 1) * self.tile_size,
+                                  tile_col * self.tile_size:(tile_col + 1) * self.tile_size]
+
+    def get_view(self, x_range=None, y_range=None, max_size=IMAGE_MAX_VIEW_SIZE):
+        """
+        Get the tiles covering the visible part of the image, stitched together, at the finest level at which the
+        visible part is at most max_size pixels along each side.
+
+        :param x_range: Visible range of columns in full resolution pixel coordinates, or None for every column.
+        :type x_range: tuple[float] | None
+        :param y_range: Visible range of rows in full resolution pixel coordinates, or None for every row.
+        :type y_range: tuple[float] | None
+        :param max_size: Maximum number of visible pixels along each side of the view.
+        :type max_size: int
+        :return: Tuple of the stitched tiles, the full resolution column and row of the center of their first pixel,
+            and the number of full resolution pixels per pixel along each side.
+        :rtype: tuple
+        """
+        rows, cols = self.shape
+        # Pixel i is centered on coordinate i, so it is visible between i - 0.5 and i + 0.5.
+        x_min, x_max = (0, cols) if x_range is None else (int(np.floor(min(x_range) + 0.5)),
+                                                          int(np.ceil(max(x_range) + 0.5)))
+        y_min, y_max = (0, rows) if y_range is None else (int(np.floor(min(y_range) + 0.5)),
+                                                          int(np.ceil(max(y_range) + 0.5)))
+        x_min, x_max = max(0, min(x_min, cols - 1)), max(1, min(x_max, cols))
+        y_min, y_max = max(0, min(y_min, rows - 1)), max(1, min(y_max, rows))
+        level = 0
+        while level < len(self.levels) - 1 and max(x_max - x_min, y_max - y_min) / 2 ** level > max_size:
+            level += 1
+        scale = 2 ** level
+        tile_pixels = self.tile_size * scale
+        first_tile_row, last_tile_row = y_min // tile_pixels, max(y_min, y_max - 1) // tile_pixels
+        first_tile_col, last_tile_col = x_min // tile_pixels, max(x_min, x_max - 1) // tile_pixels
+        view = np.concatenate([np.concatenate([self.get_tile(level, tile_row, tile_col)
+                                               for tile_col in range(first_tile_col, last_tile_col + 1)], axis=-1)
+                               for tile_row in range(first_tile_row, last_tile_row + 1)], axis=-2)
+        return (view,
+                first_tile_col * tile_pixels + (scale - 1) / 2,
+                first_tile_row * tile_pixels + (scale - 1) / 2,
+                scale)
+
+
+def get_relayout_ranges(relayoutdata):
+    """
+    Get the visible x and y ranges of an image graph from its relayoutData.
+
+    :param relayoutdata: relayoutData of the graph.
+    :type relayoutdata: dict
+    :return: Tuple of the x and y ranges, each None if the axis is autoscaled, or None if relayoutData does not change
+        the axis ranges (i.e. only the drag mode changed).
+    :rtype: tuple | None
+    """
+    ranges = {'x': [None, None], 'y': [None, None]}
+    changed = False
+    for key, value in relayoutdata.items():
+        axis, _, prop = key.partition('.')
+        if axis.rstrip('0123456789') not in ['xaxis', 'yaxis']:
+            continue
+        if prop == 'range[0]':
+            ranges[axis[0]][0] = value
+        elif prop == 'range[1]':
+            ranges[axis[0]][1] = value
+        elif prop == 'range':
+            ranges[axis[0]] = list(value)
+        elif prop != 'autorange':
+            continue
+        changed = True
+    if not changed:
+        return None
+    return tuple(tuple(ranges[axis]) if None not in ranges[axis] else None for axis in ['x', 'y'])
+
+
+def get_image_coords(image_array, x0=0, y0=0, scale=1):
+    """
+    Get the full resolution pixel coordinates of the pixel centers of a (possibly downsampled) image.
+
+    :param image_array: Image with the number of rows and columns as its last two dimensions.
+    :type image_array: numpy.array
+    :param x0: Full resolution column of the center of the first pixel.
+    :type x0: float
+    :param y0: Full resolution row of the center of the first pixel.
+    :type y0: float
+    :param scale: Number of full resolution pixels per pixel along each side.
+    :type scale: int
+    :return: Tuple of the column and row coordinates.
+    :rtype: tuple[numpy.array]
+    """
+    return x0 + scale * np.arange(image_array.shape[-1]), y0 + scale * np.arange(image_array.shape[-2])
+
+
+@timed()
+def get_ion_image_figure(ion_image_array, x0=0, y0=0, scale=1, range_max=None):
+    """
+    Plot an ion image array to a plotly.express.imshow plot. Views returned by ImagePyramid.get_view() are plotted at
+    their full resolution coordinates, so clicked coordinates always refer to full resolution pixels.
+
+    :param ion_image_array: 2D numpy array containing the ion image.
+    :type ion_image_array: numpy.array
+    :param x0: Full resolution column of the center of the first pixel.
+    :type x0: float
+    :param y0: Full resolution row of the center of the first pixel.
+    :type y0: float
+    :param scale: Number of full resolution pixels per pixel along each side.
+    :type scale: int
+    :param range_max: Upper end of the color scale. Defaults to the maximum intensity of ion_image_array.
+    :type range_max: float | None
+    :return: Plotly figure containing ion image.
+    """
+    if range_max is not None and range_max > 0:
+        upper_range_color = range_max
+    elif np.sum(ion_image_array) == 0:
         upper_range_color = 1
     else:
         upper_range_color = None
-    ion_image_array = pd.merge(intensity_df,
-                               pd.DataFrame([{'x_coord': i, 'y_coord': j}
-                                             for i in np.arange(0, max_x - min_x + 1, 1)
-                                             for j in np.arange(0, max_y - min_y + 1, 1)]),
-                               how='outer',
-                               on=['x_coord', 'y_coord']).fillna(value=0).pivot(index='y_coord',
-                                                                                columns='x_coord',
-                                                                                values='intensity').fillna(value=0)
-    ion_image = px.imshow(ion_image_array.values, color_continuous_scale='viridis', range_color=[0, upper_range_color])
+    x, y = get_image_coords(ion_image_array, x0, y0, scale)
+    ion_image = px.imshow(ion_image_array, x=x, y=y, color_continuous_scale='viridis',
+                          range_color=[0, upper_range_color])
+    ion_image.update_xaxes(showticklabels=False)
+    ion_image.update_yaxes(showticklabels=False)
+    return ion_image
+
+
+def normalize_ion_images(ion_images_array):
+    """
+    Scale each channel of a multi-channel ion image to the range 0-1 using its maximum intensity.
+
+    :param ion_images_array: 3D numpy array with shape (number of channels, number of rows, number of columns).
+    :type ion_images_array: numpy.array
+    :return: 3D numpy array containing normalized ion images.
+    :rtype: numpy.array
+    """
+    max_intensities = np.max(ion_images_array, axis=(1, 2), keepdims=True)
+    max_intensities[max_intensities == 0] = 1
+    return ion_images_array / max_intensities
+
+
+@timed()
+def get_multichannel_ion_image_figure(ion_images_array, labels, mode='panels', x0=0, y0=0, scale=1, normalize=True):
+    """
+    Plot a multi-channel ion image either as separate panels or as an RGB overlay. Each channel is normalized to its
+    maximum intensity.
+
+    :param ion_images_array: 3D numpy array with shape (number of channels, number of rows, number of columns).
+    :type ion_images_array: numpy.array
+    :param labels: Label of each channel.
+    :type labels: list[str]
+    :param mode: 'panels' to plot each channel in its own panel or 'rgb' to overlay up to three channels as the red,
+        green, and blue channels of a single image.
+    :type mode: str
+    :param x0: Full resolution column of the center of the first pixel.
+    :type x0: float
+    :param y0: Full resolution row of the center of the first pixel.
+    :type y0: float
+    :param scale: Number of full resolution pixels per pixel along each side.
+    :type scale: int
+    :param normalize: Whether to normalize the channels. Set to False if ion_images_array is part of a larger image
+        that has already been normalized.
+    :type normalize: bool
+    :return: Plotly figure containing the multi-channel ion image.
+    """
+    normalized_ion_images = normalize_ion_images(ion_images_array) if normalize else ion_images_array
+    x, y = get_image_coords(ion_images_array, x0, y0, scale)
+    if mode == 'rgb':
+        if normalized_ion_images.shape[0] > 3:
+            raise ValueError('RGB overlays support at most 3 channels.')
+        rgb_image = np.zeros(normalized_ion_images.shape[1:] + (3,), dtype=np.uint8)
+        for channel, normalized_ion_image in enumerate(normalized_ion_images):
+            rgb_image[:, :, channel] = np.round(normalized_ion_image * 255).astype(np.uint8)
+        ion_image = px.imshow(rgb_image, x=x, y=y)
+        ion_image.update_layout(title=' / '.join(f'{color}: {label}'
+                                                 for color, label in zip(['R', 'G', 'B'], labels)))
+    else:
+        ion_image = px.imshow(normalized_ion_images,
+                              x=x,
+                              y=y,
+                              facet_col=0,
+                              facet_col_wrap=min(len(labels), 4),
+                              color_continuous_scale='viridis',
+                              range_color=[0, 1])
+        ion_image.for_each_annotation(lambda annotation:
+                                      annotation.update(text=labels[int(annotation.text.split('=')[-1])]))
     ion_image.update_xaxes(showticklabels=False)
     ion_image.update_yaxes(showticklabels=False)
     return ion_image
+
+
+def get_ion_image(data, mz, mz_tolerance, mz_tolerance_unit, datacube=None, centroid_index=None, workers=1,
+                  chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Plot the ion image to a plotly.express.imshow plot.
+
+    :param data: TSF dataset loaded by pyTDFSDK.
+    :type data: pyTDFSDK.classes.TsfData
+    :param mz: m/z value of interest.
+    :type mz: float
+    :param mz_tolerance: m/z tolerance to be used (+/-).
+    :type mz_tolerance: float
+    :param mz_tolerance_unit: Whether the m/z tolerance is in Da or ppm. If not specified, the default tolerance is 0.
+    :type mz_tolerance_unit: str
+    :param datacube: Optional memory-mapped datacube for the dataset. If provided, intensities are summed from the
+        datacube instead of reading every frame.
+    :type datacube: TSFImagingDataViewer.datacube.Datacube | None
+    :param centroid_index: Optional centroid index for the dataset. If provided, the intensities of the peaks in the
+        index are summed instead of reading every frame. Takes precedence over the datacube.
+    :type centroid_index: TSFImagingDataViewer.centroid_index.CentroidIndex | None
+    :param workers: Number of worker processes used to read frames.
+    :type workers: int
+    :param chunk_size: Number of frames processed per chunk.
+    :type chunk_size: int
+    :return: Plotly figure containing ion image.
+    """
+    return get_ion_image_figure(get_ion_image_array(data,
+                                                    mz,
+                                                    mz_tolerance,
+                                                    mz_tolerance_unit,
+                                                    datacube=datacube,
+                                                    centroid_index=centroid_index,
+                                                    workers=workers,
+                                                    chunk_size=chunk_size))
@@ -0,0 +1,292 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import datetime
+import tracemalloc
+import subprocess
+import numpy as np
+from TSFImagingDataViewer.util import (PIXEL_INDICES, get_pixel_index, read_spectrum, get_spectrum,
+                                       get_ion_image_array, get_ion_images_array, create_average_spectrum,
+                                       get_mz_bins)
+from benchmarks.synthetic import SyntheticTsfData, use_synthetic_sdk, remove_synthetic_dataset
+
+# Number of pixels along X, number of pixels along Y, and number of profile data points per spectrum.
+BENCHMARK_SIZES = {'small': (32, 32, 20000),
+                   'medium': (64, 64, 50000),
+                   'large': (128, 128, 100000)}
+BENCHMARK_ION_IMAGE_TARGETS = [(304.2, 0.05, 'Da'), (496.3, 0.05, 'Da'), (760.6, 10, 'ppm'), (782.6, 10, 'ppm'),
+                               (1296.7, 0.05, 'Da')]
+BENCHMARK_MZ_BINNING = (0.5, 'Da')
+BENCHMARK_N_LOOKUPS = 10000
+BENCHMARK_N_NAVIGATION_STEPS = 50
+BENCHMARK_RESULTS_DIRNAME = 'results'
+# Each startup benchmark runs in a fresh interpreter, which prints the time and peak traced memory of the statement.
+STARTUP_BENCHMARK_SCRIPT = '''
+import sys
+import time
+import tracemalloc
+if sys.argv[1] == 'memory':
+    tracemalloc.start()
+start = time.perf_counter()
+{statement}
+print(time.perf_counter() - start, tracemalloc.get_traced_memory()[1])
+'''
+
+
+def benchmark_pixel_index(data):
+    """
+    Build the pixel index of the dataset from scratch.
+    """
+    PIXEL_INDICES.pop(data, None)
+    get_pixel_index(data)
+
+
+def benchmark_coordinate_lookup(data):
+    """
+    Look up the coordinates of random frames and the frames at those coordinates.
+    """
+    pixel_index = get_pixel_index(data)
+    rng = np.random.default_rng(0)
+    for frame in rng.choice(pixel_index.frame_ids, BENCHMARK_N_LOOKUPS):
+        x_coord, y_coord = pixel_index.get_coords(frame)
+        pixel_index.get_frame(x_coord, y_coord)
+
+
+def benchmark_spectrum_figure(data):
+    """
+    Read a spectrum, build its figure, and resample it to a zoomed in view.
+    """
+    fig = get_spectrum(read_spectrum(data, 1))
+    fig.construct_update_data_patch({'xaxis.range[0]': 700, 'xaxis.range[1]': 800})
+
+
+def benchmark_navigation(data):
+    """
+    Step along the first row of pixels the same way the X coordinate callback does, reading and plotting the spectrum
+    of each pixel.
+    """
+    pixel_index = get_pixel_index(data)
+    x_coord, y_coord = pixel_index.get_coords(pixel_index.frame_ids[0])
+    for step in range(BENCHMARK_N_NAVIGATION_STEPS):
+        frame = pixel_index.get_frame(x_coord + step, y_coord)
+        if frame is not None:
+            get_spectrum(read_spectrum(data, frame))
+
+
+def benchmark_ion_image(data):
+    """
+    Calculate a single ion image from profile spectra.
+    """
+    get_ion_image_array(data, *BENCHMARK_ION_IMAGE_TARGETS[0])
+
+
+def benchmark_multichannel_ion_image(data):
+    """
+    Calculate several ion images in a single pass over the profile spectra.
+    """
+    get_ion_images_array(data, BENCHMARK_ION_IMAGE_TARGETS)
+
+
+def benchmark_average_spectrum(data):
+    """
+    Calculate the full average spectrum.
+    """
+    create_average_spectrum(data, data.analysis['Frames']['Id'].values)
+
+
+def benchmark_binned_average_spectrum(data):
+    """
+    Calculate the full average spectrum of binned spectra.
+    """
+    create_average_spectrum(data, data.analysis['Frames']['Id'].values,
+                            mz_bins=get_mz_bins(data, *BENCHMARK_MZ_BINNING))
+
+
+BENCHMARKS = {'pixel_index': benchmark_pixel_index,
+              'coordinate_lookup': benchmark_coordinate_lookup,
+              'spectrum_figure': benchmark_spectrum_figure,
+              'navigation': benchmark_navigation,
+              'ion_image': benchmark_ion_image,
+              'multichannel_ion_image': benchmark_multichannel_ion_image,
+              'average_spectrum': benchmark_average_spectrum,
+              'binned_average_spectrum': benchmark_binned_average_spectrum}
+STARTUP_BENCHMARKS = {'import_package': 'import TSFImagingDataViewer; TSFImagingDataViewer.VERSION',
+                      'import_dashboard': 'import TSFImagingDataViewer.dashboard',
+                      'create_app': 'from TSFImagingDataViewer.dashboard import get_app; get_app()'}
+
+
+def get_args(args=None):
+    """
+    Parse command line parameters for the benchmarks.
+
+    :param args: List of command line arguments. Defaults to sys.argv.
+    :type args: list[str] | None
+    :return: Arguments with default values if not specified by the user.
+    :rtype: dict
+    """
+    parser = argparse.ArgumentParser(description='Benchmark TSFImagingDataViewer on synthetic datasets.')
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium'], choices=list(BENCHMARK_SIZES.keys()),
+                        help='Dataset sizes to benchmark.')
+    parser.add_argument('--benchmarks', nargs='+', default=list(BENCHMARKS.keys()), choices=list(BENCHMARKS.keys()),
+                        help='Benchmarks to run.')
+    parser.add_argument('--startup', action='store_true',
+                        help='Also time importing the package and creating the Dash app in fresh interpreters.')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs of each benchmark.')
+    parser.add_argument('--output', default='',
+                        help='Path to the JSON results file. Defaults to a timestamped file in benchmarks/results.')
+    parser.add_argument('--compare', default='', help='Path to a previous JSON results file to compare against.')
+    return vars(parser.parse_args(args))
+
+
+def get_git_commit():
+    """
+    Get the current git commit of the repository, if available.
+
+    :return: Commit hash or None.
+    :rtype: str | None
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(benchmark, data, repeat):
+    """
+    Time a benchmark and measure its peak traced memory. Peak memory is measured in a separate run so that tracing
+    does not affect the timings.
+
+    :param benchmark: Benchmark function called with the dataset.
+    :type benchmark: function
+    :param data: Synthetic dataset.
+    :type data: benchmarks.synthetic.SyntheticTsfData
+    :param repeat: Number of timed runs.
+    :type repeat: int
+    :return: Dictionary containing the run times in seconds and the peak memory in bytes.
+    :rtype: dict
+    """
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        benchmark(data)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    benchmark(data)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'times': times,
+            'min': min(times),
+            'median': float(np.median(times)),
+            'peak_memory_bytes': peak_memory}
+
+
+def run_startup_benchmark(statement, repeat):
+    """
+    Time a statement in fresh interpreters started from the repository root and measure its peak traced memory in a
+    separate run.
+
+    :param statement: Python statement to time.
+    :type statement: str
+    :param repeat: Number of timed runs.
+    :type repeat: int
+    :return: Dictionary containing the run times in seconds and the peak memory in bytes.
+    :rtype: dict
+    """
+    def run(mode):
+        output = subprocess.check_output([sys.executable, '-c', STARTUP_BENCHMARK_SCRIPT.format(statement=statement),
+                                          mode],
+                                         cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        duration, peak_memory = output.decode('utf-8').split()[-2:]
+        return float(duration), int(peak_memory)
+
+    times = [run('time')[0] for i in range(repeat)]
+    return {'times': times,
+            'min': min(times),
+            'median': float(np.median(times)),
+            'peak_memory_bytes': run('memory')[1]}
+
+
+def compare_results(results, previous_results):
+    """
+    Print the median time and peak memory of each benchmark relative to a previous run.
+
+    :param results: Results of the current run.
+    :type results: dict
+    :param previous_results: Results of a previous run.
+    :type previous_results: dict
+    """
+    previous = {(result['size'], result['benchmark']): result for result in previous_results['results']}
+    print(f'\nCompared to {previous_results.get("git_commit")} ({previous_results.get("timestamp")}):')
+    for result in results['results']:
+        key = (result['size'], result['benchmark'])
+        if key not in previous:
+            continue
+        time_ratio = result['median'] / previous[key]['median'] if previous[key]['median'] > 0 else float('nan')
+        memory_ratio = (result['peak_memory_bytes'] / previous[key]['peak_memory_bytes']
+                        if previous[key]['peak_memory_bytes'] > 0 else float('nan'))
+        print(f'{key[0]:>8} {key[1]:<24} time x{time_ratio:.2f}  peak memory x{memory_ratio:.2f}')
+
+
+def main(args=None):
+    """
+    Run the benchmarks and save the results as JSON.
+
+    :param args: List of command line arguments. Defaults to sys.argv.
+    :type args: list[str] | None
+    :return: Results of the run.
+    :rtype: dict
+    """
+    args = get_args(args)
+    results = {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+               'git_commit': get_git_commit(),
+               'python': platform.python_version(),
+               'numpy': np.__version__,
+               'platform': platform.platform(),
+               'repeat': args['repeat'],
+               'results': []}
+    with use_synthetic_sdk():
+        for size in args['sizes']:
+            n_x, n_y, n_points = BENCHMARK_SIZES[size]
+            data = SyntheticTsfData(n_x, n_y, n_points)
+            try:
+                for name in args['benchmarks']:
+                    result = run_benchmark(BENCHMARKS[name], data, args['repeat'])
+                    result.update({'benchmark': name,
+                                   'size': size,
+                                   'n_frames': n_x * n_y,
+                                   'n_points': n_points})
+                    results['results'].append(result)
+                    print(f'{size:>8} {name:<24} median {result["median"]:.4f} s  '
+                          f'peak memory {result["peak_memory_bytes"] / 1024 ** 2:.1f} MB')
+            finally:
+                remove_synthetic_dataset(data)
+    if args['startup']:
+        for name, statement in STARTUP_BENCHMARKS.items():
+            result = run_startup_benchmark(statement, args['repeat'])
+            result.update({'benchmark': name, 'size': 'startup'})
+            results['results'].append(result)
+            print(f'{"startup":>8} {name:<24} median {result["median"]:.4f} s  '
+                  f'peak memory {result["peak_memory_bytes"] / 1024 ** 2:.1f} MB')
+
+    output = args['output']
+    if not output:
+        results_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), BENCHMARK_RESULTS_DIRNAME)
+        os.makedirs(results_dir, exist_ok=True)
+        output = os.path.join(results_dir, f'benchmarks_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}.json')
+    with open(output, 'w') as results_file:
+        json.dump(results, results_file, indent=4)
+    print(f'Results saved to {output}')
+
+    if args['compare']:
+        with open(args['compare'], 'r') as previous_results_file:
+            compare_results(results, json.load(previous_results_file))
+    return results
+
+
+if __name__ == '__main__':
+    main()
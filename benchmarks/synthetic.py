@@ -0,0 +1,115 @@
+import shutil
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import TSFImagingDataViewer.util as util
+
+SYNTHETIC_MZ_RANGE = (100.0, 2000.0)
+SYNTHETIC_PEAK_MZS = np.array([304.2, 496.3, 524.4, 650.4, 703.6, 760.6, 782.6, 806.6, 1044.5, 1296.7])
+SYNTHETIC_PEAK_WIDTH = 0.02
+
+
+class SyntheticTsfData(object):
+    """
+    In-process stand-in for pyTDFSDK.classes.TsfData with the same analysis tables used by TSFImagingDataViewer. Every
+    frame shares a profile m/z axis; intensities are generated deterministically from the frame ID on each read so that
+    the cost of decoding a spectrum is still paid by every read.
+
+    :param n_x: Number of pixels along the X axis.
+    :type n_x: int
+    :param n_y: Number of pixels along the Y axis.
+    :type n_y: int
+    :param n_points: Number of profile data points per spectrum.
+    :type n_points: int
+    :param source_file: Directory used as the .d directory for on-disk caches. Defaults to a new temporary directory.
+    :type source_file: str | None
+    """
+    def __init__(self, n_x, n_y, n_points, source_file=None):
+        if source_file is None:
+            source_file = tempfile.mkdtemp(suffix='.d')
+        self.source_file = source_file
+        self.n_points = n_points
+        self.mz_array = np.linspace(SYNTHETIC_MZ_RANGE[0], SYNTHETIC_MZ_RANGE[1], n_points)
+        # Profile peaks are approximated by a few points on either side of each peak center.
+        self.peak_indices = np.searchsorted(self.mz_array, SYNTHETIC_PEAK_MZS)
+        self.peak_half_width = max(1, int(SYNTHETIC_PEAK_WIDTH / (self.mz_array[1] - self.mz_array[0])))
+        frame_ids = np.arange(1, n_x * n_y + 1)
+        x_coords, y_coords = np.meshgrid(np.arange(n_x), np.arange(n_y))
+        self.x_coords = x_coords.ravel()
+        self.y_coords = y_coords.ravel()
+        self.analysis = {'GlobalMetadata': {'MzAcqRangeLower': str(SYNTHETIC_MZ_RANGE[0]),
+                                            'MzAcqRangeUpper': str(SYNTHETIC_MZ_RANGE[1]),
+                                            'ImagingAreaMinXIndexPos': '0',
+                                            'ImagingAreaMaxXIndexPos': str(n_x - 1),
+                                            'ImagingAreaMinYIndexPos': '0',
+                                            'ImagingAreaMaxYIndexPos': str(n_y - 1)},
+                         'Frames': pd.DataFrame({'Id': frame_ids,
+                                                 'SummedIntensities': np.zeros(frame_ids.size),
+                                                 'MaxIntensity': np.zeros(frame_ids.size)}),
+                         'MaldiFrameInfo': pd.DataFrame({'Frame': frame_ids,
+                                                         'XIndexPos': self.x_coords,
+                                                         'YIndexPos': self.y_coords})}
+
+    def get_spectrum_arrays(self, frame, mode='profile'):
+        """
+        Generate the spectrum of a frame.
+
+        :param frame: Frame ID.
+        :type frame: int
+        :param mode: 'profile' or 'centroid'.
+        :type mode: str
+        :return: Tuple of the m/z and intensity arrays.
+        :rtype: tuple[numpy.array]
+        """
+        rng = np.random.default_rng(int(frame))
+        peak_heights = rng.random(SYNTHETIC_PEAK_MZS.size) * 1e4
+        if mode == 'centroid':
+            return self.mz_array[self.peak_indices], peak_heights
+        intensity_array = rng.random(self.n_points, dtype=np.float32) * 10
+        for offset in range(-self.peak_half_width, self.peak_half_width + 1):
+            falloff = 1 - abs(offset) / (self.peak_half_width + 1)
+            intensity_array[np.clip(self.peak_indices + offset, 0, self.n_points - 1)] += peak_heights * falloff
+        return self.mz_array, intensity_array
+
+
+class SyntheticTsfSpectrum(object):
+    """
+    In-process stand-in for pyTDFSDK.classes.TsfSpectrum that reads from a SyntheticTsfData dataset.
+
+    :param data: Synthetic dataset.
+    :type data: benchmarks.synthetic.SyntheticTsfData
+    :param frame: Frame ID.
+    :type frame: int
+    :param mode: 'profile' or 'centroid'.
+    :type mode: str
+    """
+    def __init__(self, data, frame, mode='profile'):
+        self.frame = frame
+        self.mode = mode
+        self.mz_array, self.intensity_array = data.get_spectrum_arrays(frame, mode)
+        self.coord = (int(data.x_coords[frame - 1]), int(data.y_coords[frame - 1]))
+
+
+@contextmanager
+def use_synthetic_sdk():
+    """
+    Route every spectrum read in TSFImagingDataViewer.util.read_spectrum() to the synthetic stand-in. Only in-process
+    reads are affected, so benchmarks must use workers=1.
+    """
+    tsf_spectrum = util.TsfSpectrum
+    util.TsfSpectrum = SyntheticTsfSpectrum
+    try:
+        yield
+    finally:
+        util.TsfSpectrum = tsf_spectrum
+
+
+def remove_synthetic_dataset(data):
+    """
+    Remove the temporary directory of a synthetic dataset and any caches written to it.
+
+    :param data: Synthetic dataset.
+    :type data: benchmarks.synthetic.SyntheticTsfData
+    """
+    shutil.rmtree(data.source_file, ignore_errors=True)
@@ -1,3 +1,13 @@
-from TSFImagingDataViewer.dashboard import app
+import os
+from TSFImagingDataViewer.dashboard import get_app
 
-app.run(debug=False, port=8050, threaded=False)
+# Every browser session loads its own dataset, so the server can handle requests from several users concurrently.
+# Sessions are kept in memory; when using a WSGI server (i.e. gunicorn server:server), use a single worker process
+# with multiple threads or route each session to the same worker.
+# Users choose datasets from the .d directories within TSFIMAGINGDATAVIEWER_DATA_DIR (the current directory by
+# default), since a directory dialog would open on the server rather than in the browser.
+DATA_DIR = os.environ.get('TSFIMAGINGDATAVIEWER_DATA_DIR', os.getcwd())
+server = get_app(data_dir=DATA_DIR).server
+
+if __name__ == '__main__':
+    get_app().run(debug=False, port=8050, threaded=True)
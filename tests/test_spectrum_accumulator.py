@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+from TSFImagingDataViewer.util import SpectrumAccumulator
+
+
+def test_get_average():
+    accumulator = SpectrumAccumulator()
+    mz_array = np.array([100.0, 200.0, 300.0])
+    accumulator.add_spectrum(mz_array, np.array([1.0, 0.0, 3.0]))
+    accumulator.add_spectrum(mz_array, np.array([3.0, 0.0, 1.0]))
+    assert np.array_equal(accumulator.get_average(), [2.0, 0.0, 2.0])
+    assert np.array_equal(accumulator.get_base_peak(), [3.0, 0.0, 3.0])
+    assert np.array_equal(accumulator.count_array, [2, 0, 2])
+
+
+def test_get_average_without_spectra():
+    accumulator = SpectrumAccumulator()
+    accumulator.add_intensities(np.array([100.0, 200.0]), np.empty((0, 2)))
+    accumulator.merge(SpectrumAccumulator())
+    with pytest.raises(ValueError):
+        accumulator.get_average()